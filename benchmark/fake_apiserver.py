@@ -0,0 +1,361 @@
+import copy
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+import yaml
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from deployment.resources import RESOURCE_KINDS
+
+# Kind of the objects on each resource URL name
+PLURAL_KINDS = dict((resource.plural, kind) for kind, resource in RESOURCE_KINDS.items())
+
+
+def _merge(current, patch):
+    # JSON merge patch, lists are replaced as a whole
+    for key, value in patch.items():
+        if value is None:
+            current.pop(key, None)
+        elif isinstance(value, dict) and isinstance(current.get(key), dict):
+            _merge(current[key], value)
+        else:
+            current[key] = copy.deepcopy(value)
+    return current
+
+
+class ApiError(Exception):
+
+    def __init__(self, code, reason, message):
+        super().__init__(message)
+        self.code = code
+        self.reason = reason
+
+
+class FakeApiServer:
+    # In-memory stand-in for the Kubernetes API server endpoints used by the
+    # deployer. Workloads are reported as ready as soon as they are written.
+
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=503, retry_after=None,
+                 seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+
+        self.objects = {}
+        self.requests = Counter()
+        self.injected_errors = Counter()
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+        self._random = random.Random(seed)
+        self._versions = itertools.count(1)
+        self._cluster_ips = itertools.count(1)
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests.clear()
+            self.injected_errors.clear()
+            self.bytes_received = 0
+            self.bytes_sent = 0
+
+    def _next_version(self):
+        return str(next(self._versions))
+
+    def _set_server_fields(self, kind, obj, current=None):
+
+        metadata = obj.setdefault('metadata', {})
+        metadata.pop('resourceVersion', None)
+
+        if current:
+            for field in ('uid', 'creationTimestamp', 'generation'):
+                metadata[field] = current['metadata'][field]
+
+            if obj.get('spec') != current.get('spec'):
+                metadata['generation'] += 1
+        else:
+            metadata['uid'] = str(uuid.uuid4())
+            metadata['creationTimestamp'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            metadata['generation'] = 1
+
+        if kind == 'Service' and obj['spec'].get('clusterIP') != 'None':
+            if current:
+                obj['spec'].setdefault('clusterIP', current['spec'].get('clusterIP'))
+            else:
+                obj['spec'].setdefault('clusterIP',
+                                       '10.96.%d.%d' % divmod(next(self._cluster_ips), 256))
+
+        # Workloads become ready right away, there are no controllers here
+        spec = obj.get('spec') or {}
+        replicas = spec.get('replicas', 1)
+        generation = metadata['generation']
+
+        if kind == 'StatefulSet':
+            revision = '%s-%d' % (metadata.get('name'), generation)
+            obj['status'] = {'observedGeneration': generation, 'replicas': replicas,
+                             'readyReplicas': replicas, 'currentReplicas': replicas,
+                             'updatedReplicas': replicas, 'currentRevision': revision,
+                             'updateRevision': revision}
+        elif kind == 'Deployment':
+            obj['status'] = {'observedGeneration': generation, 'replicas': replicas,
+                             'readyReplicas': replicas, 'updatedReplicas': replicas,
+                             'availableReplicas': replicas}
+        elif kind == 'Job':
+            obj['status'] = {'succeeded': spec.get('completions') or 1,
+                             'conditions': [{'type': 'Complete', 'status': 'True'}]}
+
+        if current and _without_version(obj) == _without_version(current):
+            # Writes that change nothing keep the object version
+            metadata['resourceVersion'] = current['metadata']['resourceVersion']
+        else:
+            metadata['resourceVersion'] = self._next_version()
+
+        return obj
+
+    def handle(self, method, path, query, headers, body):
+
+        url = _parse_path(path)
+        kind = url['kind']
+        key = (url['group'], url['plural'], url['namespace'], url['name'])
+        content_type = headers.get('Content-Type', '')
+
+        if method == 'GET':
+            verb = 'get' if url['name'] else ('watch' if 'watch' in query else 'list')
+        elif method == 'PATCH':
+            verb = 'apply' if 'apply-patch' in content_type else 'patch'
+        else:
+            verb = {'POST': 'create', 'PUT': 'replace', 'DELETE': 'delete'}.get(method, method)
+
+        if url['subresource']:
+            verb += '/' + url['subresource']
+
+        with self._lock:
+            self.requests[(verb, kind)] += 1
+            self.bytes_received += len(body)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            with self._lock:
+                self.injected_errors[(verb, kind)] += 1
+            raise ApiError(self.error_status, 'InjectedError', 'Injected failure')
+
+        with self._lock:
+
+            if verb in ('list', 'watch'):
+                items = [copy.deepcopy(obj) for (group, plural, namespace, name), obj
+                         in sorted(self.objects.items())
+                         if group == url['group'] and plural == url['plural'] and
+                         (url['namespace'] is None or namespace == url['namespace'])]
+
+                selector = query.get('fieldSelector', [''])[0]
+
+                if selector.startswith('metadata.name='):
+                    items = [item for item in items
+                             if item['metadata']['name'] == selector.split('=', 1)[1]]
+
+                if verb == 'watch':
+                    return 200, [{'type': 'ADDED', 'object': item} for item in items]
+
+                return 200, {'kind': kind + 'List', 'apiVersion': url['api_version'],
+                             'metadata': {'resourceVersion': str(next(self._versions))},
+                             'items': items}
+
+            current = self.objects.get(key)
+
+            if verb == 'create':
+                obj = _parse_body(body)
+                key = key[:3] + (obj['metadata']['name'],)
+
+                if key in self.objects:
+                    raise ApiError(409, 'AlreadyExists', '%s "%s" already exists' %
+                                   (url['plural'], key[3]))
+
+                obj = self._set_server_fields(kind, obj)
+                self.objects[key] = obj
+                return 201, obj
+
+            if current is None and verb != 'apply':
+                raise ApiError(404, 'NotFound', '%s "%s" not found' % (url['plural'], key[3]))
+
+            if url['subresource'] == 'scale':
+                return self._handle_scale(verb.split('/')[0], kind, key, current, body)
+
+            if verb == 'get':
+                return 200, copy.deepcopy(current)
+
+            if verb == 'delete':
+                del self.objects[key]
+                return 200, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Success'}
+
+            obj = _parse_body(body)
+
+            if verb == 'replace':
+                version = obj.get('metadata', {}).get('resourceVersion')
+
+                if version and version != current['metadata']['resourceVersion']:
+                    raise ApiError(409, 'Conflict', 'the object has been modified')
+
+                if kind == 'Service':
+                    if not version:
+                        raise ApiError(422, 'Invalid', 'metadata.resourceVersion must be '
+                                                       'specified for an update')
+
+                    if obj['spec'].get('clusterIP') != current['spec'].get('clusterIP'):
+                        raise ApiError(422, 'Invalid', 'spec.clusterIP: field is immutable')
+
+            elif verb == 'patch':
+                obj = _merge(copy.deepcopy(current), obj)
+
+            elif verb == 'apply' and current is not None:
+                # Applied fields replace the ones in the object, a close enough
+                # approximation of server-side apply for a single field manager
+                obj = dict(copy.deepcopy(current), **obj)
+                obj['metadata'] = dict(current['metadata'], **obj['metadata'])
+
+            obj = self._set_server_fields(kind, obj, current)
+            self.objects[key] = obj
+
+            return (201 if current is None else 200), obj
+
+    def _handle_scale(self, verb, kind, key, current, body):
+
+        if verb in ('replace', 'patch'):
+            replicas = _parse_body(body).get('spec', {}).get('replicas')
+
+            if replicas is not None:
+                obj = copy.deepcopy(current)
+                obj['spec']['replicas'] = replicas
+                current = self.objects[key] = self._set_server_fields(kind, obj, current)
+
+        return 200, {'kind': 'Scale', 'apiVersion': 'autoscaling/v1',
+                     'metadata': {'name': key[3], 'namespace': key[2],
+                                  'resourceVersion': current['metadata']['resourceVersion']},
+                     'spec': {'replicas': current['spec'].get('replicas', 1)},
+                     'status': {'replicas': current['status'].get('replicas', 0)}}
+
+
+def _without_version(obj):
+    obj = dict(obj, metadata=dict(obj['metadata']))
+    obj['metadata'].pop('resourceVersion', None)
+    return obj
+
+
+def _parse_body(body):
+    # Apply requests may carry YAML, everything else is JSON
+    try:
+        return json.loads(body.decode())
+    except ValueError:
+        return yaml.safe_load(body.decode())
+
+
+def _parse_path(path):
+
+    parts = [part for part in path.split('/') if part]
+
+    if parts[:2] == ['api', 'v1']:
+        group, api_version, parts = '', 'v1', parts[2:]
+    elif parts[:1] == ['apis'] and len(parts) >= 3:
+        group, api_version, parts = parts[1], '/'.join(parts[1:3]), parts[3:]
+    else:
+        raise ApiError(404, 'NotFound', 'the server could not find the requested resource')
+
+    namespace = None
+
+    if parts[:1] == ['namespaces'] and len(parts) >= 3:
+        namespace, parts = parts[1], parts[2:]
+
+    parts += [None] * (3 - len(parts))
+
+    return {
+        'group': group,
+        'api_version': api_version,
+        'namespace': namespace,
+        'plural': parts[0],
+        'kind': PLURAL_KINDS.get(parts[0], parts[0]),
+        'name': parts[1],
+        'subresource': parts[2]
+    }
+
+
+def _make_handler(server):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        # Headers and body go on separate writes, which would otherwise wait
+        # for the delayed ACK of the client on kept alive connections
+        disable_nagle_algorithm = True
+
+        def _handle(self):
+
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+
+            try:
+                status, payload = server.handle(self.command, url.path, parse_qs(url.query),
+                                                self.headers, body)
+            except ApiError as error:
+                status = error.code
+                payload = {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure',
+                           'reason': error.reason, 'message': str(error), 'code': error.code}
+
+            if isinstance(payload, list):
+                # Watch events, one JSON document per line
+                data = ''.join(json.dumps(event) + '\n' for event in payload).encode()
+            else:
+                data = json.dumps(payload).encode()
+
+            with server._lock:
+                server.bytes_sent += len(data)
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+
+            if status == 429 and server.retry_after is not None:
+                self.send_header('Retry-After', str(server.retry_after))
+
+            if isinstance(payload, list):
+                # Watches are streamed, as the client expects, in a single chunk
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                self.wfile.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(data), data) if data
+                                 else b'0\r\n\r\n')
+            else:
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import copy
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from collections import Counter, OrderedDict
+
+from benchmark.fake_apiserver import FakeApiServer
+from deployment.configuration import ConfigData
+from deployment.manifests import ManifestRepository, dump_yaml_all
+
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger("Benchmark")
+
+# Scenarios in their running order, all of them against the same server:
+# deploy on an empty cluster, deploy again without changes, deploy again
+# with one more kafka broker, deploy on two new namespaces at once with the
+# asyncio deployer and compare the asyncio deployer with a serial deploy
+SCENARIOS = ['cold-create', 'noop-redeploy', 'scale-change', 'async-namespaces',
+             'async-compare']
+
+# Scenarios deploying on namespaces of their own, or on an emptied server,
+# which do not need the previous ones to be run first
+STANDALONE_SCENARIOS = ('async-namespaces', 'async-compare')
+
+# Suffixes of the namespaces of the async-namespaces scenario
+ASYNC_NAMESPACES = ('-async-1', '-async-2')
+
+# Requests in flight of the asyncio deployer
+ASYNC_CONCURRENCY = 8
+
+# Seconds added at least to every request of the async-compare scenario,
+# without latency there is little for concurrent requests to save
+ASYNC_COMPARE_LATENCY = 0.01
+
+# Times the asyncio deployer must be faster than the serial deploy
+MIN_ASYNC_SPEEDUP = 1.3
+
+# Metadata fields set by the server, which differ between two deploys
+SERVER_FIELDS = ('uid', 'creationTimestamp', 'resourceVersion', 'generation')
+
+# Maximum number of API requests of each scenario, by request group. The
+# benchmark fails when a change makes the deployer go over any of them
+CALL_BUDGETS = {
+    'cold-create': {'total': 100, 'write': 80},
+    'noop-redeploy': {'total': 20, 'write': 3},
+    'scale-change': {'total': 25, 'write': 5},
+    'async-namespaces': {'total': 220, 'write': 170},
+    'async-compare': {'total': 200, 'write': 160},
+}
+
+WRITE_VERBS = ('create', 'replace', 'patch', 'apply', 'delete')
+
+
+def write_kubeconfig(server_url, directory):
+
+    config = {
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'clusters': [{'name': 'fake', 'cluster': {'server': server_url}}],
+        'users': [{'name': 'fake', 'user': {'token': 'fake'}}],
+        'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake'}}],
+        'current-context': 'fake'
+    }
+
+    path = os.path.join(directory, 'kubeconfig')
+
+    with open(path, 'w') as kubeconfig:
+        dump_yaml_all([config], kubeconfig)
+
+    return path
+
+
+def scenario_config(args, scenario):
+
+    conf = ConfigData(args.config_file)
+
+    if scenario == 'scale-change':
+        conf.get_config_data('services')['kafka']['clusterSize'] += 1
+
+    return conf
+
+
+async def _timed_deploy(deployer, async_client):
+
+    start = time.monotonic()
+    await deployer.deploy_async(async_client)
+
+    return start, time.monotonic()
+
+
+async def deploy_namespaces(deployers, async_client):
+    # Deploys on every namespace at once on the running event loop, and
+    # returns when each deploy started and finished
+
+    try:
+        return await asyncio.gather(*[_timed_deploy(deployer, async_client)
+                                      for deployer in deployers])
+    finally:
+        async_client.close()
+
+
+def check_async_deploy(server, deployers, times):
+    # Problems of a deploy on several namespaces: objects of a namespace
+    # missing on the server, or deploys that did not overlap
+
+    problems = []
+
+    for deployer in deployers:
+        namespace = deployer.config.get_config_data('namespace')
+        written = set(key[2:] for key in server.objects)
+        missing = [body['metadata']['name'] for objects in deployer.render().values()
+                   for body in objects if body['metadata'].get('namespace') == namespace and
+                   (namespace, body['metadata']['name']) not in written]
+
+        if missing:
+            problems.append("%d objects missing on namespace '%s'" % (len(missing), namespace))
+
+    # Deploys blocking the event loop would run one after the other
+    if max(start for start, _ in times) >= min(end for _, end in times):
+        problems.append("the deploys did not run concurrently")
+
+    return problems
+
+
+def server_state(server):
+    # Objects of the server without the fields the server itself sets
+
+    objects = {}
+
+    with server._lock:
+        for key, obj in server.objects.items():
+            obj = copy.deepcopy(obj)
+
+            for field in SERVER_FIELDS:
+                obj['metadata'].pop(field, None)
+
+            (obj.get('spec') or {}).pop('clusterIP', None)
+            objects[key] = obj
+
+    return objects
+
+
+def clear_server(server):
+    with server._lock:
+        server.objects.clear()
+
+
+def compare_async_deploy(args, server, manifests):
+    # Deploys on an empty server serially and then, on an empty server again,
+    # with the asyncio deployer, and returns the problems found: objects or
+    # write results that differ, or an asyncio deploy not faster enough
+
+    from deployment.async_kube import AsyncKubeClient
+    from deployment.deployer import KubeDeployer
+    from deployment.kube import KubeClient, DEFAULT_CONNECTION
+
+    connection = DEFAULT_CONNECTION._replace(pool_size=ASYNC_CONCURRENCY)
+    runs = []
+
+    for mode in ('serial', 'async'):
+        kube_client = KubeClient(apply_mode=args.apply_mode, connection=connection)
+        deployer = KubeDeployer(scenario_config(args, 'async-compare'), kube_client, manifests)
+
+        clear_server(server)
+        start = time.monotonic()
+
+        if mode == 'serial':
+            deployer.deploy(1)
+        else:
+            asyncio.run(deployer.deploy_async(AsyncKubeClient(kube_client, ASYNC_CONCURRENCY)))
+
+        runs.append((time.monotonic() - start, server_state(server), kube_client.write_stats))
+
+    (serial_seconds, serial_objects, serial_stats), \
+        (async_seconds, async_objects, async_stats) = runs
+
+    problems = []
+
+    for key in sorted(set(serial_objects) | set(async_objects)):
+        if serial_objects.get(key) != async_objects.get(key):
+            problems.append("%s/%s differs between the serial and the asyncio deploys" %
+                            (key[1], key[3]))
+
+    if serial_stats != async_stats:
+        problems.append("write results differ, serial %s and asyncio %s" %
+                        (dict(serial_stats), dict(async_stats)))
+
+    speedup = serial_seconds / async_seconds
+    print("serial deploy: %.3fs, asyncio deploy: %.3fs, speedup %.1fx" %
+          (serial_seconds, async_seconds, speedup))
+
+    if speedup < MIN_ASYNC_SPEEDUP:
+        problems.append("asyncio deploy only %.1fx faster than the serial one, expected %.1fx" %
+                        (speedup, MIN_ASYNC_SPEEDUP))
+
+    return problems
+
+
+def run_scenario(args, scenario, server, manifests):
+
+    # Imported once the kubeconfig is in place, the client reads its
+    # location when imported
+    from deployment.async_kube import AsyncKubeClient
+    from deployment.deployer import KubeDeployer
+    from deployment.kube import KubeClient, DEFAULT_CONNECTION
+    from deployment.scheduler import SchedulerError
+
+    kube_client = KubeClient(apply_mode=args.apply_mode, connection=DEFAULT_CONNECTION._replace(
+        pool_size=max(args.parallelism, ASYNC_CONCURRENCY)))
+    problems = []
+
+    if scenario == 'async-namespaces':
+        deployers = []
+
+        for suffix in ASYNC_NAMESPACES:
+            conf = scenario_config(args, scenario)
+            conf.get_config_data()['namespace'] += suffix
+            deployers.append(KubeDeployer(conf, kube_client, manifests))
+    elif scenario != 'async-compare':
+        deployer = KubeDeployer(scenario_config(args, scenario), kube_client, manifests)
+
+    latency = server.latency
+
+    if scenario == 'async-compare':
+        server.latency = max(latency, ASYNC_COMPARE_LATENCY)
+
+    server.reset_stats()
+    start = time.monotonic()
+
+    try:
+        if scenario == 'async-namespaces':
+            async_client = AsyncKubeClient(kube_client, ASYNC_CONCURRENCY)
+            times = asyncio.run(deploy_namespaces(deployers, async_client))
+            problems = check_async_deploy(server, deployers, times)
+        elif scenario == 'async-compare':
+            problems = compare_async_deploy(args, server, manifests)
+        else:
+            deployer.deploy(args.parallelism)
+        failed = False
+    except (SystemExit, SchedulerError):
+        failed = True
+    finally:
+        server.latency = latency
+
+    result = {
+        'scenario': scenario,
+        'failed': failed,
+        'problems': problems,
+        'seconds': time.monotonic() - start,
+        'requests': Counter(server.requests),
+        'injected_errors': Counter(server.injected_errors),
+        'bytes_sent': server.bytes_received,
+        'bytes_received': server.bytes_sent
+    }
+
+    return result
+
+
+def check_budget(result):
+
+    # Requests failed on purpose, and so their retries, are not the deployer fault
+    requests = result['requests'] - result['injected_errors']
+    counts = {
+        'total': sum(requests.values()),
+        'write': sum(count for (verb, _), count in requests.items()
+                     if verb.split('/')[0] in WRITE_VERBS)
+    }
+
+    return ["%s requests: %d, budget %d" % (group, counts[group], budget)
+            for group, budget in sorted(CALL_BUDGETS[result['scenario']].items())
+            if counts[group] > budget]
+
+
+def print_report(result, over_budget):
+
+    requests = result['requests']
+
+    print("== %s%s" % (result['scenario'], " (FAILED)" if result['failed'] else ""))
+    print("wall time: %.3fs" % result['seconds'])
+    print("requests: %d, bytes sent: %d, bytes received: %d" %
+          (sum(requests.values()), result['bytes_sent'], result['bytes_received']))
+
+    if result['injected_errors']:
+        print("injected errors: %d" % sum(result['injected_errors'].values()))
+
+    by_verb = Counter()
+    for (verb, _), count in requests.items():
+        by_verb[verb] += count
+
+    print("by verb: %s" % ", ".join("%s=%d" % item for item in sorted(by_verb.items())))
+
+    for (verb, kind), count in sorted(requests.items()):
+        print("  %-8s %-24s %5d" % (verb, kind, count))
+
+    for line in over_budget:
+        print("OVER BUDGET: %s" % line)
+
+    for line in result['problems']:
+        print("CHECK FAILED: %s" % line)
+
+    print("")
+
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser(
+        description="Measure the deployer requests against a local fake Kubernetes API server")
+
+    parser.add_argument("-c", "--config", dest='config_file',
+                        action='store', default='config.yaml',
+                        help="Path to the deployment configuration file")
+
+    parser.add_argument("-s", "--scenario", dest='scenarios',
+                        action='append', choices=SCENARIOS,
+                        help="Scenario to run, may be repeated, all of them by default")
+
+    parser.add_argument("-p", "--parallelism", dest='parallelism',
+                        action='store', type=int, default=1,
+                        help="Number of dojot components deployed concurrently")
+
+    parser.add_argument("--apply", dest='apply_mode',
+                        action='store_true', default=False,
+                        help="Write each object with a single server-side apply request")
+
+    parser.add_argument("--latency", dest='latency',
+                        action='store', type=float, default=0,
+                        help="Milliseconds added to every API request")
+
+    parser.add_argument("--error-rate", dest='error_rate',
+                        action='store', type=float, default=0,
+                        help="Fraction of the API requests that fail")
+
+    parser.add_argument("--error-status", dest='error_status',
+                        action='store', type=int, default=503,
+                        help="HTTP status of the failing requests")
+
+    parser.add_argument("--retry-after", dest='retry_after',
+                        action='store', type=int,
+                        help="Retry-After seconds sent with the 429 responses")
+
+    parser.add_argument("--seed", dest='seed',
+                        action='store', type=int,
+                        help="Seed of the error injection, for repeatable runs")
+
+    parser.add_argument("-v", "--verbose", dest='verbose',
+                        action='store_true', default=False,
+                        help="Show the deployer log")
+
+    return parser.parse_args()
+
+
+def main():
+
+    args = parse_arguments()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    selected = args.scenarios or SCENARIOS
+    chained = [scenario for scenario in SCENARIOS if scenario not in STANDALONE_SCENARIOS]
+
+    # Scenarios build on the previous ones, which are run before the
+    # selected ones even when not selected themselves
+    scenarios = chained[:max([chained.index(scenario) + 1 for scenario in selected
+                              if scenario in chained] or [0])]
+    scenarios += [scenario for scenario in STANDALONE_SCENARIOS if scenario in selected]
+
+    server = FakeApiServer(latency=args.latency / 1000.0, error_rate=args.error_rate,
+                           error_status=args.error_status, retry_after=args.retry_after,
+                           seed=args.seed).start()
+
+    over_budget = OrderedDict()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['KUBECONFIG'] = write_kubeconfig(server.url, directory)
+
+        manifests = ManifestRepository()
+
+        try:
+            for scenario in scenarios:
+                result = run_scenario(args, scenario, server, manifests)
+
+                if scenario not in selected:
+                    continue
+
+                over_budget[scenario] = check_budget(result)
+                print_report(result, over_budget[scenario])
+
+                over_budget[scenario] += result['problems']
+
+                if result['failed']:
+                    over_budget[scenario].append("deployment failed")
+        finally:
+            server.stop()
+
+    failed = [scenario for scenario, problems in over_budget.items() if problems]
+
+    if failed:
+        logger.error("Scenarios over their budget or failed: %s" % ", ".join(failed))
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+// Adds the shards to the cluster and spreads the device history over them.
+// Expects 'shards', 'databases' and 'shardKey' to be defined before it runs.
+
+var known = db.getSiblingDB('admin').runCommand({listShards: 1}).shards.map(
+    function (shard) { return shard._id; });
+
+shards.forEach(function (shard) {
+    if (known.indexOf(shard.name) < 0) {
+        printjson(sh.addShard(shard.name + '/' + shard.hosts.join(',')));
+    }
+});
+
+var config = db.getSiblingDB('config');
+
+databases.forEach(function (name) {
+    var database = config.databases.findOne({_id: name});
+
+    if (!database || !database.partitioned) {
+        printjson(sh.enableSharding(name));
+    }
+
+    // Hashed keys spread the inserts of growing keys, such as timestamps and
+    // object ids, evenly over the shards
+    var key = {};
+    key[shardKey] = 'hashed';
+
+    db.getSiblingDB(name).getCollectionNames().forEach(function (collection) {
+        var namespace = name + '.' + collection;
+
+        if (collection.indexOf('system.') === 0 ||
+                config.collections.findOne({_id: namespace, dropped: false})) {
+            return;
+        }
+
+        // Collections with documents need the index of the key beforehand
+        db.getSiblingDB(name)[collection].createIndex(key);
+        printjson(sh.shardCollection(namespace, key));
+    });
+});
@@ -5,7 +5,10 @@ import logging
 import sys
 
 from deployment.configuration import ConfigData
-from deployment.deployer import KubeDeployer
+from deployment.deployer import KubeDeployer, select_steps
+from deployment.plan import write_plan
+from deployment.render import OUTPUT_FORMATS, write_render
+from deployment.resources import ObjectCollector
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger("Main")
@@ -13,23 +16,269 @@ logger = logging.getLogger("Main")
 
 def parse_arguments():
 
-    logger.info("Parsing Input Arguments")
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-c", "--config", dest='config_file',
                         action='store', default='config.yaml',
                         help="Path to the deployment configuration file")
 
-    return parser.parse_args()
+    parser.add_argument("-p", "--parallelism", dest='parallelism',
+                        action='store', type=int, default=1,
+                        help="Number of dojot components deployed concurrently")
+
+    parser.add_argument("--apply", dest='apply_mode',
+                        action='store_true', default=False,
+                        help="Write each object with a single server-side apply request. "
+                             "Only for Kubernetes 1.14 and 1.15 with the ServerSideApply "
+                             "feature gate on, later versions dropped the "
+                             "extensions/v1beta1 and apps/v1beta1 APIs of the manifests")
+
+    parser.add_argument("--qps", dest='qps',
+                        action='store', type=float,
+                        help="Maximum average number of API requests per second, "
+                             "unlimited by default")
+
+    parser.add_argument("--burst", dest='burst',
+                        action='store', type=int,
+                        help="Number of API requests allowed at once above --qps, "
+                             "the qps value by default")
+
+    parser.add_argument("--max-retries", dest='max_retries',
+                        action='store', type=int,
+                        help="Number of retries of throttled or failed API requests, "
+                             "5 by default")
+
+    parser.add_argument("--pool-size", dest='pool_size',
+                        action='store', type=int,
+                        help="Number of connections kept to the API server, "
+                             "the parallelism by default")
+
+    parser.add_argument("--connect-timeout", dest='connect_timeout',
+                        action='store', type=float,
+                        help="Seconds to wait for a connection to the API server, 0 to wait "
+                             "forever, 10 by default")
+
+    parser.add_argument("--read-timeout", dest='read_timeout',
+                        action='store', type=float,
+                        help="Seconds to wait for an API server response, 0 to wait "
+                             "forever, 60 by default")
+
+    parser.add_argument("--keep-alive", dest='keep_alive',
+                        action='store', type=int,
+                        help="Seconds of idle connection before TCP keep-alive probes, "
+                             "0 to disable them, 60 by default")
+
+    parser.add_argument("-w", "--wait", dest='wait',
+                        action='store_true', default=False,
+                        help="Wait for each component to be ready before deploying "
+                             "the components that depend on it")
+
+    parser.add_argument("--only", dest='only',
+                        action='store', metavar='COMPONENTS',
+                        help="Comma separated components to deploy, such as gui,history. "
+                             "storage and external-access are only configured when named")
+
+    parser.add_argument("--skip", dest='skip',
+                        action='store', metavar='COMPONENTS',
+                        help="Comma separated components not to deploy")
+
+    parser.add_argument("--with-deps", dest='with_deps',
+                        action='store_true', default=False,
+                        help="Also deploy the components the ones given to --only depend on")
+
+    parser.add_argument("-r", "--render", dest='render',
+                        action='store', metavar='DIR|-',
+                        help="Write the objects that would be deployed to a directory, "
+                             "or to stdout with '-', without contacting the cluster")
+
+    parser.add_argument("--plan", dest='plan',
+                        action='store_true', default=False,
+                        help="Show the objects a deploy would create, update or leave "
+                             "untouched, and their changed fields, without writing anything")
+
+    parser.add_argument("--capacity", dest='capacity',
+                        action='store_true', default=False,
+                        help="Check whether the pods and volumes of the deploy fit on the "
+                             "cluster, without writing anything")
+
+    parser.add_argument("--preflight", dest='preflight',
+                        action='store_true', default=False,
+                        help="Only run the checks made before a deploy")
+
+    parser.add_argument("--skip-preflight", dest='skip_preflight',
+                        action='store_true', default=False,
+                        help="Deploy without checking the cluster beforehand")
+
+    parser.add_argument("-o", "--output-format", dest='output_format',
+                        action='store', choices=OUTPUT_FORMATS, default='yaml',
+                        help="Format of the rendered objects, json also writes the plan "
+                             "as a single JSON document")
+
+    parser.add_argument("--metrics-file", dest='metrics_file',
+                        action='store', metavar='FILE',
+                        help="Write the API call latencies to a Prometheus textfile, "
+                             "or to a JSON report when FILE ends with .json")
+
+    args = parser.parse_args()
+
+    if len([mode for mode in (args.render, args.plan, args.preflight, args.capacity)
+            if mode]) > 1:
+        parser.error("--render, --plan, --preflight and --capacity cannot be used together")
+
+    if args.preflight and args.skip_preflight:
+        parser.error("--preflight and --skip-preflight cannot be used together")
+
+    if args.render == '-' or args.plan or args.capacity:
+        # Keeps stdout for the rendered objects or the reports
+        for handler in logging.getLogger().handlers:
+            handler.setStream(sys.stderr)
+
+    logger.info("Parsing Input Arguments")
+
+    if args.parallelism < 1:
+        parser.error("parallelism must be at least 1")
+
+    for setting in ('qps', 'max_retries', 'connect_timeout', 'read_timeout', 'keep_alive'):
+        if getattr(args, setting) is not None and getattr(args, setting) < 0:
+            parser.error("%s must not be negative" % setting.replace('_', '-'))
+
+    for setting in ('burst', 'pool_size'):
+        if getattr(args, setting) is not None and getattr(args, setting) < 1:
+            parser.error("%s must be at least 1" % setting.replace('_', '-'))
+
+    if args.with_deps and not args.only:
+        parser.error("--with-deps requires --only")
+
+    # Steps of a selective deploy, None deploys everything
+    args.steps = None
+
+    if args.only or args.skip:
+        try:
+            args.steps = select_steps(_names(args.only), _names(args.skip), args.with_deps)
+        except ValueError as error:
+            parser.error(str(error))
+
+        if not args.steps:
+            parser.error("no component left to deploy")
+
+    return args
+
+
+def _names(value):
+    return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+
+def create_kube_client(args, conf, min_pool_size=1):
+
+    from deployment.kube import KubeClient, ConnectionSettings, DEFAULT_CONNECTION
+    from deployment.retry import RateLimiter, RetryPolicy, DEFAULT_MAX_RETRIES
+
+    client_data = conf.get_config_data('kubeClient')
+
+    # Command line options take precedence over the configuration file
+    def setting(option, name, default):
+        value = getattr(args, option)
+        return value if value is not None else client_data.get(name, default)
+
+    qps = setting('qps', 'qps', 0)
+    rate_limiter = RateLimiter(qps, setting('burst', 'burst', None)) if qps else None
+
+    # Every component deployed concurrently gets a connection of its own
+    connection = ConnectionSettings(
+        pool_size=max(setting('pool_size', 'poolSize', args.parallelism), min_pool_size),
+        connect_timeout=setting('connect_timeout', 'connectTimeout',
+                                DEFAULT_CONNECTION.connect_timeout),
+        read_timeout=setting('read_timeout', 'readTimeout', DEFAULT_CONNECTION.read_timeout),
+        keep_alive=setting('keep_alive', 'keepAlive', DEFAULT_CONNECTION.keep_alive))
+
+    max_retries = setting('max_retries', 'maxRetries', DEFAULT_MAX_RETRIES)
+
+    return KubeClient(apply_mode=args.apply_mode,
+                      retry_policy=RetryPolicy(max_retries=max_retries),
+                      rate_limiter=rate_limiter,
+                      connection=connection)
+
+
+def rendered_objects(args, conf):
+
+    renderer = KubeDeployer(conf, ObjectCollector())
+
+    return [body for step_objects in renderer.render(args.steps).values()
+            for body in step_objects]
+
+
+def run_preflight(args, conf):
+    # Checks the cluster before anything is written, reporting every problem
+    # found at once, and returns the client for the deploy
+
+    from deployment.preflight import PreflightChecks, KUBECONFIG_ERRORS, PREFLIGHT_WORKERS
+
+    kube_client = None
+    kube_error = None
+
+    # Every check running at once gets a connection of its own
+    try:
+        kube_client = create_kube_client(args, conf, PREFLIGHT_WORKERS)
+    except KUBECONFIG_ERRORS as error:
+        kube_error = error
+
+    objects = rendered_objects(args, conf)
+
+    if not PreflightChecks(conf, objects, kube_client, kube_error, args.wait).run():
+        logger.error("Preflight checks failed, nothing was deployed")
+        exit(1)
+
+    return kube_client
 
 
 def main():
 
     args = parse_arguments()
     conf = ConfigData(args.config_file)
-    deployer = KubeDeployer(conf)
 
-    deployer.deploy()
+    if args.render:
+        deployer = KubeDeployer(conf, ObjectCollector())
+        write_render(deployer.render(args.steps), args.render, args.output_format)
+        return
+
+    if args.plan or args.capacity or args.skip_preflight:
+        kube_client = create_kube_client(args, conf)
+    else:
+        kube_client = run_preflight(args, conf)
+
+        if args.preflight:
+            return
+
+    if args.capacity:
+        from deployment.capacity import CapacityPlanner, write_capacity
+
+        report = CapacityPlanner(kube_client, rendered_objects(args, conf),
+                                 conf.get_config_data('namespace')).run()
+        write_capacity(report, args.output_format)
+
+        if not report['fits']:
+            exit(1)
+        return
+
+    deployer = KubeDeployer(conf, kube_client)
+
+    if args.plan:
+        planned = deployer.plan(args.steps)
+        write_plan(planned, args.output_format)
+
+        # Fails when the deploy would be refused
+        if any(change.action == 'refused' for change in planned):
+            exit(1)
+        return
+
+    try:
+        deployer.deploy(args.parallelism, args.wait, args.steps)
+    finally:
+        # Also reported when the deploy fails
+        kube_client.metrics.log_summary()
+
+        if args.metrics_file:
+            kube_client.metrics.write_report(args.metrics_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .resources import ResourceWriter, ObjectCollector
+
+logger = logging.getLogger("AsyncKubernetes")
+
+# ResourceWriter methods that get an awaitable version on AsyncKubeClient
+WRITER_METHODS = [name for name in vars(ResourceWriter)
+                  if name.startswith('create_') or name == 'start_job']
+
+# Requests in flight of a client created by AsyncKubeClient itself
+DEFAULT_CONCURRENCY = 8
+
+
+class AsyncKubeClient:
+    # Awaitable facade over the synchronous KubeClient. It is not a
+    # non-blocking client: every request still blocks a thread of a pool,
+    # the event loop being only free to run other coroutines meanwhile.
+    # The requests keep the create/replace semantics of the wrapped client,
+    # and at most 'concurrency' of them are in flight at any time, a number
+    # bounded by the connection pool of the wrapped client, which blocks
+    # once all of its connections are taken
+
+    def __init__(self, kube_client=None, concurrency=None):
+
+        if kube_client is None:
+            from .kube import KubeClient, DEFAULT_CONNECTION
+            kube_client = KubeClient(connection=DEFAULT_CONNECTION._replace(
+                pool_size=concurrency or DEFAULT_CONCURRENCY))
+
+        pool_size = kube_client.connection.pool_size
+
+        if concurrency is None:
+            concurrency = pool_size
+        elif concurrency > pool_size:
+            logger.warning("Only %d of the %d concurrent requests asked for can run at once,"
+                           " the size of the client connection pool" % (pool_size, concurrency))
+            concurrency = pool_size
+
+        self.kube_client = kube_client
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args))
+
+    async def write(self, body):
+        await self._run(self.kube_client.write, body)
+
+    async def write_all(self, bodies):
+        # Objects of the same component are written in their manifest order
+        for body in bodies:
+            await self.write(body)
+
+    async def delete(self, kind, name, namespace=None):
+        await self._run(self.kube_client.delete, kind, name, namespace)
+
+    async def load_snapshot(self, namespace):
+        await self._run(self.kube_client.load_snapshot, namespace)
+
+    def log_write_summary(self):
+        self.kube_client.log_write_summary()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def _async_writer(method_name):
+
+    async def method(self, *args):
+        collector = ObjectCollector()
+        getattr(collector, method_name)(*args)
+        await self.write_all(collector.objects)
+
+    method.__name__ = method_name
+    return method
+
+
+for _method_name in WRITER_METHODS:
+    setattr(AsyncKubeClient, _method_name, _async_writer(_method_name))
@@ -0,0 +1,336 @@
+import json
+import logging
+import sys
+
+from collections import Counter, OrderedDict, namedtuple
+
+from .preflight import BLOCKING_TAINTS, required_anti_affinity
+from .profiles import WORKLOAD_KINDS, pod_resources, requested_resources, workload_replicas
+from .quantities import parse_cpu, parse_memory, parse_quantity
+from .resources import describe
+
+logger = logging.getLogger("Capacity")
+
+# A pod of a rendered workload, with the CPU, in cores, and memory, in
+# bytes, it requests
+Pod = namedtuple('Pod', ['workload', 'index', 'cpu', 'memory', 'spec'])
+
+# Pods that are done do not take anything from their nodes
+FINISHED_PHASES = ('Succeeded', 'Failed')
+
+GIBIBYTE = 2 ** 30
+
+
+def _tolerates(pod_spec, taint):
+
+    for toleration in pod_spec.get('tolerations') or []:
+        if toleration.get('effect') and toleration['effect'] != taint['effect']:
+            continue
+
+        if toleration.get('operator') == 'Exists' and \
+                toleration.get('key') in (None, taint['key']):
+            return True
+
+        if toleration.get('key') == taint['key'] and \
+                toleration.get('value') == taint.get('value'):
+            return True
+
+    return False
+
+
+def _storage_class(claim_spec):
+    return claim_spec.get('storageClassName') or 'default'
+
+
+class Node:
+    # Room left on a node for the dojot pods and the pods placed on it
+
+    def __init__(self, name, cpu, memory, pods, labels, taints):
+        self.name = name
+        self.cpu = cpu
+        self.memory = memory
+        self.pods = pods
+        self.labels = labels
+        self.taints = taints
+
+        self.used_cpu = 0.0
+        self.used_memory = 0
+        self.used_pods = 0
+        self.placed = []
+
+    def take(self, cpu, memory):
+        self.used_cpu += cpu
+        self.used_memory += memory
+        self.used_pods += 1
+
+    def usage(self, cpu=0.0, memory=0):
+        # Highest fraction of the node taken, with a pod of the given size on
+        # top, and the resource taking it
+
+        usage = [((self.used_cpu + cpu) / self.cpu if self.cpu else 1.0, 'cpu'),
+                 ((self.used_memory + memory) / self.memory if self.memory else 1.0, 'memory')]
+
+        return max(usage)
+
+    def accepts(self, pod):
+
+        if self.used_pods >= self.pods or \
+                self.used_cpu + pod.cpu > self.cpu or \
+                self.used_memory + pod.memory > self.memory:
+            return False
+
+        for key, value in (pod.spec.get('nodeSelector') or {}).items():
+            if self.labels.get(key) != value:
+                return False
+
+        if any(taint['effect'] in BLOCKING_TAINTS and not _tolerates(pod.spec, taint)
+               for taint in self.taints):
+            return False
+
+        # Required anti-affinity keeps the pods of a workload apart
+        if required_anti_affinity(pod.spec) and \
+                any(placed.workload == pod.workload for placed in self.placed):
+            return False
+
+        return True
+
+
+def workload_pods(objects):
+    # Every pod the rendered workloads run, by decreasing size so the
+    # largest ones are placed first
+
+    pods = []
+
+    for body in objects:
+        if body['kind'] not in WORKLOAD_KINDS:
+            continue
+
+        pod_spec = body['spec']['template']['spec']
+        resources = pod_resources(pod_spec)
+        workload = describe(body['kind'], body['metadata']['name'],
+                            body['metadata'].get('namespace'))
+
+        for index in range(workload_replicas(body)):
+            pods.append(Pod(workload, index, resources['requests.cpu'],
+                            resources['requests.memory'], pod_spec))
+
+    return sorted(pods, key=lambda pod: (pod.memory, pod.cpu), reverse=True)
+
+
+def place_pods(pods, nodes):
+    # Places each pod on the node left the least used after taking it, as
+    # the scheduler spreads the pods, and returns the pods left out
+
+    unplaced = []
+
+    for pod in pods:
+        candidates = [node for node in nodes if node.accepts(pod)]
+
+        if not candidates:
+            unplaced.append(pod)
+            continue
+
+        node = min(candidates,
+                   key=lambda node: (node.usage(pod.cpu, pod.memory)[0], node.used_pods))
+        node.take(pod.cpu, pod.memory)
+        node.placed.append(pod)
+
+    return unplaced
+
+
+class CapacityPlanner:
+    # Checks whether the rendered objects fit on the nodes of the cluster,
+    # next to the pods already running on them outside of the namespace
+
+    def __init__(self, kube_client, objects, namespace):
+        self.kube_client = kube_client
+        self.objects = objects
+        self.namespace = namespace
+
+    def nodes(self):
+
+        nodes = OrderedDict()
+
+        for item in self.kube_client.call('list', 'Node', self.kube_client.v1.list_node).items:
+            ready = any(condition.type == 'Ready' and condition.status == 'True'
+                        for condition in item.status.conditions or [])
+
+            if item.spec.unschedulable or not ready:
+                continue
+
+            allocatable = item.status.allocatable or {}
+            taints = [{'key': taint.key, 'value': taint.value, 'effect': taint.effect}
+                      for taint in item.spec.taints or []]
+
+            nodes[item.metadata.name] = Node(item.metadata.name,
+                                             parse_cpu(allocatable.get('cpu', '0')),
+                                             parse_memory(allocatable.get('memory', '0')),
+                                             int(parse_quantity(allocatable.get('pods', '0'))),
+                                             item.metadata.labels or {}, taints)
+
+        # Pods of the namespace are left out, the deploy replaces them
+        running = self.kube_client.call('list', 'Pod',
+                                        self.kube_client.v1.list_pod_for_all_namespaces).items
+
+        for item in running:
+            if item.metadata.namespace == self.namespace or \
+                    item.status.phase in FINISHED_PHASES or item.spec.node_name not in nodes:
+                continue
+
+            cpu = 0.0
+            memory = 0
+
+            for container in item.spec.containers:
+                requests = (container.resources and container.resources.requests) or {}
+                cpu += parse_cpu(requests.get('cpu', '0'))
+                memory += parse_memory(requests.get('memory', '0'))
+
+            nodes[item.spec.node_name].take(cpu, memory)
+
+        return list(nodes.values())
+
+    def storage_quotas(self):
+        # Storage left on the resource quotas of the namespace, by storage class
+
+        quotas = self.kube_client.call(
+            'list', 'ResourceQuota', self.kube_client.v1.list_namespaced_resource_quota,
+            self.namespace).items
+
+        left = {}
+        suffix = '.storageclass.storage.k8s.io/requests.storage'
+
+        for quota in quotas:
+            hard = quota.status.hard or quota.spec.hard or {}
+            used = quota.status.used or {}
+
+            for field, limit in hard.items():
+                if field.endswith(suffix):
+                    storage_class = field[:-len(suffix)]
+                    headroom = parse_memory(limit) - parse_memory(used.get(field, '0'))
+                    left[storage_class] = min(headroom, left.get(storage_class, headroom))
+
+        return left
+
+    def storage(self):
+        # Storage requested by the rendered objects, by storage class
+
+        storage = Counter()
+
+        for body in self.objects:
+            if body['kind'] == 'PersistentVolumeClaim':
+                storage[_storage_class(body['spec'])] += \
+                    requested_resources(body)['requests.storage']
+
+            elif body['kind'] == 'StatefulSet':
+                for claim in body['spec'].get('volumeClaimTemplates') or []:
+                    storage[_storage_class(claim['spec'])] += workload_replicas(body) * \
+                        parse_memory(claim['spec']['resources']['requests']['storage'])
+
+        return storage
+
+    def run(self):
+
+        totals = Counter()
+
+        for body in self.objects:
+            totals.update(requested_resources(body))
+
+        pods = workload_pods(self.objects)
+        nodes = self.nodes()
+        unplaced = place_pods(pods, nodes)
+
+        storage_left = self.storage_quotas()
+        storage = []
+
+        for storage_class, requested in sorted(self.storage().items()):
+            storage.append({
+                'storageClass': storage_class,
+                'requested': requested,
+                'available': storage_left.get(storage_class),
+                'fits': storage_class not in storage_left or
+                requested <= storage_left[storage_class]
+            })
+
+        report_nodes = []
+
+        for node in nodes:
+            usage, resource = node.usage()
+            report_nodes.append({
+                'name': node.name,
+                'cpu': node.cpu,
+                'memory': node.memory,
+                'usedCpu': node.used_cpu,
+                'usedMemory': node.used_memory,
+                'pods': len(node.placed),
+                'usage': usage,
+                'bottleneck': resource
+            })
+
+        bottleneck = max(report_nodes, key=lambda node: node['usage']) if report_nodes else None
+
+        return {
+            'fits': not unplaced and all(entry['fits'] for entry in storage),
+            'requests': {
+                'cpu': totals['requests.cpu'],
+                'memory': totals['requests.memory'],
+                'pods': totals['pods']
+            },
+            'withoutRequests': sorted(set(pod.workload for pod in pods
+                                          if not pod.cpu and not pod.memory)),
+            'nodes': report_nodes,
+            'bottleneck': bottleneck and bottleneck['name'],
+            'unplaced': ["%s, pod %d" % (pod.workload, pod.index) for pod in unplaced],
+            'storage': storage
+        }
+
+
+def _gibibytes(value):
+    return "%.2fGi" % (value / GIBIBYTE)
+
+
+def write_capacity(report, output_format='yaml', stream=None):
+    # Writes the report of a capacity check as text, or with the json
+    # format as a single document
+
+    stream = stream or sys.stdout
+
+    if output_format == 'json':
+        json.dump(report, stream, indent=2)
+        stream.write('\n')
+        return
+
+    requests = report['requests']
+    stream.write("Requested: %.2f cores and %s of memory in %d pods\n" %
+                 (requests['cpu'], _gibibytes(requests['memory']), requests['pods']))
+
+    if report['withoutRequests']:
+        stream.write("Without requests, counted as empty: %s\n" %
+                     ", ".join(report['withoutRequests']))
+
+    stream.write("\n%-30s %20s %20s %6s %6s\n" %
+                 ('NODE', 'CPU (used/alloc)', 'MEMORY (used/alloc)', 'PODS', 'USAGE'))
+
+    for node in report['nodes']:
+        stream.write("%-30s %20s %20s %6d %5d%%\n" % (
+            node['name'], "%.2f/%.2f" % (node['usedCpu'], node['cpu']),
+            "%s/%s" % (_gibibytes(node['usedMemory']), _gibibytes(node['memory'])),
+            node['pods'], round(node['usage'] * 100)))
+
+    for entry in report['storage']:
+        available = 'no quota' if entry['available'] is None else \
+            "%s left on quota" % _gibibytes(entry['available'])
+        stream.write("\nStorage class %s: %s requested, %s\n" %
+                     (entry['storageClass'], _gibibytes(entry['requested']), available))
+
+    stream.write("\n")
+
+    for pod in report['unplaced']:
+        stream.write("Cannot be placed: %s\n" % pod)
+
+    if report['bottleneck']:
+        bottleneck = [node for node in report['nodes']
+                      if node['name'] == report['bottleneck']][0]
+        stream.write("Bottleneck: %s, %d%% of its %s\n" % (
+            bottleneck['name'], round(bottleneck['usage'] * 100), bottleneck['bottleneck']))
+
+    stream.write("The platform %s\n" % ('fits' if report['fits'] else 'does not fit'))
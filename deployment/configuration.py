@@ -1,7 +1,11 @@
 import ipaddress
 import logging
+import re
 import yaml
 
+from .manifests import load_yaml
+from .profiles import PROFILES
+from .quantities import parse_cpu, parse_memory
 
 logger = logging.getLogger("Configuration")
 
@@ -13,6 +17,124 @@ DEFAULT_EXTERNAL_PORTS = {
     'coapPort': 5684
 }
 
+# Seconds to wait for the workloads of a component to become ready
+DEFAULT_READINESS_TIMEOUT = 300
+
+# Deployments of the stateless dojot services, which take a number of
+# replicas or autoscaling settings on the services section
+STATELESS_SERVICES = ('device-manager', 'data-broker', 'history', 'persister', 'flowbroker',
+                      'iotagent-mqtt', 'auth', 'kong', 'gui', 'image-manager', 'alarm-manager')
+
+# Services that use redis, each one with a redis of its own unless the
+# shared redis tier is deployed and the service does not opt out of it
+REDIS_CLIENTS = ('auth', 'data-broker', 'iotagent-mqtt')
+
+# Settings of the MQTT IoT agent accepted on services.iotagent-mqtt, used
+# once it runs more than one replica
+MQTT_IOTAGENT_DEFAULTS = {
+    'sessionAffinity': True,
+    'sessionAffinityTimeout': 10800,
+    'maxUnavailable': 1
+}
+
+# Longest client IP affinity accepted by the API server, in seconds
+MAX_SESSION_AFFINITY_TIMEOUT = 86400
+
+# Shared redis tier settings accepted on services.redis
+REDIS_DEFAULTS = {
+    'replicas': 3,
+    'proxyReplicas': 2,
+    'maxmemory': None,
+    'maxmemoryPolicy': 'volatile-lru',
+    'persistence': 'rdb',
+    'ioThreads': 1,
+    'storageSize': '1Gi',
+    'updatePartition': 0
+}
+
+REDIS_EVICTION_POLICIES = ('noeviction', 'allkeys-lru', 'allkeys-lfu', 'allkeys-random',
+                           'volatile-lru', 'volatile-lfu', 'volatile-random', 'volatile-ttl')
+
+REDIS_PERSISTENCE_MODES = ('none', 'rdb', 'aof')
+
+# RabbitMQ cluster settings accepted on services.rabbitmq
+RABBITMQ_DEFAULTS = {
+    'replicas': 1,
+    'memoryHighWatermark': 0.4,
+    'queuePolicy': 'quorum',
+    'storageSize': '1Gi',
+    'updatePartition': 0
+}
+
+RABBITMQ_QUEUE_POLICIES = ('quorum', 'mirrored', 'none')
+
+# Kubernetes client settings accepted on the kubeClient section, with the
+# smallest value allowed for each one
+CLIENT_SETTINGS = {
+    'poolSize': 1,
+    'connectTimeout': 0,
+    'readTimeout': 0,
+    'keepAlive': 0,
+    'qps': 0,
+    'burst': 1,
+    'maxRetries': 0
+}
+
+# Settings that only take whole numbers
+CLIENT_INTEGER_SETTINGS = ('poolSize', 'burst', 'maxRetries')
+
+MONGODB_TOPOLOGIES = ('replicaSet', 'sharded')
+
+# Sharded cluster settings accepted on services.mongodb, with their defaults
+MONGODB_SHARDING_DEFAULTS = {
+    'shards': 2,
+    'configServers': 3,
+    'routers': 2,
+    'shardedDatabases': ['device_history'],
+    'shardKey': '_id',
+    'readPreference': 'secondaryPreferred'
+}
+
+MONGODB_READ_PREFERENCES = ('primary', 'primaryPreferred', 'secondary', 'secondaryPreferred',
+                            'nearest')
+
+# Kafka broker settings accepted on services.kafka, with the smallest value
+# allowed for each one. Retention bytes take -1 for no size limit
+KAFKA_SETTINGS = {
+    'partitions': 1,
+    'replicationFactor': 1,
+    'minInSyncReplicas': 1,
+    'networkThreads': 1,
+    'ioThreads': 1,
+    'logSegmentBytes': 1048576,
+    'logRetentionHours': 1,
+    'logRetentionBytes': -1
+}
+
+# Postgres parameters accepted on services.postgres.parameters, memory sizes
+# taking the postgres units, as in '512MB'
+POSTGRES_MEMORY_PARAMETERS = ('sharedBuffers', 'workMem', 'effectiveCacheSize')
+POSTGRES_MEMORY_PATTERN = re.compile(r'^[0-9]+(kB|MB|GB|TB)$')
+
+POSTGRES_POOL_MODES = ('session', 'transaction', 'statement')
+
+# Connections of a postgres server when max_connections is not set
+POSTGRES_DEFAULT_CONNECTIONS = 100
+
+# PgBouncer settings accepted on services.postgres.pgbouncer
+PGBOUNCER_DEFAULTS = {
+    'replicas': 1,
+    'poolMode': 'transaction',
+    'poolSize': 20,
+    'maxClientConnections': 1000
+}
+
+# Resources that may be set on the container overrides, with their parsers
+CONTAINER_RESOURCES = {
+    'cpu': parse_cpu,
+    'memory': parse_memory
+}
+
 
 class ConfigData:
 
@@ -27,7 +149,7 @@ class ConfigData:
 
         with open(config_file, "r") as f:
             try:
-                self.config_data = yaml.load(f)
+                self.config_data = load_yaml(f)
             except yaml.YAMLError as exc:
                 logger.error(exc)
 
@@ -126,6 +248,120 @@ class ConfigData:
 
             self._check_services_configuration(services_data)
 
+            self._check_scaling_configuration(services_data)
+
+            self._check_mqtt_iotagent_configuration(services_data)
+
+            self._check_redis_configuration(services_data)
+
+            self._check_rabbitmq_configuration(services_data)
+
+        self._check_resources_configuration()
+
+        self._check_readiness_configuration()
+
+        self._check_client_configuration()
+
+    def _check_resources_configuration(self):
+
+        profile = self.config_data.get('profile', None)
+
+        if profile is not None and profile not in PROFILES:
+            logger.error("Invalid profile '%s', profiles supported: %s" %
+                         (profile, ", ".join(sorted(PROFILES))))
+            exit(1)
+
+        # Container resources by container name, on top of the profile ones
+        overrides = self.config_data.get('resources') or {}
+
+        if not isinstance(overrides, dict):
+            logger.error("resources must map container names to their requests and limits")
+            exit(1)
+
+        for container, resources in overrides.items():
+
+            if not isinstance(resources, dict) or \
+                    not set(resources).issubset(('requests', 'limits')):
+                logger.error("Invalid %s resources, fields supported: requests and limits" %
+                             container)
+                exit(1)
+
+            values = {}
+
+            for field, quantities in resources.items():
+
+                if not isinstance(quantities, dict) or \
+                        not set(quantities).issubset(CONTAINER_RESOURCES):
+                    logger.error("Invalid %s resource %s, fields supported: cpu and memory" %
+                                 (container, field))
+                    exit(1)
+
+                for resource, quantity in quantities.items():
+                    try:
+                        values[(field, resource)] = CONTAINER_RESOURCES[resource](quantity)
+                    except ValueError:
+                        logger.error("Invalid %s %s %s '%s'" %
+                                     (container, resource, field, quantity))
+                        exit(1)
+
+                    # Kubernetes takes the quantities as strings
+                    quantities[resource] = str(quantity)
+
+            for resource in CONTAINER_RESOURCES:
+                request = values.get(('requests', resource))
+                limit = values.get(('limits', resource))
+
+                if request is not None and limit is not None and request > limit:
+                    logger.error("The %s %s request is higher than its limit" %
+                                 (container, resource))
+                    exit(1)
+
+        self.config_data['profile'] = profile
+        self.config_data['resources'] = overrides
+
+    def _check_readiness_configuration(self):
+
+        # Timeouts by component name, with a default for the other components
+        timeouts = self.config_data.get('readinessTimeouts') or {}
+
+        if not isinstance(timeouts, dict):
+            logger.error("readinessTimeouts must map component names to timeouts in seconds")
+            exit(1)
+
+        timeouts.setdefault('default', DEFAULT_READINESS_TIMEOUT)
+
+        for component, timeout in timeouts.items():
+            if not isinstance(timeout, (int, float)) or timeout <= 0:
+                logger.error("Invalid readiness timeout '%s' for %s" % (timeout, component))
+                exit(1)
+
+        self.config_data['readinessTimeouts'] = timeouts
+
+    def _check_client_configuration(self):
+
+        client_data = self.config_data.get('kubeClient') or {}
+
+        if not isinstance(client_data, dict):
+            logger.error("kubeClient must map client settings to their values")
+            exit(1)
+
+        for setting, value in client_data.items():
+            if setting not in CLIENT_SETTINGS:
+                logger.error("Unknown kubeClient setting '%s', settings supported: %s" %
+                             (setting, ", ".join(sorted(CLIENT_SETTINGS))))
+                exit(1)
+
+            if setting in CLIENT_INTEGER_SETTINGS:
+                valid_type = isinstance(value, int)
+            else:
+                valid_type = isinstance(value, (int, float))
+
+            if not valid_type or isinstance(value, bool) or value < CLIENT_SETTINGS[setting]:
+                logger.error("Invalid kubeClient %s '%s'" % (setting, value))
+                exit(1)
+
+        self.config_data['kubeClient'] = client_data
+
     def _check_services_configuration(self, services_data):
 
         zk_data = services_data.get('zookeeper', {})
@@ -138,7 +374,10 @@ class ConfigData:
             logger.error("Invalid ZK cluster size %d" % zk_size)
             exit(1)
 
-        services_data['zookeeper'] = {'clusterSize': zk_size}
+        services_data['zookeeper'] = {
+            'clusterSize': zk_size,
+            'updatePartition': self._check_update_partition('Zookeeper', zk_data, zk_size)
+        }
 
         pg_data = services_data.get('postgres', {})
 
@@ -148,7 +387,12 @@ class ConfigData:
             logger.error("Invalid Postgres cluster size %d" % pg_size)
             exit(1)
 
-        services_data['postgres'] = {'clusterSize': pg_size}
+        services_data['postgres'] = {
+            'clusterSize': pg_size,
+            'updatePartition': self._check_update_partition('Postgres', pg_data, pg_size)
+        }
+
+        services_data['postgres'].update(self._check_postgres_settings(pg_data))
 
         mongodb_data = services_data.get('mongodb', {})
 
@@ -158,7 +402,13 @@ class ConfigData:
             logger.error("Invalid MongoDB number of replicas %d" % mongodb_replicas)
             exit(1)
 
-        services_data['mongodb'] = {'replicas': mongodb_replicas}
+        services_data['mongodb'] = {
+            'replicas': mongodb_replicas,
+            'updatePartition': self._check_update_partition('MongoDB', mongodb_data,
+                                                            mongodb_replicas)
+        }
+
+        services_data['mongodb'].update(self._check_mongodb_topology(mongodb_data))
 
         kafka_data = services_data.get('kafka', {})
 
@@ -168,7 +418,12 @@ class ConfigData:
             logger.error("Invalid Kafka cluster size %d" % kafka_size)
             exit(1)
 
-        services_data['kafka'] = {'clusterSize': kafka_size}
+        services_data['kafka'] = {
+            'clusterSize': kafka_size,
+            'updatePartition': self._check_update_partition('Kafka', kafka_data, kafka_size)
+        }
+
+        services_data['kafka'].update(self._check_kafka_settings(kafka_data, kafka_size))
 
         auth_data = services_data.get('auth', {})
 
@@ -184,6 +439,375 @@ class ConfigData:
                 logger.warning("Auth Email parameters are missing, "
                                "the service will be run with a temporary password.")
 
+    def _check_mongodb_topology(self, mongodb_data):
+
+        topology = mongodb_data.get('topology', 'replicaSet')
+
+        if topology not in MONGODB_TOPOLOGIES:
+            logger.error("Invalid MongoDB topology '%s', values supported: %s" %
+                         (topology, ", ".join(MONGODB_TOPOLOGIES)))
+            exit(1)
+
+        settings = {'topology': topology}
+
+        if topology != 'sharded':
+            return settings
+
+        for setting, default in MONGODB_SHARDING_DEFAULTS.items():
+            settings[setting] = mongodb_data.get(setting, default)
+
+        for setting in ('shards', 'configServers', 'routers'):
+            value = settings[setting]
+
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                logger.error("Invalid MongoDB %s '%s'" % (setting, value))
+                exit(1)
+
+        databases = settings['shardedDatabases']
+
+        if not isinstance(databases, list) or \
+                not all(isinstance(name, str) and name for name in databases):
+            logger.error("MongoDB shardedDatabases must be a list of database names")
+            exit(1)
+
+        if not isinstance(settings['shardKey'], str) or not settings['shardKey']:
+            logger.error("Invalid MongoDB shardKey '%s'" % settings['shardKey'])
+            exit(1)
+
+        if settings['readPreference'] not in MONGODB_READ_PREFERENCES:
+            logger.error("Invalid MongoDB readPreference '%s', values supported: %s" %
+                         (settings['readPreference'], ", ".join(MONGODB_READ_PREFERENCES)))
+            exit(1)
+
+        return settings
+
+    def _check_postgres_settings(self, pg_data):
+
+        settings = {}
+
+        parameters = pg_data.get('parameters') or {}
+
+        if not isinstance(parameters, dict):
+            logger.error("Postgres parameters must map parameter names to their values")
+            exit(1)
+
+        for parameter, value in parameters.items():
+
+            if parameter in POSTGRES_MEMORY_PARAMETERS:
+                valid = POSTGRES_MEMORY_PATTERN.match(str(value))
+            elif parameter == 'maxConnections':
+                valid = isinstance(value, int) and not isinstance(value, bool) and value > 0
+            else:
+                logger.error("Unknown Postgres parameter '%s', parameters supported: %s" %
+                             (parameter, ", ".join(POSTGRES_MEMORY_PARAMETERS +
+                                                   ('maxConnections',))))
+                exit(1)
+
+            if not valid:
+                logger.error("Invalid Postgres %s '%s'" % (parameter, value))
+                exit(1)
+
+        if parameters:
+            settings['parameters'] = parameters
+
+        pgbouncer = pg_data.get('pgbouncer', None)
+
+        if pgbouncer is None or pgbouncer is False:
+            return settings
+
+        if pgbouncer is True:
+            pgbouncer = {}
+
+        if not isinstance(pgbouncer, dict) or not set(pgbouncer).issubset(PGBOUNCER_DEFAULTS):
+            logger.error("Invalid PgBouncer settings, fields supported: %s" %
+                         ", ".join(sorted(PGBOUNCER_DEFAULTS)))
+            exit(1)
+
+        for setting, default in PGBOUNCER_DEFAULTS.items():
+            pgbouncer.setdefault(setting, default)
+
+        if pgbouncer['poolMode'] not in POSTGRES_POOL_MODES:
+            logger.error("Invalid PgBouncer poolMode '%s', values supported: %s" %
+                         (pgbouncer['poolMode'], ", ".join(POSTGRES_POOL_MODES)))
+            exit(1)
+
+        for setting in ('replicas', 'poolSize', 'maxClientConnections'):
+            value = pgbouncer[setting]
+
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                logger.error("Invalid PgBouncer %s '%s'" % (setting, value))
+                exit(1)
+
+        # Each PgBouncer replica opens up to poolSize connections to the master
+        max_connections = parameters.get('maxConnections', POSTGRES_DEFAULT_CONNECTIONS)
+
+        if pgbouncer['replicas'] * pgbouncer['poolSize'] > max_connections:
+            logger.warning("PgBouncer may open %d connections, more than the %d of Postgres" %
+                           (pgbouncer['replicas'] * pgbouncer['poolSize'], max_connections))
+
+        settings['pgbouncer'] = pgbouncer
+
+        return settings
+
+    def _check_kafka_settings(self, kafka_data, kafka_size):
+
+        settings = {}
+
+        for setting, minimum in KAFKA_SETTINGS.items():
+            value = kafka_data.get(setting, None)
+
+            if value is None:
+                continue
+
+            if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+                logger.error("Invalid Kafka %s '%s'" % (setting, value))
+                exit(1)
+
+            settings[setting] = value
+
+        replication = settings.get('replicationFactor', 1)
+
+        if replication > kafka_size:
+            logger.error("Kafka replicationFactor %d is higher than its cluster size %d" %
+                         (replication, kafka_size))
+            exit(1)
+
+        if settings.get('minInSyncReplicas', 1) > replication:
+            logger.error("Kafka minInSyncReplicas %d is higher than its replicationFactor %d" %
+                         (settings['minInSyncReplicas'], replication))
+            exit(1)
+
+        storage_size = kafka_data.get('storageSize', None)
+
+        if storage_size is not None:
+            try:
+                parse_memory(storage_size)
+            except ValueError:
+                logger.error("Invalid Kafka storageSize '%s'" % storage_size)
+                exit(1)
+
+            settings['storageSize'] = str(storage_size)
+
+        return settings
+
+    def _check_scaling_configuration(self, services_data):
+
+        for service in STATELESS_SERVICES:
+            service_data = services_data.get(service) or {}
+
+            replicas = service_data.get('replicas', None)
+
+            if replicas is not None and (not isinstance(replicas, int) or
+                                         isinstance(replicas, bool) or replicas < 1):
+                logger.error("Invalid %s number of replicas %s" % (service, replicas))
+                exit(1)
+
+            autoscaling = service_data.get('autoscaling', None)
+
+            if autoscaling is not None:
+                service_data['autoscaling'] = self._check_autoscaling(service, autoscaling,
+                                                                      replicas or 1)
+
+            if service_data:
+                services_data[service] = service_data
+
+    def _check_mqtt_iotagent_configuration(self, services_data):
+
+        mqtt_data = services_data.get('iotagent-mqtt') or {}
+
+        for setting, default in MQTT_IOTAGENT_DEFAULTS.items():
+            mqtt_data.setdefault(setting, default)
+
+        if not isinstance(mqtt_data['sessionAffinity'], bool):
+            logger.error("Invalid iotagent-mqtt sessionAffinity '%s'" %
+                         mqtt_data['sessionAffinity'])
+            exit(1)
+
+        timeout = mqtt_data['sessionAffinityTimeout']
+
+        if not isinstance(timeout, int) or isinstance(timeout, bool) or \
+                not 0 < timeout <= MAX_SESSION_AFFINITY_TIMEOUT:
+            logger.error("Invalid iotagent-mqtt sessionAffinityTimeout '%s', it must be between"
+                         " 1 and %d seconds" % (timeout, MAX_SESSION_AFFINITY_TIMEOUT))
+            exit(1)
+
+        max_unavailable = mqtt_data['maxUnavailable']
+
+        if not isinstance(max_unavailable, int) or isinstance(max_unavailable, bool) or \
+                max_unavailable < 1:
+            logger.error("Invalid iotagent-mqtt maxUnavailable '%s'" % max_unavailable)
+            exit(1)
+
+        services_data['iotagent-mqtt'] = mqtt_data
+
+    def _check_redis_configuration(self, services_data):
+
+        if 'redis' in services_data:
+            redis_data = services_data['redis'] or {}
+
+            if not isinstance(redis_data, dict) or not set(redis_data).issubset(REDIS_DEFAULTS):
+                logger.error("Invalid Redis settings, fields supported: %s" %
+                             ", ".join(sorted(REDIS_DEFAULTS)))
+                exit(1)
+
+            for setting, default in REDIS_DEFAULTS.items():
+                redis_data.setdefault(setting, default)
+
+            for setting in ('replicas', 'proxyReplicas', 'ioThreads'):
+                value = redis_data[setting]
+
+                if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                    logger.error("Invalid Redis %s '%s'" % (setting, value))
+                    exit(1)
+
+            if redis_data['maxmemoryPolicy'] not in REDIS_EVICTION_POLICIES:
+                logger.error("Invalid Redis maxmemoryPolicy '%s', values supported: %s" %
+                             (redis_data['maxmemoryPolicy'], ", ".join(REDIS_EVICTION_POLICIES)))
+                exit(1)
+
+            if redis_data['persistence'] not in REDIS_PERSISTENCE_MODES:
+                logger.error("Invalid Redis persistence '%s', values supported: %s" %
+                             (redis_data['persistence'], ", ".join(REDIS_PERSISTENCE_MODES)))
+                exit(1)
+
+            for setting in ('maxmemory', 'storageSize'):
+                if redis_data[setting] is None:
+                    continue
+
+                try:
+                    parse_memory(redis_data[setting])
+                except ValueError:
+                    logger.error("Invalid Redis %s '%s'" % (setting, redis_data[setting]))
+                    exit(1)
+
+                redis_data[setting] = str(redis_data[setting])
+
+            redis_data['updatePartition'] = self._check_update_partition(
+                'Redis', redis_data, redis_data['replicas'])
+
+            if redis_data['replicas'] < 3:
+                logger.warning("The shared Redis tier has less than 3 nodes, its sentinels"
+                               " cannot fail over")
+
+            services_data['redis'] = redis_data
+
+        # Services may keep a redis of their own instead of the shared one
+        for service in REDIS_CLIENTS:
+            service_data = services_data.get(service) or {}
+            shared = service_data.get('sharedRedis', True)
+
+            if not isinstance(shared, bool):
+                logger.error("Invalid %s sharedRedis '%s'" % (service, shared))
+                exit(1)
+
+    def _check_rabbitmq_configuration(self, services_data):
+
+        rabbitmq_data = services_data.get('rabbitmq') or {}
+
+        if not isinstance(rabbitmq_data, dict) or \
+                not set(rabbitmq_data).issubset(RABBITMQ_DEFAULTS):
+            logger.error("Invalid RabbitMQ settings, fields supported: %s" %
+                         ", ".join(sorted(RABBITMQ_DEFAULTS)))
+            exit(1)
+
+        for setting, default in RABBITMQ_DEFAULTS.items():
+            rabbitmq_data.setdefault(setting, default)
+
+        replicas = rabbitmq_data['replicas']
+
+        if not isinstance(replicas, int) or isinstance(replicas, bool) or replicas < 1:
+            logger.error("Invalid RabbitMQ number of replicas %s" % replicas)
+            exit(1)
+
+        watermark = rabbitmq_data['memoryHighWatermark']
+
+        if not isinstance(watermark, (int, float)) or isinstance(watermark, bool) or \
+                not 0 < watermark <= 1:
+            logger.error("Invalid RabbitMQ memoryHighWatermark '%s', it is a fraction of the"
+                         " memory between 0 and 1" % watermark)
+            exit(1)
+
+        if rabbitmq_data['queuePolicy'] not in RABBITMQ_QUEUE_POLICIES:
+            logger.error("Invalid RabbitMQ queuePolicy '%s', values supported: %s" %
+                         (rabbitmq_data['queuePolicy'], ", ".join(RABBITMQ_QUEUE_POLICIES)))
+            exit(1)
+
+        try:
+            parse_memory(rabbitmq_data['storageSize'])
+        except ValueError:
+            logger.error("Invalid RabbitMQ storageSize '%s'" % rabbitmq_data['storageSize'])
+            exit(1)
+
+        rabbitmq_data['storageSize'] = str(rabbitmq_data['storageSize'])
+        rabbitmq_data['updatePartition'] = self._check_update_partition('RabbitMQ', rabbitmq_data,
+                                                                        replicas)
+
+        if replicas == 2:
+            logger.warning("A RabbitMQ cluster of 2 nodes cannot tell which one is on the"
+                           " minority side of a partition, use 1 or at least 3 nodes")
+
+        services_data['rabbitmq'] = rabbitmq_data
+
+    def _check_autoscaling(self, service, autoscaling, replicas):
+
+        if not isinstance(autoscaling, dict):
+            logger.error("Invalid %s autoscaling settings" % service)
+            exit(1)
+
+        min_replicas = autoscaling.get('minReplicas', replicas)
+        max_replicas = autoscaling.get('maxReplicas', None)
+
+        if not isinstance(min_replicas, int) or isinstance(min_replicas, bool) or \
+                min_replicas < 1:
+            logger.error("Invalid %s autoscaling minReplicas %s" % (service, min_replicas))
+            exit(1)
+
+        if not isinstance(max_replicas, int) or isinstance(max_replicas, bool) or \
+                max_replicas < min_replicas:
+            logger.error("Invalid %s autoscaling maxReplicas %s, it must be set and not lower"
+                         " than minReplicas" % (service, max_replicas))
+            exit(1)
+
+        cpu_utilization = autoscaling.get('cpuUtilization', None)
+        metric = autoscaling.get('metric', None)
+
+        if cpu_utilization is None and metric is None:
+            logger.error("Missing %s autoscaling target, fields supported:"
+                         " cpuUtilization and metric" % service)
+            exit(1)
+
+        if cpu_utilization is not None and \
+                (not isinstance(cpu_utilization, int) or isinstance(cpu_utilization, bool) or
+                 cpu_utilization < 1):
+            logger.error("Invalid %s autoscaling cpuUtilization %s" % (service, cpu_utilization))
+            exit(1)
+
+        if metric is not None and \
+                (not isinstance(metric, dict) or not metric.get('name') or
+                 metric.get('targetAverageValue') is None):
+            logger.error("Invalid %s autoscaling metric, fields required:"
+                         " name and targetAverageValue" % service)
+            exit(1)
+
+        autoscaling['minReplicas'] = min_replicas
+
+        return autoscaling
+
+    def _check_update_partition(self, service, service_data, replicas):
+
+        # Pods with a lower ordinal keep their current version on rolling updates
+        partition = service_data.get('updatePartition', 0)
+
+        if not isinstance(partition, int) or isinstance(partition, bool) or partition < 0:
+            logger.error("Invalid %s update partition %s" % (service, partition))
+            exit(1)
+
+        if partition and partition >= replicas:
+            logger.warning("The %s update partition %d is not lower than its %d replicas, no pod"
+                           " is rolled out on updates" % (service, partition, replicas))
+
+        return partition
+
     def get_config_data(self, param=None):
 
         if param:
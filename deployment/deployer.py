@@ -1,52 +1,179 @@
 import logging
 import base64
-import yaml
+import copy
+import hashlib
+import json
 
-from .kube import KubeClient
+from collections import OrderedDict
+from functools import partial
+
+from .async_kube import AsyncKubeClient
+from .manifests import ManifestRepository
+from .resources import ObjectCollector, set_env
+from .configuration import STATELESS_SERVICES
+from .profiles import redis_maxmemory, size_pod
+from .quantities import parse_memory
+from .scheduler import DependencyScheduler, SchedulerError
 
 logger = logging.getLogger("Deployer")
 
+# Dojot components in their serial deployment order, each one with the
+# components whose services it uses and that must be deployed before it
+COMPONENT_DEPENDENCIES = OrderedDict([
+    ('zookeeper', []),
+    ('postgres', ['zookeeper']),
+    ('mongodb', []),
+    ('kafka', ['zookeeper']),
+    ('rabbitmq', []),
+    ('minio', []),
+    ('redis', []),
+    ('apigw', ['postgres']),
+    ('auth', ['postgres', 'kafka', 'apigw', 'redis']),
+    ('mutual_auth', ['kafka']),
+    ('ejbca', ['kafka']),
+    ('device_manager', ['postgres', 'kafka']),
+    ('data_broker', ['zookeeper', 'kafka', 'redis']),
+    ('history', ['mongodb', 'kafka']),
+    ('alarm_manager', ['rabbitmq']),
+    ('image_manager', ['postgres', 'minio']),
+    ('mqtt_iotagent', ['kafka', 'redis']),
+    ('flowbroker', ['mongodb', 'kafka', 'rabbitmq']),
+    ('gui', []),
+])
+
+# Steps that configure the cluster for dojot, run before the components. A
+# selective deploy only runs them when they are named
+CLUSTER_STEPS = ('storage', 'external-access')
+
+
+def _step_name(name):
+    # Components are also accepted with dashes, as named on the rendered files
+
+    if name.replace('_', '-') in CLUSTER_STEPS:
+        return name.replace('_', '-')
+
+    if name.replace('-', '_') in COMPONENT_DEPENDENCIES:
+        return name.replace('-', '_')
+
+    known = CLUSTER_STEPS + tuple(component.replace('_', '-')
+                                  for component in COMPONENT_DEPENDENCIES)
+
+    raise ValueError("Unknown component '%s', the components are: %s" %
+                     (name, ", ".join(known)))
+
+
+def select_steps(only=None, skip=None, with_deps=False):
+    # Cluster steps and components to deploy, in deploy order. With only the
+    # named ones are deployed, with the components they depend on, directly
+    # or not, when with_deps is set. Skipped ones are never deployed
+
+    if only:
+        selected = set(_step_name(name) for name in only)
+    else:
+        selected = set(CLUSTER_STEPS) | set(COMPONENT_DEPENDENCIES)
+
+    if with_deps:
+        pending = [name for name in selected if name in COMPONENT_DEPENDENCIES]
+
+        while pending:
+            for dependency in COMPONENT_DEPENDENCIES[pending.pop()]:
+                if dependency not in selected:
+                    selected.add(dependency)
+                    pending.append(dependency)
+
+    selected -= set(_step_name(name) for name in skip or [])
+
+    return [name for name in CLUSTER_STEPS + tuple(COMPONENT_DEPENDENCIES) if name in selected]
+
+
+# Environment variables of the kafka broker settings, each one turned into
+# the matching server.properties entry by the broker image
+KAFKA_BROKER_ENV = OrderedDict([
+    ('partitions', 'KAFKA_NUM_PARTITIONS'),
+    ('replicationFactor', 'KAFKA_DEFAULT_REPLICATION_FACTOR'),
+    ('minInSyncReplicas', 'KAFKA_MIN_INSYNC_REPLICAS'),
+    ('networkThreads', 'KAFKA_NUM_NETWORK_THREADS'),
+    ('ioThreads', 'KAFKA_NUM_IO_THREADS'),
+    ('logSegmentBytes', 'KAFKA_LOG_SEGMENT_BYTES'),
+    ('logRetentionHours', 'KAFKA_LOG_RETENTION_HOURS'),
+    ('logRetentionBytes', 'KAFKA_LOG_RETENTION_BYTES'),
+])
+
+# Postgres parameters of services.postgres.parameters, by setting name
+POSTGRES_PARAMETERS = OrderedDict([
+    ('sharedBuffers', 'shared_buffers'),
+    ('workMem', 'work_mem'),
+    ('maxConnections', 'max_connections'),
+    ('effectiveCacheSize', 'effective_cache_size'),
+])
+
+# Variable with the database host of each postgres client deployment, which
+# points to PgBouncer when it is deployed. Migrations keep a direct connection
+POSTGRES_CLIENTS = {
+    'kong': 'KONG_PG_HOST',
+    'auth': 'AUTH_DB_HOST',
+    'device-manager': 'DBHOST',
+    'image-manager': 'DBHOST'
+}
+# Deployments connecting to mongodb, through the routers on a sharded cluster
+MONGODB_CLIENTS = ('history', 'persister', 'flowbroker')
+
+# Annotation of the pod templates with the hash of the configuration they
+# mount, which rolls the pods out when the configuration changes
+CONFIG_HASH_ANNOTATION = 'deployer.dojot.com.br/config-hash'
+
+# Snapshots of the shared redis tier, by persistence mode
+REDIS_PERSISTENCE = {
+    'none': ['save ""', 'appendonly no'],
+    'rdb': ['save 900 1', 'save 300 10', 'save 60 10000', 'appendonly no'],
+    'aof': ['save ""', 'appendonly yes', 'appendfsync everysec']
+}
+
 
 class KubeDeployer:
 
-    def __init__(self, conf):
+    def __init__(self, conf, kube_client=None, manifests=None):
         self.config = conf
-        self.kube_client = KubeClient()
+
+        if kube_client is None:
+            # Only imported when needed, rendering works without the kubernetes client
+            from .kube import KubeClient
+            kube_client = KubeClient()
+
+        self.kube_client = kube_client
+        self.manifests = manifests or ManifestRepository()
 
     def deploy_rbd(self, namespace):
 
-        with open('manifests/STORAGE/CEPH/rbd-provisioner.yaml',
-                  'r') as rbd_model:
-
-            for rbd_data in yaml.load_all(rbd_model):
-
-                if rbd_data["kind"] == "Deployment":
-                    spec = rbd_data["spec"]
-                    name = rbd_data["metadata"]["name"]
-                    rbd_namespace = rbd_data["metadata"]["namespace"]
-                    self.kube_client.create_deployment(name, rbd_namespace, spec)
-                elif rbd_data["kind"] == "ServiceAccount":
-                    name = rbd_data["metadata"]["name"]
-                    sa_namespace = rbd_data["metadata"]["namespace"]
-                    if sa_namespace != 'kube-system':
-                        sa_namespace = namespace
-                    self.kube_client.create_service_account(name, sa_namespace)
-                elif rbd_data["kind"] == "ClusterRole":
-                    name = rbd_data["metadata"]["name"]
-                    rules = rbd_data["rules"]
-                    self.kube_client.create_cluster_role(name, rules)
-                elif rbd_data["kind"] == "ClusterRoleBinding":
-                    name = rbd_data["metadata"]["name"]
-                    subjects = rbd_data["subjects"]
-                    cluster_role = rbd_data["roleRef"]["name"]
-
-                    for subject in subjects:
-                        if subject['namespace'] != 'kube-system':
-                            subject['namespace'] = namespace
-
-                    self.kube_client.create_cluster_role_binding(name, subjects, cluster_role)
-                else:
-                    logger.warning("Found unexpected object on RBD model file!")
+        for rbd_data in self.manifests.load_all('manifests/STORAGE/CEPH/rbd-provisioner.yaml'):
+
+            if rbd_data["kind"] == "Deployment":
+                spec = rbd_data["spec"]
+                name = rbd_data["metadata"]["name"]
+                rbd_namespace = rbd_data["metadata"]["namespace"]
+                self.create_deployment(name, rbd_namespace, spec)
+            elif rbd_data["kind"] == "ServiceAccount":
+                name = rbd_data["metadata"]["name"]
+                sa_namespace = rbd_data["metadata"]["namespace"]
+                if sa_namespace != 'kube-system':
+                    sa_namespace = namespace
+                self.kube_client.create_service_account(name, sa_namespace)
+            elif rbd_data["kind"] == "ClusterRole":
+                name = rbd_data["metadata"]["name"]
+                rules = rbd_data["rules"]
+                self.kube_client.create_cluster_role(name, rules)
+            elif rbd_data["kind"] == "ClusterRoleBinding":
+                name = rbd_data["metadata"]["name"]
+                subjects = rbd_data["subjects"]
+                cluster_role = rbd_data["roleRef"]["name"]
+
+                for subject in subjects:
+                    if subject['namespace'] != 'kube-system':
+                        subject['namespace'] = namespace
+
+                self.kube_client.create_cluster_role_binding(name, subjects, cluster_role)
+            else:
+                logger.warning("Found unexpected object on RBD model file!")
 
     def configure_storage(self, namespace):
         storage = self.config.get_config_data('storage')
@@ -67,21 +194,20 @@ class KubeDeployer:
                                            namespace, {'key': base64.b64encode(
                                                user_key.encode()).decode()})
 
-            with open('manifests/STORAGE/CEPH/dojot-storage-class.yaml', 'r') as st_class:
-                st_data = yaml.load(st_class)
+            st_data = self.manifests.load('manifests/STORAGE/CEPH/dojot-storage-class.yaml')
 
-                name = st_data['metadata']['name']
-                provisioner = st_data['provisioner']
-                parameters = st_data['parameters']
+            name = st_data['metadata']['name']
+            provisioner = st_data['provisioner']
+            parameters = st_data['parameters']
 
-                parameters['monitors'] = \
-                    str(ceph_monitors).strip("[]").replace("'", "").replace(" ", "")
-                parameters['userId'] = user_id
-                parameters['adminId'] = admin_id
-                parameters['pool'] = user_pool
+            parameters['monitors'] = \
+                str(ceph_monitors).strip("[]").replace("'", "").replace(" ", "")
+            parameters['userId'] = user_id
+            parameters['adminId'] = admin_id
+            parameters['pool'] = user_pool
 
-                self.kube_client.create_storage_class(name, {'provisioner': provisioner,
-                                                             'parameters': parameters})
+            self.kube_client.create_storage_class(name, {'provisioner': provisioner,
+                                                         'parameters': parameters})
 
             self.deploy_rbd(namespace)
 
@@ -89,16 +215,15 @@ class KubeDeployer:
 
             gcp_storage_type = storage['gcpStorageType']
 
-            with open('manifests/STORAGE/GCP/dojot-storage-class.yaml', 'r') as st_class:
-                st_data = yaml.load(st_class)
+            st_data = self.manifests.load('manifests/STORAGE/GCP/dojot-storage-class.yaml')
 
-                name = st_data['metadata']['name']
-                provisioner = st_data['provisioner']
-                parameters = st_data['parameters']
+            name = st_data['metadata']['name']
+            provisioner = st_data['provisioner']
+            parameters = st_data['parameters']
 
-                parameters['type'] = gcp_storage_type
-                self.kube_client.create_storage_class(name, {'provisioner': provisioner,
-                                                             'parameters': parameters})
+            parameters['type'] = gcp_storage_type
+            self.kube_client.create_storage_class(name, {'provisioner': provisioner,
+                                                         'parameters': parameters})
 
     def configure_external_access(self, namespace):
         external = self.config.get_config_data('externalAccess')
@@ -108,411 +233,913 @@ class KubeDeployer:
         if external['type'] == 'publicIP':
             ips_list = external['ips']
 
-            with open('manifests/EXTERNAL_ACCESS/public-ip.yaml', 'r') as external_file:
-                for service_doc in yaml.load_all(external_file):
-                    service_name = service_doc['metadata']['name']
-                    service_spec = service_doc['spec']
+            for service_doc in self.manifests.load_all('manifests/EXTERNAL_ACCESS/public-ip.yaml'):
+                service_name = service_doc['metadata']['name']
+                service_spec = service_doc['spec']
+
+                service_spec['externalIPs'] = ips_list
+                service_ports = service_spec['ports']
 
-                    service_spec['externalIPs'] = ips_list
-                    service_ports = service_spec['ports']
+                for port in service_ports:
+                    if port['name'] == 'ext-http':
+                        port['port'] = external_ports['httpPort']
+                    elif port['name'] == 'ext-https':
+                        port['port'] = external_ports['httpsPort']
+                    elif port['name'] == 'ext-mqtt':
+                        port['port'] = external_ports['mqttPort']
+                    elif port['name'] == 'ext-coap':
+                        port['port'] = external_ports['coapPort']
 
-                    for port in service_ports:
-                        if port['name'] == 'ext-http':
-                            port['port'] = external_ports['httpPort']
-                        elif port['name'] == 'ext-https':
-                            port['port'] = external_ports['httpsPort']
-                        elif port['name'] == 'ext-mqtt':
-                            port['port'] = external_ports['mqttPort']
-                        elif port['name'] == 'ext-coap':
-                            port['port'] = external_ports['coapPort']
+                if service_name == 'external-mqtt':
+                    self.set_session_affinity(service_spec)
 
-                    self.kube_client.create_service(service_name, namespace, service_spec)
+                self.kube_client.create_service(service_name, namespace, service_spec)
 
         elif external['type'] == 'loadBalancer':
 
-            with open('manifests/EXTERNAL_ACCESS/load-balancer.yaml', 'r') as external_file:
-                for service_doc in yaml.load_all(external_file):
-                    service_name = service_doc['metadata']['name']
-                    service_spec = service_doc['spec']
+            for service_doc in \
+                    self.manifests.load_all('manifests/EXTERNAL_ACCESS/load-balancer.yaml'):
+                service_name = service_doc['metadata']['name']
+                service_spec = service_doc['spec']
+
+                service_ports = service_spec['ports']
+
+                for port in service_ports:
+                    if port['name'] == 'ext-http':
+                        port['port'] = external_ports['httpPort']
+                    elif port['name'] == 'ext-https':
+                        port['port'] = external_ports['httpsPort']
+                    elif port['name'] == 'ext-mqtt':
+                        port['port'] = external_ports['mqttPort']
+                    elif port['name'] == 'ext-coap':
+                        port['port'] = external_ports['coapPort']
+
+                if service_name == 'external-mqtt':
+                    self.set_session_affinity(service_spec)
+
+                self.kube_client.create_service(service_name, namespace, service_spec)
+
+    def size_pods(self, spec):
+        # Resources of the configured profile and overrides on every container
+        size_pod(spec['template']['spec'], self.config.get_config_data('profile'),
+                 self.config.get_config_data('resources'))
+
+    def create_stateful_set(self, name, namespace, spec):
+        self.size_pods(spec)
+        self.kube_client.create_stateful_set(name, namespace, spec)
+
+    def start_job(self, name, namespace, spec):
+        self.size_pods(spec)
+        self.kube_client.start_job(name, namespace, spec)
+
+    def create_deployment(self, name, namespace, spec):
+        # Stateless services take their number of replicas, or an autoscaler
+        # in charge of it, from the services configuration
+
+        self.size_pods(spec)
+
+        self.set_postgres_host(name, spec)
+
+        self.set_mongodb_client(name, spec)
+
+        service_config = {}
+
+        if name in STATELESS_SERVICES:
+            service_config = self.config.get_config_data('services').get(name) or {}
+
+        autoscaling = service_config.get('autoscaling')
+
+        if autoscaling:
+            spec.pop('replicas', None)
+        elif service_config.get('replicas'):
+            spec['replicas'] = service_config['replicas']
+
+        self.kube_client.create_deployment(name, namespace, spec)
+
+        if autoscaling:
+            self.kube_client.create_horizontal_pod_autoscaler(
+                name, namespace, self.autoscaler_spec(name, spec, autoscaling))
+
+    def set_postgres_host(self, name, spec):
+
+        if name not in POSTGRES_CLIENTS or \
+                not self.config.get_config_data('services')['postgres'].get('pgbouncer'):
+            return
+
+        for container in spec['template']['spec']['containers']:
+            if container['name'] == name:
+                set_env(container, POSTGRES_CLIENTS[name], 'pgbouncer')
 
-                    service_ports = service_spec['ports']
+    def set_mongodb_client(self, name, spec):
 
-                    for port in service_ports:
-                        if port['name'] == 'ext-http':
-                            port['port'] = external_ports['httpPort']
-                        elif port['name'] == 'ext-https':
-                            port['port'] = external_ports['httpsPort']
-                        elif port['name'] == 'ext-mqtt':
-                            port['port'] = external_ports['mqttPort']
-                        elif port['name'] == 'ext-coap':
-                            port['port'] = external_ports['coapPort']
+        mongodb_config = self.config.get_config_data('services')['mongodb']
 
-                    self.kube_client.create_service(service_name, namespace, service_spec)
+        if name not in MONGODB_CLIENTS or mongodb_config['topology'] != 'sharded':
+            return
+
+        for container in spec['template']['spec']['containers']:
+            if container['name'] != name:
+                continue
+
+            # Routers are not members of a replica set
+            container['env'] = [env_var for env_var in container.get('env', [])
+                                if env_var['name'] != 'REPLICA_SET']
+
+            if name == 'history':
+                set_env(container, 'READ_PREFERENCE', mongodb_config['readPreference'])
+
+    def autoscaler_spec(self, name, spec, autoscaling):
+
+        metrics = []
+
+        if autoscaling.get('cpuUtilization'):
+            # Utilization is relative to the CPU requested by the containers
+            for container in spec['template']['spec']['containers']:
+                if 'cpu' not in (container.get('resources') or {}).get('requests', {}):
+                    logger.warning("Container %s of %s has no CPU request, its CPU utilization"
+                                   " cannot be measured" % (container['name'], name))
+
+            metrics.append({
+                'type': 'Resource',
+                'resource': {
+                    'name': 'cpu',
+                    'targetAverageUtilization': autoscaling['cpuUtilization']
+                }
+            })
+
+        if autoscaling.get('metric'):
+            metrics.append({
+                'type': 'Pods',
+                'pods': {
+                    'metricName': autoscaling['metric']['name'],
+                    'targetAverageValue': str(autoscaling['metric']['targetAverageValue'])
+                }
+            })
+
+        return {
+            'scaleTargetRef': {
+                'apiVersion': 'extensions/v1beta1',
+                'kind': 'Deployment',
+                'name': name
+            },
+            'minReplicas': autoscaling['minReplicas'],
+            'maxReplicas': autoscaling['maxReplicas'],
+            'metrics': metrics
+        }
+
+    def set_rolling_update(self, spec, config):
+        # Template changes replace the pods one at a time, down to the partition
+        spec['updateStrategy'] = {
+            'type': 'RollingUpdate',
+            'rollingUpdate': {
+                'partition': config['updatePartition']
+            }
+        }
 
     def deploy_zookeeper(self, namespace, config):
 
         zk_size = config['clusterSize']
 
-        with open('manifests/zookeeper.yaml', 'r') as zk_docs:
+        for zk_doc in self.manifests.load_all('manifests/zookeeper.yaml'):
 
-            for zk_doc in yaml.load_all(zk_docs):
+            if zk_doc['kind'] == 'Service':
+                self.kube_client.create_service(zk_doc['metadata']['name'],
+                                                namespace, zk_doc['spec'])
 
-                if zk_doc['kind'] == 'Service':
-                    self.kube_client.create_service(zk_doc['metadata']['name'],
-                                                    namespace, zk_doc['spec'])
+            elif zk_doc['kind'] == 'StatefulSet':
 
-                elif zk_doc['kind'] == 'StatefulSet':
+                zk_spec = zk_doc['spec']
 
-                    zk_spec = zk_doc['spec']
+                zk_spec['replicas'] = zk_size
+                zk_spec['template']['spec']['containers'][0]['command'][-1] = \
+                    "--servers=%d" % zk_size
 
-                    zk_spec['replicas'] = zk_size
-                    zk_spec['template']['spec']['containers'][0]['command'][-1] = \
-                        "--servers=%d" % zk_size
+                self.set_rolling_update(zk_spec, config)
 
-                    self.kube_client.create_stateful_set(zk_doc['metadata']['name'],
-                                                         namespace, zk_spec)
-                else:
-                    logger.error("Invalid document on Zookeeper manifest: %s" % zk_doc['kind'])
+                self.create_stateful_set(zk_doc['metadata']['name'],
+                                         namespace, zk_spec)
+            else:
+                logger.error("Invalid document on Zookeeper manifest: %s" % zk_doc['kind'])
 
     def deploy_postgres(self, namespace, config):
 
         pg_size = config['clusterSize']
 
-        with open('config_scripts/postgres-init.sh', 'r') as config_file:
+        config_data = {
+            "postgres-init.sh": self.manifests.read('config_scripts/postgres-init.sh')
+        }
+
+        self.kube_client.create_config_map('postgres-init', namespace, config_data)
 
-            config_data = {
-                "postgres-init.sh": config_file.read()
-            }
+        for pg_doc in self.manifests.load_all('manifests/postgres.yaml'):
 
-            self.kube_client.create_config_map('postgres-init', namespace, config_data)
+            if pg_doc['kind'] == 'ServiceAccount':
+                self.kube_client.create_service_account(pg_doc['metadata']['name'], namespace)
+            elif pg_doc['kind'] == 'Role':
+                self.kube_client.create_role(pg_doc['metadata']['name'], namespace,
+                                             pg_doc['rules'])
+            elif pg_doc['kind'] == 'RoleBinding':
+                self.kube_client.create_role_binding(pg_doc['metadata']['name'],
+                                                     namespace,
+                                                     pg_doc['subjects'],
+                                                     pg_doc['roleRef']['name'])
+            elif pg_doc['kind'] == 'Service':
+                self.kube_client.create_service(pg_doc['metadata']['name'], namespace,
+                                                pg_doc['spec'])
+            elif pg_doc['kind'] == 'StatefulSet':
 
-        with open('manifests/postgres.yaml', 'r') as pg_docs:
+                pg_spec = pg_doc['spec']
 
-            for pg_doc in yaml.load_all(pg_docs):
+                pg_spec['replicas'] = pg_size
 
-                if pg_doc['kind'] == 'ServiceAccount':
-                    self.kube_client.create_service_account(pg_doc['metadata']['name'], namespace)
-                elif pg_doc['kind'] == 'Role':
-                    self.kube_client.create_role(pg_doc['metadata']['name'], namespace,
-                                                 pg_doc['rules'])
-                elif pg_doc['kind'] == 'RoleBinding':
-                    self.kube_client.create_role_binding(pg_doc['metadata']['name'],
-                                                         namespace,
-                                                         pg_doc['subjects'],
-                                                         pg_doc['roleRef']['name'])
-                elif pg_doc['kind'] == 'Service':
-                    self.kube_client.create_service(pg_doc['metadata']['name'], namespace,
-                                                    pg_doc['spec'])
-                elif pg_doc['kind'] == 'StatefulSet':
+                for env_var in pg_spec['template']['spec']['containers'][0]['env']:
+                    if env_var['name'] == 'POD_NAMESPACE':
+                        env_var['value'] = namespace
 
-                    pg_spec = pg_doc['spec']
+                self.set_rolling_update(pg_spec, config)
 
-                    pg_spec['replicas'] = pg_size
+                if config.get('parameters'):
+                    # Merged by spilo into the Patroni configuration
+                    parameters = OrderedDict(
+                        (POSTGRES_PARAMETERS[setting], str(config['parameters'][setting]))
+                        for setting in POSTGRES_PARAMETERS if setting in config['parameters'])
 
-                    for env_var in pg_spec['template']['spec']['containers'][0]['env']:
-                        if env_var['name'] == 'POD_NAMESPACE':
-                            env_var['value'] = namespace
+                    set_env(pg_spec['template']['spec']['containers'][0], 'SPILO_CONFIGURATION',
+                            json.dumps({'postgresql': {'parameters': parameters}}))
 
-                    # TODO: Get passwoords as secrets
+                # TODO: Get passwoords as secrets
 
-                    self.kube_client.create_stateful_set(pg_doc['metadata']['name'],
-                                                         namespace, pg_spec)
-                elif pg_doc['kind'] == 'Job':
+                self.create_stateful_set(pg_doc['metadata']['name'],
+                                         namespace, pg_spec)
+            elif pg_doc['kind'] == 'Job':
 
-                    # TODO: Passwords as secrets
-                    self.kube_client.start_job(pg_doc['metadata']['name'], namespace,
-                                               pg_doc['spec'])
-                else:
-                    logger.error("Invalid document on Postgres manifest: %s" % pg_doc['kind'])
+                # TODO: Passwords as secrets
+                self.start_job(pg_doc['metadata']['name'], namespace,
+                               pg_doc['spec'])
+            else:
+                logger.error("Invalid document on Postgres manifest: %s" % pg_doc['kind'])
+
+        if config.get('pgbouncer'):
+            self.deploy_pgbouncer(namespace, config['pgbouncer'])
+
+    def deploy_pgbouncer(self, namespace, config):
+
+        for pgbouncer_doc in self.manifests.load_all('manifests/pgbouncer.yaml'):
+            if pgbouncer_doc['kind'] == 'Service':
+                self.kube_client.create_service(pgbouncer_doc['metadata']['name'], namespace,
+                                                pgbouncer_doc['spec'])
+            elif pgbouncer_doc['kind'] == 'Deployment':
+
+                pgbouncer_spec = pgbouncer_doc['spec']
+
+                pgbouncer_spec['replicas'] = config['replicas']
+
+                for env_var in pgbouncer_spec['template']['spec']['containers'][0]['env']:
+                    if env_var['name'] == 'POOL_MODE':
+                        env_var['value'] = config['poolMode']
+                    elif env_var['name'] == 'DEFAULT_POOL_SIZE':
+                        env_var['value'] = str(config['poolSize'])
+                    elif env_var['name'] == 'MAX_CLIENT_CONN':
+                        env_var['value'] = str(config['maxClientConnections'])
+
+                self.create_deployment(pgbouncer_doc['metadata']['name'], namespace,
+                                       pgbouncer_spec)
+            else:
+                logger.error("Invalid document on PgBouncer manifest: %s" % pgbouncer_doc['kind'])
 
     def deploy_mongodb(self, namespace, config):
 
         mongodb_replicas = config['replicas']
+        sharded = config['topology'] == 'sharded'
 
-        with open('manifests/mongodb.yaml', 'r') as mongodb_docs:
+        for mongodb_doc in self.manifests.load_all('manifests/mongodb.yaml'):
 
-            for mongodb_doc in yaml.load_all(mongodb_docs):
+            if mongodb_doc['kind'] == 'ServiceAccount':
+                self.kube_client.create_service_account(
+                    mongodb_doc['metadata']['name'], namespace)
+            elif mongodb_doc['kind'] == 'Role':
+                self.kube_client.create_role(mongodb_doc['metadata']['name'], namespace,
+                                             mongodb_doc['rules'])
+            elif mongodb_doc['kind'] == 'RoleBinding':
+                self.kube_client.create_role_binding(mongodb_doc['metadata']['name'],
+                                                     namespace,
+                                                     mongodb_doc['subjects'],
+                                                     mongodb_doc['roleRef']['name'])
+            elif mongodb_doc['kind'] == 'Service':
 
-                if mongodb_doc['kind'] == 'ServiceAccount':
-                    self.kube_client.create_service_account(
-                        mongodb_doc['metadata']['name'], namespace)
-                elif mongodb_doc['kind'] == 'Role':
-                    self.kube_client.create_role(mongodb_doc['metadata']['name'], namespace,
-                                                 mongodb_doc['rules'])
-                elif mongodb_doc['kind'] == 'RoleBinding':
-                    self.kube_client.create_role_binding(mongodb_doc['metadata']['name'],
-                                                         namespace,
-                                                         mongodb_doc['subjects'],
-                                                         mongodb_doc['roleRef']['name'])
-                elif mongodb_doc['kind'] == 'Service':
-                    self.kube_client.create_service(mongodb_doc['metadata']['name'], namespace,
-                                                    mongodb_doc['spec'])
-                elif mongodb_doc['kind'] == 'StatefulSet':
+                if sharded:
+                    # Clients keep connecting to the mongodb service, now to its routers
+                    mongodb_doc['spec']['selector'] = {'name': 'mongodb-router'}
 
-                    mongodb_spec = mongodb_doc['spec']
+                self.kube_client.create_service(mongodb_doc['metadata']['name'], namespace,
+                                                mongodb_doc['spec'])
+            elif mongodb_doc['kind'] == 'StatefulSet':
 
-                    mongodb_spec['replicas'] = 1 + mongodb_replicas
+                if sharded:
+                    continue
 
-                    for env_var in mongodb_spec['template']['spec']['containers'][1]['env']:
-                        if env_var['name'] == 'KUBE_NAMESPACE':
-                            env_var['value'] = namespace
+                mongodb_spec = mongodb_doc['spec']
 
-                    self.kube_client.create_stateful_set(mongodb_doc['metadata']['name'],
-                                                         namespace, mongodb_spec)
-                else:
-                    logger.error("Invalid document on MongoDB manifest: %s" % mongodb_doc['kind'])
+                mongodb_spec['replicas'] = 1 + mongodb_replicas
+
+                for env_var in mongodb_spec['template']['spec']['containers'][1]['env']:
+                    if env_var['name'] == 'KUBE_NAMESPACE':
+                        env_var['value'] = namespace
+
+                self.set_rolling_update(mongodb_spec, config)
+
+                self.create_stateful_set(mongodb_doc['metadata']['name'],
+                                         namespace, mongodb_spec)
+            else:
+                logger.error("Invalid document on MongoDB manifest: %s" % mongodb_doc['kind'])
+
+        if sharded:
+            self.deploy_mongodb_shards(namespace, config)
+
+    def deploy_mongodb_shards(self, namespace, config):
+        # Config server replica set, a replica set for each shard and the
+        # mongos routers, followed by a job adding the shards to the cluster
+
+        config_hosts = ["mongodb-config-%d.mongodb-config:27017" % ordinal
+                        for ordinal in range(config['configServers'])]
+        shards = []
+
+        for mongodb_doc in self.manifests.load_all('manifests/mongodb-sharded.yaml'):
+            name = mongodb_doc['metadata']['name']
+
+            if mongodb_doc['kind'] == 'Service' and name == 'mongodb-shard':
+                for shard in range(config['shards']):
+                    spec = dict(mongodb_doc['spec'], selector={'name': 'mongodb-shard-%d' % shard})
+                    self.kube_client.create_service('mongodb-shard-%d' % shard, namespace, spec)
+
+            elif mongodb_doc['kind'] == 'Service':
+                self.kube_client.create_service(name, namespace, mongodb_doc['spec'])
+
+            elif mongodb_doc['kind'] == 'StatefulSet' and name == 'mongodb-shard':
+                for shard in range(config['shards']):
+                    shards.append(self.deploy_mongodb_shard(namespace, config, shard,
+                                                            copy.deepcopy(mongodb_doc['spec'])))
+
+            elif mongodb_doc['kind'] == 'StatefulSet':
+
+                config_spec = mongodb_doc['spec']
+
+                config_spec['replicas'] = config['configServers']
+
+                for env_var in config_spec['template']['spec']['containers'][1]['env']:
+                    if env_var['name'] == 'KUBE_NAMESPACE':
+                        env_var['value'] = namespace
+
+                self.set_rolling_update(config_spec, config)
+
+                self.create_stateful_set(name, namespace, config_spec)
+
+            elif mongodb_doc['kind'] == 'Deployment':
+
+                router_spec = mongodb_doc['spec']
+
+                router_spec['replicas'] = config['routers']
+                router_spec['template']['spec']['containers'][0]['command'][-1] = \
+                    'cfgrs/' + ','.join(config_hosts)
+
+                self.create_deployment(name, namespace, router_spec)
+
+            elif mongodb_doc['kind'] == 'Job':
+
+                settings = "var shards = %s;\nvar databases = %s;\nvar shardKey = %s;\n\n" % (
+                    json.dumps(shards), json.dumps(config['shardedDatabases']),
+                    json.dumps(config['shardKey']))
+
+                self.kube_client.create_config_map('mongodb-sharding', namespace, {
+                    'mongodb-sharding.js':
+                        settings + self.manifests.read('config_scripts/mongodb-sharding.js')
+                })
+
+                self.start_job(name, namespace, mongodb_doc['spec'])
+            else:
+                logger.error("Invalid document on sharded MongoDB manifest: %s" %
+                             mongodb_doc['kind'])
+
+    def deploy_mongodb_shard(self, namespace, config, shard, shard_spec):
+        # Replica set of a shard, from the shard template of the manifest
+
+        name = 'mongodb-shard-%d' % shard
+        replica_set = 'shard%d' % shard
+
+        shard_spec['serviceName'] = name
+        shard_spec['replicas'] = 1 + config['replicas']
+        shard_spec['template']['metadata']['labels']['name'] = name
+
+        containers = shard_spec['template']['spec']['containers']
+
+        containers[0]['command'][containers[0]['command'].index('--replSet') + 1] = replica_set
+
+        for env_var in containers[1]['env']:
+            if env_var['name'] == 'MONGO_SIDECAR_POD_LABELS':
+                env_var['value'] = 'name=%s' % name
+            elif env_var['name'] == 'KUBERNETES_MONGO_SERVICE_NAME':
+                env_var['value'] = name
+            elif env_var['name'] == 'KUBE_NAMESPACE':
+                env_var['value'] = namespace
+
+        self.set_rolling_update(shard_spec, config)
+
+        self.create_stateful_set(name, namespace, shard_spec)
+
+        return {
+            'name': replica_set,
+            'hosts': ["%s-%d.%s:27017" % (name, ordinal, name)
+                      for ordinal in range(shard_spec['replicas'])]
+        }
 
     def deploy_kafka(self, namespace, config):
 
         kafka_replicas = config['clusterSize']
 
-        with open('manifests/kafka.yaml', 'r') as kafka_docs:
+        for kafka_doc in self.manifests.load_all('manifests/kafka.yaml'):
 
-            for kafka_doc in yaml.load_all(kafka_docs):
+            if kafka_doc['kind'] == 'Service':
+                self.kube_client.create_service(kafka_doc['metadata']['name'], namespace,
+                                                kafka_doc['spec'])
+            elif kafka_doc['kind'] == 'StatefulSet':
 
-                if kafka_doc['kind'] == 'Service':
-                    self.kube_client.create_service(kafka_doc['metadata']['name'], namespace,
-                                                    kafka_doc['spec'])
-                elif kafka_doc['kind'] == 'StatefulSet':
+                kafka_spec = kafka_doc['spec']
 
-                    kafka_spec = kafka_doc['spec']
+                kafka_spec['replicas'] = kafka_replicas
 
-                    kafka_spec['replicas'] = kafka_replicas
+                kafka_container = kafka_spec['template']['spec']['containers'][0]
 
-                    self.kube_client.create_stateful_set(kafka_doc['metadata']['name'],
-                                                         namespace, kafka_spec)
-                else:
-                    logger.error("Invalid document on Kafka manifest: %s" % kafka_doc['kind'])
+                for setting, env_name in KAFKA_BROKER_ENV.items():
+                    if setting in config:
+                        set_env(kafka_container, env_name, str(config[setting]))
 
-    def deploy_device_manager(self, namespace):
+                if 'replicationFactor' in config:
+                    # Consumer offsets are as durable as the topics
+                    set_env(kafka_container, 'KAFKA_OFFSETS_TOPIC_REPLICATION_FACTOR',
+                            str(config['replicationFactor']))
 
-        with open('manifests/device_manager.yaml', 'r') as devm_docs:
+                if 'storageSize' in config:
+                    for claim in kafka_spec['volumeClaimTemplates']:
+                        claim['spec']['resources']['requests']['storage'] = \
+                            config['storageSize']
 
-            for devm_doc in yaml.load_all(devm_docs):
-                if devm_doc['kind'] == 'Service':
-                    self.kube_client.create_service(devm_doc['metadata']['name'], namespace,
-                                                    devm_doc['spec'])
-                elif devm_doc['kind'] == 'Deployment':
+                self.set_rolling_update(kafka_spec, config)
 
-                    image = devm_doc['spec']['template']['spec']['containers'][0]['image'].replace(
-                        'latest', self.config.get_config_data('version'))
+                self.create_stateful_set(kafka_doc['metadata']['name'],
+                                         namespace, kafka_spec)
+            else:
+                logger.error("Invalid document on Kafka manifest: %s" % kafka_doc['kind'])
 
-                    devm_doc['spec']['template']['spec']['containers'][0]['image'] = image
+    def uses_shared_redis(self, service):
+        services = self.config.get_config_data('services')
+        return bool(services.get('redis')) and \
+            (services.get(service) or {}).get('sharedRedis', True)
 
-                    self.kube_client.create_deployment(devm_doc['metadata']['name'], namespace,
-                                                       devm_doc['spec'])
-                else:
-                    logger.error("Invalid document on Dev Manager manifest: %s" % devm_doc['kind'])
+    def set_config_hash(self, spec, config_data):
+        digest = hashlib.sha256(json.dumps(config_data, sort_keys=True).encode()).hexdigest()
+        spec['template']['metadata'].setdefault('annotations', {})[CONFIG_HASH_ANNOTATION] = \
+            digest
 
-    def deploy_data_broker(self, namespace):
+    def redis_config(self, config, container):
 
-        with open('manifests/data_broker.yaml', 'r') as data_broker_docs:
+        lines = ['port 6379', 'dir /data', 'maxmemory-policy %s' % config['maxmemoryPolicy']]
 
-            for db_doc in yaml.load_all(data_broker_docs):
-                if db_doc['kind'] == 'Service':
-                    self.kube_client.create_service(db_doc['metadata']['name'], namespace,
-                                                    db_doc['spec'])
-                elif db_doc['kind'] == 'Deployment':
+        memory_limit = (container.get('resources') or {}).get('limits', {}).get('memory')
 
-                    if db_doc['metadata']['name'] == "data-broker":
-                        img = db_doc['spec']['template']['spec']['containers'][0]['image'].replace(
-                            'latest', self.config.get_config_data('version'))
+        # Without an explicit maxmemory, the memory limit of the container
+        # set by the profile or the overrides sizes the data set
+        if config['maxmemory']:
+            lines.append('maxmemory %d' % parse_memory(config['maxmemory']))
+        elif memory_limit:
+            lines.append('maxmemory %d' % redis_maxmemory(parse_memory(memory_limit)))
+        else:
+            logger.warning("The shared Redis tier has no maxmemory, set it or a profile")
 
-                        db_doc['spec']['template']['spec']['containers'][0]['image'] = img
+        if config['ioThreads'] > 1:
+            lines += ['io-threads %d' % config['ioThreads'], 'io-threads-do-reads yes']
 
-                    self.kube_client.create_deployment(db_doc['metadata']['name'], namespace,
-                                                       db_doc['spec'])
-                else:
-                    logger.error("Invalid document on Data Broker manifest: %s" % db_doc['kind'])
+        lines += REDIS_PERSISTENCE[config['persistence']]
 
-    def deploy_gui(self, namespace):
+        return "\n".join(lines) + "\n"
 
-        with open('manifests/gui.yaml', 'r') as gui_docs:
+    def deploy_redis(self, namespace, config):
+        # Shared redis nodes, each one with a sentinel, behind proxies that
+        # forward the clients to the current master
 
-            for gui_doc in yaml.load_all(gui_docs):
-                if gui_doc['kind'] == 'Service':
-                    self.kube_client.create_service(gui_doc['metadata']['name'], namespace,
-                                                    gui_doc['spec'])
-                elif gui_doc['kind'] == 'Deployment':
+        if not config:
+            return
 
-                    img = gui_doc['spec']['template']['spec']['containers'][0]['image'].replace(
-                        'latest', self.config.get_config_data('version'))
+        for redis_doc in self.manifests.load_all('manifests/redis.yaml'):
+            if redis_doc['kind'] == 'Service':
+                self.kube_client.create_service(redis_doc['metadata']['name'], namespace,
+                                                redis_doc['spec'])
+            elif redis_doc['kind'] == 'StatefulSet':
+
+                redis_spec = redis_doc['spec']
+                pod_spec = redis_spec['template']['spec']
+
+                redis_spec['replicas'] = config['replicas']
 
-                    gui_doc['spec']['template']['spec']['containers'][0]['image'] = img
+                for env_var in pod_spec['containers'][1]['env']:
+                    if env_var['name'] == 'QUORUM':
+                        env_var['value'] = str(config['replicas'] // 2 + 1)
 
-                    self.kube_client.create_deployment(gui_doc['metadata']['name'], namespace,
-                                                       gui_doc['spec'])
+                if config['persistence'] == 'none':
+                    del redis_spec['volumeClaimTemplates']
+                    pod_spec['volumes'].append({'name': 'redis-volume', 'emptyDir': {}})
                 else:
-                    logger.error("Invalid document on GUI manifest: %s" % gui_doc['kind'])
+                    redis_spec['volumeClaimTemplates'][0]['spec']['resources']['requests'][
+                        'storage'] = config['storageSize']
 
-    def deploy_apigw(self, namespace):
+                self.set_rolling_update(redis_spec, config)
 
-        with open('config_scripts/kong.config.sh', 'r') as config_file:
+                # Sized first, maxmemory follows the memory limit of the node
+                self.size_pods(redis_spec)
 
-            config_data = {
-                "kong.config.sh": config_file.read()
-            }
+                config_data = {
+                    'redis.conf': self.redis_config(config, pod_spec['containers'][0]),
+                    'redis_init.sh': self.manifests.read('redis_config_files/redis_init.sh'),
+                    'sentinel_init.sh':
+                        self.manifests.read('redis_config_files/sentinel_init.sh')
+                }
 
-            self.kube_client.create_config_map('kong-route-config', namespace, config_data)
+                self.kube_client.create_config_map('redis-config', namespace, config_data)
 
-        with open('manifests/apigw.yaml', 'r') as apigw_docs:
+                self.set_config_hash(redis_spec, config_data)
 
-            for apigw_doc in yaml.load_all(apigw_docs):
+                self.create_stateful_set(redis_doc['metadata']['name'], namespace,
+                                         redis_spec)
+            elif redis_doc['kind'] == 'Deployment':
 
-                if apigw_doc['kind'] == 'Service':
-                    self.kube_client.create_service(apigw_doc['metadata']['name'], namespace,
-                                                    apigw_doc['spec'])
-                elif apigw_doc['kind'] == 'Deployment':
+                proxy_spec = redis_doc['spec']
 
-                    img = apigw_doc['spec']['template']['spec']['containers'][0]['image'].replace(
-                        'latest', self.config.get_config_data('version'))
+                proxy_spec['replicas'] = config['proxyReplicas']
 
-                    apigw_doc['spec']['template']['spec']['containers'][0]['image'] = img
+                # One backend server for each node, the master being the only
+                # one passing the health check
+                servers = ["    server redis-node-%d redis-node-%d.redis-cluster:6379" %
+                           (ordinal, ordinal) for ordinal in range(config['replicas'])]
 
-                    self.kube_client.create_deployment(apigw_doc['metadata']['name'], namespace,
-                                                       apigw_doc['spec'])
+                config_data = {
+                    'haproxy.cfg': self.manifests.read('redis_config_files/haproxy.cfg') +
+                    "\n".join(servers) + "\n"
+                }
 
-                elif apigw_doc['kind'] == 'Job':
+                self.kube_client.create_config_map('redis-proxy-config', namespace,
+                                                   config_data)
 
-                    if apigw_doc['metadata']['name'] == "kong-migrate":
-                        img = \
-                            apigw_doc['spec']['template']['spec']['containers'][0]['image'].replace(
-                                'latest', self.config.get_config_data('version'))
+                self.set_config_hash(proxy_spec, config_data)
 
-                        apigw_doc['spec']['template']['spec']['containers'][0]['image'] = img
+                self.create_deployment(redis_doc['metadata']['name'], namespace, proxy_spec)
+            else:
+                logger.error("Invalid document on Redis manifest: %s" % redis_doc['kind'])
 
-                    self.kube_client.start_job(apigw_doc['metadata']['name'], namespace,
-                                               apigw_doc['spec'])
-                else:
-                    logger.error("Invalid document on API GW manifest: %s" % apigw_doc['kind'])
+    def deploy_device_manager(self, namespace):
 
-    def deploy_auth(self, namespace, config):
+        for devm_doc in self.manifests.load_all('manifests/device_manager.yaml'):
+            if devm_doc['kind'] == 'Service':
+                self.kube_client.create_service(devm_doc['metadata']['name'], namespace,
+                                                devm_doc['spec'])
+            elif devm_doc['kind'] == 'Deployment':
 
-        with open('manifests/auth.yaml', 'r') as auth_docs:
+                image = devm_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+                    'latest', self.config.get_config_data('version'))
 
-            for auth_doc in yaml.load_all(auth_docs):
-                if auth_doc['kind'] == 'Service':
-                    self.kube_client.create_service(auth_doc['metadata']['name'], namespace,
-                                                    auth_doc['spec'])
-                elif auth_doc['kind'] == 'Deployment':
+                devm_doc['spec']['template']['spec']['containers'][0]['image'] = image
+
+                self.create_deployment(devm_doc['metadata']['name'], namespace,
+                                       devm_doc['spec'])
+            else:
+                logger.error("Invalid document on Dev Manager manifest: %s" % devm_doc['kind'])
+
+    def deploy_data_broker(self, namespace):
 
-                    img = auth_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+        shared_redis = self.uses_shared_redis('data-broker')
+
+        for db_doc in self.manifests.load_all('manifests/data_broker.yaml'):
+            if shared_redis and db_doc['metadata']['name'] == 'data-broker-redis':
+                continue
+
+            if db_doc['kind'] == 'Service':
+                self.kube_client.create_service(db_doc['metadata']['name'], namespace,
+                                                db_doc['spec'])
+            elif db_doc['kind'] == 'Deployment':
+
+                if db_doc['metadata']['name'] == "data-broker":
+                    img = db_doc['spec']['template']['spec']['containers'][0]['image'].replace(
                         'latest', self.config.get_config_data('version'))
 
-                    auth_doc['spec']['template']['spec']['containers'][0]['image'] = img
+                    db_doc['spec']['template']['spec']['containers'][0]['image'] = img
 
-                    # If email parameters are set, pass then to the deployment
-                    # TODO: Set email parameters as secrets
-                    if config.get('emailHost', None):
+                    if shared_redis:
+                        set_env(db_doc['spec']['template']['spec']['containers'][0],
+                                'DATABROKER_CACHE_HOST', 'redis')
 
-                        env_vars = auth_doc['spec']['template']['spec']['containers'][0]['env']
+                self.create_deployment(db_doc['metadata']['name'], namespace,
+                                       db_doc['spec'])
+            else:
+                logger.error("Invalid document on Data Broker manifest: %s" % db_doc['kind'])
 
-                        for env_var in env_vars:
-                            if env_var['name'] == 'AUTH_EMAIL_HOST':
-                                env_var['value'] = config.get('emailHost')
-                            elif env_var['name'] == 'AUTH_EMAIL_USER':
-                                env_var['value'] = config.get('emailUser')
-                            elif env_var['name'] == 'AUTH_EMAIL_PASSWD':
-                                env_var['value'] = config.get('emailPassword')
+    def deploy_gui(self, namespace):
 
-                    self.kube_client.create_deployment(auth_doc['metadata']['name'], namespace,
-                                                       auth_doc['spec'])
-                else:
-                    logger.error("Invalid document on Auth manifest: %s" % auth_doc['kind'])
+        for gui_doc in self.manifests.load_all('manifests/gui.yaml'):
+            if gui_doc['kind'] == 'Service':
+                self.kube_client.create_service(gui_doc['metadata']['name'], namespace,
+                                                gui_doc['spec'])
+            elif gui_doc['kind'] == 'Deployment':
 
-    # TODO: Clusterize rabbitmq
-    # TODO: Add persistence to rabbit
-    def deploy_rabbitmq(self, namespace):
-        with open('manifests/rabbitmq.yaml', 'r') as rabbit_docs:
+                img = gui_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+                    'latest', self.config.get_config_data('version'))
 
-            for rabbit_doc in yaml.load_all(rabbit_docs):
-                if rabbit_doc['kind'] == 'Service':
-                    self.kube_client.create_service(rabbit_doc['metadata']['name'], namespace,
-                                                    rabbit_doc['spec'])
-                elif rabbit_doc['kind'] == 'Deployment':
+                gui_doc['spec']['template']['spec']['containers'][0]['image'] = img
 
-                    self.kube_client.create_deployment(rabbit_doc['metadata']['name'], namespace,
-                                                       rabbit_doc['spec'])
-                else:
-                    logger.error("Invalid document on RabbitMQ manifest: %s" % rabbit_doc['kind'])
+                self.create_deployment(gui_doc['metadata']['name'], namespace,
+                                       gui_doc['spec'])
+            else:
+                logger.error("Invalid document on GUI manifest: %s" % gui_doc['kind'])
 
-    def deploy_mqtt_iotagent(self, namespace):
-        with open('manifests/iotagent-mqtt.yaml', 'r') as mqtt_docs:
+    def deploy_apigw(self, namespace):
 
-            for mqtt_doc in yaml.load_all(mqtt_docs):
-                if mqtt_doc['kind'] == 'Service':
+        config_data = {
+            "kong.config.sh": self.manifests.read('config_scripts/kong.config.sh')
+        }
 
-                    self.kube_client.create_service(mqtt_doc['metadata']['name'], namespace,
-                                                    mqtt_doc['spec'])
-                elif mqtt_doc['kind'] == 'Deployment':
+        self.kube_client.create_config_map('kong-route-config', namespace, config_data)
 
-                    if mqtt_doc['metadata']['name'] == "iotagent-mqtt":
-                        img = \
-                            mqtt_doc['spec']['template']['spec']['containers'][0]['image'].replace(
-                                'latest', self.config.get_config_data('version'))
+        for apigw_doc in self.manifests.load_all('manifests/apigw.yaml'):
 
-                        mqtt_doc['spec']['template']['spec']['containers'][0]['image'] = img
+            if apigw_doc['kind'] == 'Service':
+                self.kube_client.create_service(apigw_doc['metadata']['name'], namespace,
+                                                apigw_doc['spec'])
+            elif apigw_doc['kind'] == 'Deployment':
 
-                    self.kube_client.create_deployment(mqtt_doc['metadata']['name'], namespace,
-                                                       mqtt_doc['spec'])
-                else:
-                    logger.error("Invalid document on MQTT IoT Agent manifest: %s" %
-                                 mqtt_doc['kind'])
+                img = apigw_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+                    'latest', self.config.get_config_data('version'))
 
-    def deploy_flowbroker(self, namespace):
-        with open('manifests/flowbroker.yaml', 'r') as flowbroker_docs:
+                apigw_doc['spec']['template']['spec']['containers'][0]['image'] = img
 
-            for flowbroker_doc in yaml.load_all(flowbroker_docs):
-                if flowbroker_doc['kind'] == 'Service':
+                self.create_deployment(apigw_doc['metadata']['name'], namespace,
+                                       apigw_doc['spec'])
 
-                    self.kube_client.create_service(flowbroker_doc['metadata']['name'], namespace,
-                                                    flowbroker_doc['spec'])
-                elif flowbroker_doc['kind'] == 'Deployment':
+            elif apigw_doc['kind'] == 'Job':
 
+                if apigw_doc['metadata']['name'] == "kong-migrate":
                     img = \
-                      flowbroker_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+                        apigw_doc['spec']['template']['spec']['containers'][0]['image'].replace(
                             'latest', self.config.get_config_data('version'))
 
-                    flowbroker_doc['spec']['template']['spec']['containers'][0]['image'] = img
+                    apigw_doc['spec']['template']['spec']['containers'][0]['image'] = img
 
-                    self.kube_client.create_deployment(flowbroker_doc['metadata']['name'],
-                                                       namespace, flowbroker_doc['spec'])
-                else:
-                    logger.error("Invalid document on Flowbroker manifest: %s" %
-                                 flowbroker_doc['kind'])
+                self.start_job(apigw_doc['metadata']['name'], namespace,
+                               apigw_doc['spec'])
+            else:
+                logger.error("Invalid document on API GW manifest: %s" % apigw_doc['kind'])
 
-    def deploy_history(self, namespace):
-        with open('manifests/history.yaml', 'r') as history_docs:
+    def deploy_auth(self, namespace, config):
 
-            for history_doc in yaml.load_all(history_docs):
-                if history_doc['kind'] == 'Service':
+        for auth_doc in self.manifests.load_all('manifests/auth.yaml'):
+            if auth_doc['kind'] == 'Service':
+                self.kube_client.create_service(auth_doc['metadata']['name'], namespace,
+                                                auth_doc['spec'])
+            elif auth_doc['kind'] == 'Deployment':
+
+                img = auth_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+                    'latest', self.config.get_config_data('version'))
+
+                auth_doc['spec']['template']['spec']['containers'][0]['image'] = img
+
+                # If email parameters are set, pass then to the deployment
+                # TODO: Set email parameters as secrets
+                if config.get('emailHost', None):
+
+                    env_vars = auth_doc['spec']['template']['spec']['containers'][0]['env']
+
+                    for env_var in env_vars:
+                        if env_var['name'] == 'AUTH_EMAIL_HOST':
+                            env_var['value'] = config.get('emailHost')
+                        elif env_var['name'] == 'AUTH_EMAIL_USER':
+                            env_var['value'] = config.get('emailUser')
+                        elif env_var['name'] == 'AUTH_EMAIL_PASSWD':
+                            env_var['value'] = config.get('emailPassword')
+
+                if self.uses_shared_redis('auth'):
+                    # The cache moves from the redis container of the pod
+                    containers = auth_doc['spec']['template']['spec']['containers']
+                    containers[:] = [container for container in containers
+                                     if container['name'] != 'redis']
+                    set_env(containers[0], 'AUTH_CACHE_HOST', 'redis')
+
+                self.create_deployment(auth_doc['metadata']['name'], namespace,
+                                       auth_doc['spec'])
+            else:
+                logger.error("Invalid document on Auth manifest: %s" % auth_doc['kind'])
+
+    def rabbitmq_config(self, namespace, config, container):
+
+        lines = [
+            'cluster_formation.peer_discovery_backend = rabbit_peer_discovery_k8s',
+            'cluster_formation.k8s.host = kubernetes.default.svc.cluster.local',
+            'cluster_formation.k8s.address_type = hostname',
+            'cluster_formation.k8s.service_name = rabbitmq-cluster',
+            'cluster_formation.k8s.hostname_suffix = .rabbitmq-cluster.%s.svc.cluster.local' %
+            namespace,
+            'cluster_formation.node_cleanup.only_log_warning = true',
+            # Nodes on the minority side of a partition stop instead of diverging
+            'cluster_partition_handling = %s' %
+            ('pause_minority' if config['replicas'] >= 3 else 'autoheal'),
+            'queue_master_locator = min-masters',
+            'loopback_users.guest = false',
+            'listeners.tcp.default = 5672',
+            'vm_memory_high_watermark.relative = %s' % config['memoryHighWatermark']
+        ]
+
+        # The watermark is relative to the memory limit of the container
+        # rather than to the memory of the node
+        memory_limit = (container.get('resources') or {}).get('limits', {}).get('memory')
+
+        if memory_limit:
+            lines.append('total_memory_available_override_value = %d' %
+                         parse_memory(memory_limit))
+
+        if config['queuePolicy'] == 'quorum':
+            lines.append('default_queue_type = quorum')
+
+        return "\n".join(lines) + "\n"
+
+    def deploy_rabbitmq(self, namespace, config):
+
+        for rabbit_doc in self.manifests.load_all('manifests/rabbitmq.yaml'):
+            if rabbit_doc['kind'] == 'ServiceAccount':
+                self.kube_client.create_service_account(rabbit_doc['metadata']['name'], namespace)
+            elif rabbit_doc['kind'] == 'Role':
+                self.kube_client.create_role(rabbit_doc['metadata']['name'], namespace,
+                                             rabbit_doc['rules'])
+            elif rabbit_doc['kind'] == 'RoleBinding':
+                self.kube_client.create_role_binding(rabbit_doc['metadata']['name'],
+                                                     namespace,
+                                                     rabbit_doc['subjects'],
+                                                     rabbit_doc['roleRef']['name'])
+            elif rabbit_doc['kind'] == 'Service':
+                self.kube_client.create_service(rabbit_doc['metadata']['name'], namespace,
+                                                rabbit_doc['spec'])
+            elif rabbit_doc['kind'] == 'StatefulSet':
+
+                rabbit_spec = rabbit_doc['spec']
+                container = rabbit_spec['template']['spec']['containers'][0]
+
+                rabbit_spec['replicas'] = config['replicas']
+                rabbit_spec['volumeClaimTemplates'][0]['spec']['resources']['requests'][
+                    'storage'] = config['storageSize']
+
+                if config['queuePolicy'] == 'mirrored':
+                    # Queues mirrored on a majority of the nodes, set once the
+                    # node is up as policies live in the cluster database
+                    policy = json.dumps({'ha-mode': 'exactly',
+                                         'ha-params': config['replicas'] // 2 + 1,
+                                         'ha-sync-mode': 'automatic'})
+
+                    container['lifecycle'] = {'postStart': {'exec': {'command': [
+                        'sh', '-c', "rabbitmqctl await_startup && rabbitmqctl set_policy "
+                        "--apply-to queues ha-dojot '.*' '%s' || true" % policy]}}}
+
+                self.set_rolling_update(rabbit_spec, config)
+
+                # Sized first, the memory watermark follows the memory limit
+                self.size_pods(rabbit_spec)
+
+                config_data = {
+                    'rabbitmq.conf': self.rabbitmq_config(namespace, config, container),
+                    'enabled_plugins': '[rabbitmq_peer_discovery_k8s].\n'
+                }
+
+                self.kube_client.create_config_map('rabbitmq-config', namespace, config_data)
+
+                self.set_config_hash(rabbit_spec, config_data)
+
+                self.create_stateful_set(rabbit_doc['metadata']['name'], namespace,
+                                         rabbit_spec)
+            else:
+                logger.error("Invalid document on RabbitMQ manifest: %s" % rabbit_doc['kind'])
+
+    def mqtt_iotagent_scaled(self):
+        mqtt_config = self.config.get_config_data('services')['iotagent-mqtt']
+
+        return bool(mqtt_config.get('autoscaling')) or (mqtt_config.get('replicas') or 1) > 1
+
+    def set_session_affinity(self, spec):
+        # MQTT clients keep reconnecting to the same agent replica, which
+        # already holds their subscriptions
+
+        mqtt_config = self.config.get_config_data('services')['iotagent-mqtt']
+
+        if not self.mqtt_iotagent_scaled() or not mqtt_config['sessionAffinity']:
+            return
+
+        spec['sessionAffinity'] = 'ClientIP'
+        spec['sessionAffinityConfig'] = {
+            'clientIP': {'timeoutSeconds': mqtt_config['sessionAffinityTimeout']}
+        }
+
+        # Without it load balancers hide the address of the clients
+        if spec.get('type') == 'LoadBalancer':
+            spec['externalTrafficPolicy'] = 'Local'
 
-                    self.kube_client.create_service(history_doc['metadata']['name'], namespace,
-                                                    history_doc['spec'])
-                elif history_doc['kind'] == 'Deployment':
+    def deploy_mqtt_iotagent(self, namespace):
+        shared_redis = self.uses_shared_redis('iotagent-mqtt')
 
+        for mqtt_doc in self.manifests.load_all('manifests/iotagent-mqtt.yaml'):
+            if shared_redis and mqtt_doc['metadata']['name'] == 'iotagent-mqtt-redis':
+                continue
+
+            if mqtt_doc['kind'] == 'Service':
+
+                if mqtt_doc['metadata']['name'] == 'iotagent-mqtt':
+                    self.set_session_affinity(mqtt_doc['spec'])
+
+                self.kube_client.create_service(mqtt_doc['metadata']['name'], namespace,
+                                                mqtt_doc['spec'])
+            elif mqtt_doc['kind'] == 'Deployment':
+
+                if mqtt_doc['metadata']['name'] == "iotagent-mqtt":
                     img = \
-                      history_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+                        mqtt_doc['spec']['template']['spec']['containers'][0]['image'].replace(
                             'latest', self.config.get_config_data('version'))
 
-                    history_doc['spec']['template']['spec']['containers'][0]['image'] = img
+                    mqtt_doc['spec']['template']['spec']['containers'][0]['image'] = img
 
-                    self.kube_client.create_deployment(history_doc['metadata']['name'],
-                                                       namespace, history_doc['spec'])
-                else:
-                    logger.error("Invalid document on History manifest: %s" %
-                                 history_doc['kind'])
+                    # All the replicas keep their sessions and retained
+                    # messages on the same redis, either their own or the
+                    # shared one
+                    if shared_redis:
+                        set_env(mqtt_doc['spec']['template']['spec']['containers'][0],
+                                'BACKEND_HOST', 'redis')
 
-    def deploy_mutual_auth(self, namespace):
+                self.create_deployment(mqtt_doc['metadata']['name'], namespace,
+                                       mqtt_doc['spec'])
+
+                if mqtt_doc['metadata']['name'] == "iotagent-mqtt" and \
+                        self.mqtt_iotagent_scaled():
+                    self.create_mqtt_disruption_budget(namespace, mqtt_doc['spec'])
+            else:
+                logger.error("Invalid document on MQTT IoT Agent manifest: %s" %
+                             mqtt_doc['kind'])
 
-        with open('ma_config_files/redis_init.sh', 'r') as redis_init_file:
-            redis_init = redis_init_file.read()
+    def create_mqtt_disruption_budget(self, namespace, spec):
+        # Voluntary evictions, such as node drains, take down a few agent
+        # replicas at a time so the others keep taking the connections
 
-        with open('ma_config_files/redis.conf', 'r') as redis_conf_file:
-            redis_conf = redis_conf_file.read()
+        mqtt_config = self.config.get_config_data('services')['iotagent-mqtt']
+
+        self.kube_client.create_pod_disruption_budget('iotagent-mqtt', namespace, {
+            'maxUnavailable': mqtt_config['maxUnavailable'],
+            'selector': {'matchLabels': spec['template']['metadata']['labels']}
+        })
+
+    def deploy_flowbroker(self, namespace):
+        for flowbroker_doc in self.manifests.load_all('manifests/flowbroker.yaml'):
+            if flowbroker_doc['kind'] == 'Service':
+
+                self.kube_client.create_service(flowbroker_doc['metadata']['name'], namespace,
+                                                flowbroker_doc['spec'])
+            elif flowbroker_doc['kind'] == 'Deployment':
+
+                img = \
+                  flowbroker_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+                        'latest', self.config.get_config_data('version'))
 
-        with open('ma_config_files/sentinel.conf', 'r') as sentinel_conf_file:
-            sentinel_conf = sentinel_conf_file.read()
+                flowbroker_doc['spec']['template']['spec']['containers'][0]['image'] = img
+
+                self.create_deployment(flowbroker_doc['metadata']['name'],
+                                       namespace, flowbroker_doc['spec'])
+            else:
+                logger.error("Invalid document on Flowbroker manifest: %s" %
+                             flowbroker_doc['kind'])
+
+    def deploy_history(self, namespace):
+        for history_doc in self.manifests.load_all('manifests/history.yaml'):
+            if history_doc['kind'] == 'Service':
+
+                self.kube_client.create_service(history_doc['metadata']['name'], namespace,
+                                                history_doc['spec'])
+            elif history_doc['kind'] == 'Deployment':
+
+                img = \
+                  history_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+                        'latest', self.config.get_config_data('version'))
+
+                history_doc['spec']['template']['spec']['containers'][0]['image'] = img
+
+                self.create_deployment(history_doc['metadata']['name'],
+                                       namespace, history_doc['spec'])
+            else:
+                logger.error("Invalid document on History manifest: %s" %
+                             history_doc['kind'])
+
+    def deploy_mutual_auth(self, namespace):
+
+        redis_init = self.manifests.read('ma_config_files/redis_init.sh')
+        redis_conf = self.manifests.read('ma_config_files/redis.conf')
+        sentinel_conf = self.manifests.read('ma_config_files/sentinel.conf')
 
         config_data = {
             "sentinel.conf": sentinel_conf,
@@ -522,180 +1149,373 @@ class KubeDeployer:
 
         self.kube_client.create_config_map('ma-redis-config', namespace, config_data)
 
-        with open('manifests/mutual-authentication.yaml', 'r') as ma_docs:
-
-            for ma_doc in yaml.load_all(ma_docs):
-                if ma_doc['kind'] == 'Service':
+        for ma_doc in self.manifests.load_all('manifests/mutual-authentication.yaml'):
+            if ma_doc['kind'] == 'Service':
 
-                    self.kube_client.create_service(ma_doc['metadata']['name'], namespace,
-                                                    ma_doc['spec'])
-                elif ma_doc['kind'] == 'Deployment':
+                self.kube_client.create_service(ma_doc['metadata']['name'], namespace,
+                                                ma_doc['spec'])
+            elif ma_doc['kind'] == 'Deployment':
 
-                    if ma_doc['metadata']['name'] == "kerberos":
+                if ma_doc['metadata']['name'] == "kerberos":
 
-                        img = \
-                            ma_doc['spec']['template']['spec']['containers'][0]['image'].replace(
-                                'latest', self.config.get_config_data('version'))
+                    img = \
+                        ma_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+                            'latest', self.config.get_config_data('version'))
 
-                        ma_doc['spec']['template']['spec']['containers'][0]['image'] = img
+                    ma_doc['spec']['template']['spec']['containers'][0]['image'] = img
 
-                    self.kube_client.create_deployment(ma_doc['metadata']['name'], namespace,
-                                                       ma_doc['spec'])
-                else:
-                    logger.error("Invalid document on Mutual Authetication manifest: %s" %
-                                 ma_doc['kind'])
+                self.create_deployment(ma_doc['metadata']['name'], namespace,
+                                       ma_doc['spec'])
+            else:
+                logger.error("Invalid document on Mutual Authetication manifest: %s" %
+                             ma_doc['kind'])
 
     # TODO: Minio configuration for Google Cloud
     # TODO: ACCESS keys as secrets
     def deploy_minio(self, namespace):
-        with open('manifests/minio.yaml', 'r') as minio_docs:
+        for minio_doc in self.manifests.load_all('manifests/minio.yaml'):
+            if minio_doc['kind'] == 'Service':
+                self.kube_client.create_service(minio_doc['metadata']['name'],
+                                                namespace,
+                                                minio_doc['spec'])
 
-            for minio_doc in yaml.load_all(minio_docs):
-                if minio_doc['kind'] == 'Service':
-                    self.kube_client.create_service(minio_doc['metadata']['name'],
-                                                    namespace,
-                                                    minio_doc['spec'])
+            elif minio_doc['kind'] == 'Deployment':
 
-                elif minio_doc['kind'] == 'Deployment':
+                self.create_deployment(minio_doc['metadata']['name'],
+                                       namespace, minio_doc['spec'])
 
-                    self.kube_client.create_deployment(minio_doc['metadata']['name'],
-                                                       namespace, minio_doc['spec'])
+            elif minio_doc['kind'] == 'PersistentVolumeClaim':
 
-                elif minio_doc['kind'] == 'PersistentVolumeClaim':
+                self.kube_client.create_pvc(minio_doc['metadata']['name'],
+                                            namespace, minio_doc['spec'])
 
-                    self.kube_client.create_pvc(minio_doc['metadata']['name'],
-                                                namespace, minio_doc['spec'])
-
-                else:
-                    logger.error("Invalid document on Minio manifest: %s" %
-                                 minio_doc['kind'])
+            else:
+                logger.error("Invalid document on Minio manifest: %s" %
+                             minio_doc['kind'])
 
     # TODO: Access keys as secrets
     def deploy_image_manager(self, namespace):
 
-        with open('manifests/image-manager.yaml', 'r') as image_manager_docs:
-
-            for image_doc in yaml.load_all(image_manager_docs):
-                if image_doc['kind'] == 'Service':
-                    self.kube_client.create_service(image_doc['metadata']['name'],
-                                                    namespace,
-                                                    image_doc['spec'])
+        for image_doc in self.manifests.load_all('manifests/image-manager.yaml'):
+            if image_doc['kind'] == 'Service':
+                self.kube_client.create_service(image_doc['metadata']['name'],
+                                                namespace,
+                                                image_doc['spec'])
 
-                elif image_doc['kind'] == 'Deployment':
+            elif image_doc['kind'] == 'Deployment':
 
-                    img = \
-                        image_doc['spec']['template']['spec']['containers'][0]['image'].replace(
-                            'latest', self.config.get_config_data('version'))
+                img = \
+                    image_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+                        'latest', self.config.get_config_data('version'))
 
-                    image_doc['spec']['template']['spec']['containers'][0]['image'] = img
+                image_doc['spec']['template']['spec']['containers'][0]['image'] = img
 
-                    self.kube_client.create_deployment(image_doc['metadata']['name'],
-                                                       namespace, image_doc['spec'])
+                self.create_deployment(image_doc['metadata']['name'],
+                                       namespace, image_doc['spec'])
 
-                else:
-                    logger.error("Invalid document on Image Manager manifest: %s" %
-                                 image_doc['kind'])
+            else:
+                logger.error("Invalid document on Image Manager manifest: %s" %
+                             image_doc['kind'])
 
     def deploy_ejbca(self, namespace):
 
-        with open('manifests/ejbca.yaml', 'r') as ejbca_docs:
+        for ejbca_doc in self.manifests.load_all('manifests/ejbca.yaml'):
+            if ejbca_doc['kind'] == 'Service':
+                self.kube_client.create_service(ejbca_doc['metadata']['name'],
+                                                namespace,
+                                                ejbca_doc['spec'])
 
-            for ejbca_doc in yaml.load_all(ejbca_docs):
-                if ejbca_doc['kind'] == 'Service':
-                    self.kube_client.create_service(ejbca_doc['metadata']['name'],
-                                                    namespace,
-                                                    ejbca_doc['spec'])
+            elif ejbca_doc['kind'] == 'Deployment':
 
-                elif ejbca_doc['kind'] == 'Deployment':
-
-                    img = \
-                        ejbca_doc['spec']['template']['spec']['containers'][0]['image'].replace(
-                            'latest', self.config.get_config_data('version'))
+                img = \
+                    ejbca_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+                        'latest', self.config.get_config_data('version'))
 
-                    ejbca_doc['spec']['template']['spec']['containers'][0]['image'] = img
+                ejbca_doc['spec']['template']['spec']['containers'][0]['image'] = img
 
-                    self.kube_client.create_deployment(ejbca_doc['metadata']['name'],
-                                                       namespace, ejbca_doc['spec'])
+                self.create_deployment(ejbca_doc['metadata']['name'],
+                                       namespace, ejbca_doc['spec'])
 
-                elif ejbca_doc['kind'] == 'PersistentVolumeClaim':
+            elif ejbca_doc['kind'] == 'PersistentVolumeClaim':
 
-                    self.kube_client.create_pvc(ejbca_doc['metadata']['name'],
-                                                namespace, ejbca_doc['spec'])
+                self.kube_client.create_pvc(ejbca_doc['metadata']['name'],
+                                            namespace, ejbca_doc['spec'])
 
-                else:
-                    logger.error("Invalid document on EJBCA manifest: %s" %
-                                 ejbca_doc['kind'])
+            else:
+                logger.error("Invalid document on EJBCA manifest: %s" %
+                             ejbca_doc['kind'])
                     
     def deploy_alarm_manager(self, namespace):
 
         # TODO: Mount the alarm metamodel files
-        with open('manifests/alarm-manager.yaml', 'r') as alarm_manager_docs:
-
-            for alarm_doc in yaml.load_all(alarm_manager_docs):
-                if alarm_doc['kind'] == 'Service':
-                    self.kube_client.create_service(alarm_doc['metadata']['name'],
-                                                    namespace,
-                                                    alarm_doc['spec'])
+        for alarm_doc in self.manifests.load_all('manifests/alarm-manager.yaml'):
+            if alarm_doc['kind'] == 'Service':
+                self.kube_client.create_service(alarm_doc['metadata']['name'],
+                                                namespace,
+                                                alarm_doc['spec'])
 
-                elif alarm_doc['kind'] == 'Deployment':
+            elif alarm_doc['kind'] == 'Deployment':
 
-                    img = \
-                        alarm_doc['spec']['template']['spec']['containers'][0]['image'].replace(
-                            'latest', self.config.get_config_data('version'))
+                img = \
+                    alarm_doc['spec']['template']['spec']['containers'][0]['image'].replace(
+                        'latest', self.config.get_config_data('version'))
 
-                    alarm_doc['spec']['template']['spec']['containers'][0]['image'] = img
+                alarm_doc['spec']['template']['spec']['containers'][0]['image'] = img
 
-                    self.kube_client.create_deployment(alarm_doc['metadata']['name'],
-                                                       namespace, alarm_doc['spec'])
+                self.create_deployment(alarm_doc['metadata']['name'],
+                                       namespace, alarm_doc['spec'])
 
-                elif alarm_doc['kind'] == 'PersistentVolumeClaim':
+            elif alarm_doc['kind'] == 'PersistentVolumeClaim':
 
-                    self.kube_client.create_pvc(alarm_doc['metadata']['name'],
-                                                namespace, alarm_doc['spec'])
+                self.kube_client.create_pvc(alarm_doc['metadata']['name'],
+                                            namespace, alarm_doc['spec'])
 
-                else:
-                    logger.error("Invalid document on Alarm Manager manifest: %s" %
-                                 alarm_doc['kind'])
+            else:
+                logger.error("Invalid document on Alarm Manager manifest: %s" %
+                             alarm_doc['kind'])
 
-    def deploy_services(self, namespace):
+    def component_tasks(self, namespace):
 
         services_config = self.config.get_config_data('services')
-        # This class instantiate the multiple dojot services
-        self.deploy_zookeeper(namespace, services_config['zookeeper'])
-        self.deploy_postgres(namespace, services_config['postgres'])
-        self.deploy_mongodb(namespace, services_config['mongodb'])
-        self.deploy_kafka(namespace, services_config['kafka'])
-        self.deploy_rabbitmq(namespace)
-        self.deploy_minio(namespace)
 
-        self.deploy_apigw(namespace)
-        self.deploy_auth(namespace, services_config['auth'])
-        self.deploy_mutual_auth(namespace)
-        self.deploy_ejbca(namespace)
+        return OrderedDict([
+            ('zookeeper', partial(self.deploy_zookeeper, namespace,
+                                  services_config['zookeeper'])),
+            ('postgres', partial(self.deploy_postgres, namespace, services_config['postgres'])),
+            ('mongodb', partial(self.deploy_mongodb, namespace, services_config['mongodb'])),
+            ('kafka', partial(self.deploy_kafka, namespace, services_config['kafka'])),
+            ('rabbitmq', partial(self.deploy_rabbitmq, namespace, services_config['rabbitmq'])),
+            ('minio', partial(self.deploy_minio, namespace)),
+            ('redis', partial(self.deploy_redis, namespace, services_config.get('redis'))),
+            ('apigw', partial(self.deploy_apigw, namespace)),
+            ('auth', partial(self.deploy_auth, namespace, services_config['auth'])),
+            ('mutual_auth', partial(self.deploy_mutual_auth, namespace)),
+            ('ejbca', partial(self.deploy_ejbca, namespace)),
+            ('device_manager', partial(self.deploy_device_manager, namespace)),
+            ('data_broker', partial(self.deploy_data_broker, namespace)),
+            ('history', partial(self.deploy_history, namespace)),
+            ('alarm_manager', partial(self.deploy_alarm_manager, namespace)),
+            ('image_manager', partial(self.deploy_image_manager, namespace)),
+            ('mqtt_iotagent', partial(self.deploy_mqtt_iotagent, namespace)),
+            ('flowbroker', partial(self.deploy_flowbroker, namespace)),
+            ('gui', partial(self.deploy_gui, namespace)),
+        ])
+
+    def collect(self, step):
+        # Runs a deployer step, as a method taking the deployer, against an
+        # object collector and returns the objects it would write
+        collector = ObjectCollector()
+        step(KubeDeployer(self.config, collector, self.manifests))
+        return collector.objects
+
+    def component_objects(self, namespace, name):
+        return self.collect(lambda deployer: deployer.component_tasks(namespace)[name]())
+
+    def stale_objects(self, objects):
+        # Kind, name and namespace of the objects an earlier deploy may have
+        # left behind the given ones: the autoscalers of the services that
+        # are no longer autoscaled, which would keep overriding their replicas
+
+        autoscaled = set(body['metadata']['name'] for body in objects
+                         if body['kind'] == 'HorizontalPodAutoscaler')
+
+        return [('HorizontalPodAutoscaler', body['metadata']['name'],
+                 body['metadata']['namespace'])
+                for body in objects if body['kind'] == 'Deployment' and
+                body['metadata']['name'] in STATELESS_SERVICES and
+                body['metadata']['name'] not in autoscaled]
+
+    def deploy_component(self, namespace, name, waiter=None):
+
+        objects = self.component_objects(namespace, name)
+
+        for body in objects:
+            self.kube_client.write(body)
+
+        for kind, stale_name, stale_namespace in self.stale_objects(objects):
+            self.kube_client.delete(kind, stale_name, stale_namespace)
+
+        if waiter:
+            timeouts = self.config.get_config_data('readinessTimeouts')
+            waiter.wait_for_objects(objects, timeouts.get(name, timeouts['default']))
+
+    def deploy_services(self, namespace, parallelism=1, wait=False, components=None):
+
+        # On wait mode the workloads of each component must be ready before
+        # the components that depend on it are deployed
+        waiter = None
+
+        if wait:
+            from .readiness import ReadinessWaiter
+            waiter = ReadinessWaiter(self.kube_client)
+
+        # Components left out of a selective deploy count as already deployed
+        if components is None:
+            components = COMPONENT_DEPENDENCIES
+
+        tasks = OrderedDict((name, partial(self.deploy_component, namespace, name, waiter))
+                            for name in components)
+
+        # Components that do not depend on each other are deployed concurrently
+        # by up to 'parallelism' workers, a single worker keeps the serial order
+        scheduler = DependencyScheduler(COMPONENT_DEPENDENCIES)
+        scheduler.run(tasks, parallelism)
+
+    def log_failures(self, error):
+
+        self.kube_client.log_write_summary()
+
+        logger.error("Dojot deployment failed on these components:")
+        for name, failure in error.failures.items():
+            logger.error("  %s: %s" % (name, failure))
+
+        if error.skipped:
+            logger.error("Components not deployed, as they depend on the ones above: %s" %
+                         ", ".join(error.skipped))
+
+    async def deploy_component_async(self, async_client, objects):
+
+        await async_client.write_all(objects)
+
+        for kind, name, namespace in self.stale_objects(objects):
+            await async_client.delete(kind, name, namespace)
+
+    async def deploy_services_async(self, namespace, async_client):
+
+        tasks = OrderedDict(
+            (name, partial(self.deploy_component_async, async_client,
+                           self.component_objects(namespace, name)))
+            for name in COMPONENT_DEPENDENCIES)
+
+        scheduler = DependencyScheduler(COMPONENT_DEPENDENCIES)
+        await scheduler.run_async(tasks)
+
+    async def deploy_async(self, async_client=None):
+        # Several deployers, each one with its own namespace, may share a
+        # single AsyncKubeClient and be awaited together on one event loop.
+        # Failed components are logged and raised as a SchedulerError instead
+        # of exiting, which would also stop the other deploys of the loop
+        logger.info("Starting deployment")
+
+        # A client created here is closed here, a given one by its owner
+        if async_client is None:
+            async_client = AsyncKubeClient(self.kube_client)
+            owned = True
+        else:
+            owned = False
+
+        namespace = self.config.get_config_data('namespace')
+
+        try:
+            await async_client.load_snapshot(namespace)
+
+            await async_client.create_namespace(namespace)
+
+            await async_client.write_all(
+                self.collect(lambda deployer: deployer.configure_storage(namespace)))
+
+            await async_client.write_all(
+                self.collect(lambda deployer: deployer.configure_external_access(namespace)))
+
+            await self.deploy_services_async(namespace, async_client)
+        except SchedulerError as error:
+            self.log_failures(error)
+            raise
+        finally:
+            if owned:
+                async_client.close()
+
+        async_client.log_write_summary()
 
-        self.deploy_device_manager(namespace)
-        self.deploy_data_broker(namespace)
-        self.deploy_history(namespace)
-        self.deploy_alarm_manager(namespace)
+        logger.info("Dojot was successfully deployed on namespace '%s'!" % namespace)
+
+    def step_objects(self, namespace, name):
+
+        if name == 'storage':
+            return self.collect(lambda deployer: deployer.configure_storage(namespace))
+
+        if name == 'external-access':
+            return self.collect(lambda deployer: deployer.configure_external_access(namespace))
+
+        return self.component_objects(namespace, name)
+
+    def render(self, steps=None):
+        # Objects of every deploy step, by step name, built without any cluster.
+        # Steps left out of 'steps' have no objects, so they keep their numbers
+        namespace = self.config.get_config_data('namespace')
 
-        self.deploy_image_manager(namespace)
+        rendered = OrderedDict()
+        rendered['namespace'] = self.collect(
+            lambda deployer: deployer.kube_client.create_namespace(namespace))
 
-        self.deploy_mqtt_iotagent(namespace)
-        self.deploy_flowbroker(namespace)
+        for name in CLUSTER_STEPS + tuple(COMPONENT_DEPENDENCIES):
+            if steps is None or name in steps:
+                rendered[name] = self.step_objects(namespace, name)
+            else:
+                rendered[name] = []
 
-        self.deploy_gui(namespace)
+        return rendered
 
-    def deploy(self):
+    def plan(self, steps=None):
+        # Changes the deploy of the given steps would make to the cluster,
+        # found listing the objects of each kind and without writing anything
+        namespace = self.config.get_config_data('namespace')
+
+        objects = [body for step_objects in self.render(steps).values()
+                   for body in step_objects]
+        stale = self.stale_objects(objects)
+
+        self.kube_client.load_snapshot(namespace, set(body['kind'] for body in objects) |
+                                       set(kind for kind, _, _ in stale))
+
+        planned = [self.kube_client.plan_write(body) for body in objects]
+        planned += [self.kube_client.plan_delete(*stale_object) for stale_object in stale]
+
+        return [change for change in planned if change is not None]
+
+    def deploy(self, parallelism=1, wait=False, steps=None):
+        # Deploys the given steps, from select_steps(), or all of them
         logger.info("Starting deployment")
 
         namespace = self.config.get_config_data('namespace')
 
+        if steps is None:
+            steps = select_steps()
+            kinds = None
+        else:
+            logger.info("Deploying only: %s" % ", ".join(name.replace('_', '-')
+                                                         for name in steps))
+
+            # Only the kinds written by the selected steps are listed
+            kinds = set(['Namespace'])
+
+            for name in steps:
+                objects = self.step_objects(namespace, name)
+                kinds.update(body['kind'] for body in objects)
+                kinds.update(kind for kind, _, _ in self.stale_objects(objects))
+
+        # Existing objects are listed once, instead of read one by one
+        self.kube_client.load_snapshot(namespace, kinds)
+
         self.kube_client.create_namespace(namespace)
 
-        self.configure_storage(namespace)
+        if 'storage' in steps:
+            self.configure_storage(namespace)
+
+        if 'external-access' in steps:
+            self.configure_external_access(namespace)
+
+        components = [name for name in steps if name in COMPONENT_DEPENDENCIES]
 
-        self.configure_external_access(namespace)
+        try:
+            self.deploy_services(namespace, parallelism, wait, components)
+        except SchedulerError as error:
+            self.log_failures(error)
+            exit(1)
 
-        self.deploy_services(namespace)
+        self.kube_client.log_write_summary()
 
-        logger.info("Dojot was successfully deployed!")
+        if wait:
+            logger.info("Dojot was successfully deployed and is ready!")
+        else:
+            logger.info("Dojot was successfully deployed!")
@@ -1,350 +1,651 @@
+import hashlib
+import json
 import logging
+import socket
+import threading
+import time
 import kubernetes
 
+from collections import Counter, namedtuple
+
 from kubernetes.client.rest import ApiException
+from urllib3.connection import HTTPConnection
+
+from .metrics import CallMetrics
+from .plan import PlannedChange
+from .resources import ResourceWriter, RESOURCE_KINDS, resource_path, describe
+from .retry import RetryPolicy, RETRYABLE_ERRORS
+from .scheduler import TaskFailure
 
 logger = logging.getLogger("Kubernetes")
 
+# Field manager that owns the fields sent on server-side apply
+FIELD_MANAGER = 'dojot-deployer'
+
+# Annotation holding the hash of the object content written by the deployer
+HASH_ANNOTATION = 'deployer.dojot.com.br/content-hash'
+
+# Client API object and method name suffix used to handle each kind
+KIND_APIS = {
+    'Namespace': ('v1', 'namespace'),
+    'Secret': ('v1', 'secret'),
+    'ServiceAccount': ('v1', 'service_account'),
+    'Service': ('v1', 'service'),
+    'ConfigMap': ('v1', 'config_map'),
+    'PersistentVolumeClaim': ('v1', 'persistent_volume_claim'),
+    'StorageClass': ('storageV1Beta1', 'storage_class'),
+    'Deployment': ('extensionsV1Beta1', 'deployment'),
+    'StatefulSet': ('appsV1Beta1', 'stateful_set'),
+    'Job': ('batchV1', 'job'),
+    'ClusterRole': ('authorizationV1Beta1', 'cluster_role'),
+    'ClusterRoleBinding': ('authorizationV1Beta1', 'cluster_role_binding'),
+    'Role': ('authorizationV1Beta1', 'role'),
+    'RoleBinding': ('authorizationV1Beta1', 'role_binding'),
+    'HorizontalPodAutoscaler': ('autoscalingV2Beta1', 'horizontal_pod_autoscaler'),
+    'PodDisruptionBudget': ('policyV1Beta1', 'pod_disruption_budget'),
+}
+
+# Kinds that are only created, existing objects are left untouched
+# TODO: View how to deal with existing pvcs as they are not replaceable
+KEEP_EXISTING_KINDS = ('Namespace', 'ServiceAccount', 'StorageClass', 'PersistentVolumeClaim')
+
+# Stateful set fields the API server allows to change, updates of any other
+# field are refused
+STATEFUL_SET_MUTABLE_FIELDS = ('replicas', 'template', 'updateStrategy')
+
+# Errors that abort the deploy once the retries are exhausted
+API_ERRORS = (ApiException,) + RETRYABLE_ERRORS
+
+# Connections kept to the API server, shared by every API group: pool size,
+# connect and read timeouts and TCP keep-alive idle time, in seconds, where
+# zero disables them
+ConnectionSettings = namedtuple('ConnectionSettings',
+                                ['pool_size', 'connect_timeout', 'read_timeout', 'keep_alive'])
+
+DEFAULT_CONNECTION = ConnectionSettings(pool_size=4, connect_timeout=10, read_timeout=60,
+                                        keep_alive=60)
+
+
+def _keep_alive_options(idle):
+
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+    # Probes start after 'idle' seconds without traffic, where supported
+    for option in ('TCP_KEEPIDLE', 'TCP_KEEPINTVL'):
+        if hasattr(socket, option):
+            options.append((socket.IPPROTO_TCP, getattr(socket, option), idle))
+
+    return options
+
+
+class SharedApiClient(kubernetes.client.ApiClient):
+    # Single client behind every API group object, so that all of them share
+    # its connection pool and TLS connections
+
+    def __init__(self, configuration, connection):
+        configuration.connection_pool_maxsize = connection.pool_size
+        super().__init__(configuration)
+
+        self.connection = connection
+
+        if connection.connect_timeout or connection.read_timeout:
+            self.request_timeout = (connection.connect_timeout or None,
+                                    connection.read_timeout or None)
+        else:
+            self.request_timeout = None
+
+        # Requests beyond the pool size wait for a pooled connection, instead
+        # of opening one that would be discarded, handshake included, after use
+        pool_options = {'block': True}
+
+        if connection.keep_alive:
+            pool_options['socket_options'] = (HTTPConnection.default_socket_options +
+                                              _keep_alive_options(connection.keep_alive))
+
+        self.rest_client.pool_manager.connection_pool_kw.update(pool_options)
+
+    def call_api(self, *args, **kwargs):
+
+        # Watches are streamed for as long as the server keeps them open, so
+        # they are left without the default timeout
+        if kwargs.get('_request_timeout') is None and kwargs.get('_preload_content', True):
+            kwargs['_request_timeout'] = self.request_timeout
+
+        return super().call_api(*args, **kwargs)
+
+
+class _JsonResponse:
+    # Stands for a response whose body is deserialized into a client model
+
+    def __init__(self, data):
+        self.data = data
+
+
+class UnsafeUpdateError(TaskFailure):
+    pass
+
+
+def _error_reason(error):
+    return getattr(error, 'reason', None) or error.__class__.__name__
+
+
+def content_hash(body):
+    # Hash of the object as built by the deployer, leaving out the hash
+    # annotation itself when already set
+
+    metadata = dict(body['metadata'])
+    annotations = dict(metadata.get('annotations') or {})
+
+    if annotations.pop(HASH_ANNOTATION, None) is not None:
+        if annotations:
+            metadata['annotations'] = annotations
+        else:
+            del metadata['annotations']
+
+    body = dict(body, metadata=metadata)
+
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
+
+
+def _contains(current, desired):
+    # Whether every field set on the desired value has the same value on the
+    # current one, which also holds the fields defaulted by the API server
+
+    if isinstance(desired, dict):
+        return isinstance(current, dict) and \
+            all(_contains(current.get(key), value) for key, value in desired.items())
+
+    if isinstance(desired, list):
+        return isinstance(current, list) and len(current) == len(desired) and \
+            all(_contains(item, desired_item) for item, desired_item in zip(current, desired))
+
+    return current == desired
+
+
+def _changes(current, desired, path=''):
+    # Fields set on the desired value that differ on the current one. Fields
+    # only found on the current one, such as the ones defaulted by the API
+    # server, do not count as changes
+
+    if isinstance(desired, dict) and isinstance(current, dict):
+        changes = []
 
-class KubeClient:
+        for key, value in desired.items():
+            changes += _changes(current.get(key), value, path + '.' + key if path else key)
+
+        return changes
+
+    if isinstance(desired, list) and isinstance(current, list) and len(current) == len(desired):
+        changes = []
+
+        for index, (item, desired_item) in enumerate(zip(current, desired)):
+            changes += _changes(item, desired_item, '%s[%d]' % (path, index))
+
+        return changes
+
+    if _contains(current, desired):
+        return []
+
+    return [(path, current, desired)]
+
+
+class KubeClient(ResourceWriter):
+
+    def __init__(self, apply_mode=False, retry_policy=None, rate_limiter=None,
+                 connection=DEFAULT_CONNECTION):
+        # On apply mode every object is sent on a single server-side apply
+        # request instead of being read and then created or replaced
+        self.apply_mode = apply_mode
+
+        # Every request waits for the rate limiter, when there is one, and
+        # throttled or failed requests are retried following the policy
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter = rate_limiter
+
+        self.connection = connection
+
+        # Number of objects by write result: created, updated, unchanged...
+        self.write_stats = Counter()
+        self._stats_lock = threading.Lock()
+
+        # Latency of every API call and of every object write
+        self.metrics = CallMetrics()
+
+        # Objects listed by load_snapshot, by kind, namespace and name, and
+        # the (kind, namespace) pairs already listed
+        self._snapshot = {}
+        self._snapshot_scopes = set()
+
+        # Client model of the objects of each listed kind
+        self._models = {}
 
-    def __init__(self):
         self._prepare_kube()
 
     def _prepare_kube(self):
-        kubernetes.config.load_kube_config()
-        self.v1 = kubernetes.client.CoreV1Api()
-        self.storageV1Beta1 = kubernetes.client.StorageV1beta1Api()
-        self.extensionsV1Beta1 = kubernetes.client.ExtensionsV1beta1Api()
-        self.authorizationV1Beta1 = kubernetes.client.RbacAuthorizationV1beta1Api()
-        self.appsV1Beta1 = kubernetes.client.AppsV1beta1Api()
-        self.batchV1 = kubernetes.client.BatchV1Api()
-
-    def create_namespace(self, namespace):
+        configuration = kubernetes.client.Configuration()
+        kubernetes.config.load_kube_config(client_configuration=configuration)
+
+        self.api_client = SharedApiClient(configuration, self.connection)
+        self.v1 = kubernetes.client.CoreV1Api(self.api_client)
+        self.storageV1Beta1 = kubernetes.client.StorageV1beta1Api(self.api_client)
+        self.extensionsV1Beta1 = kubernetes.client.ExtensionsV1beta1Api(self.api_client)
+        self.authorizationV1Beta1 = kubernetes.client.RbacAuthorizationV1beta1Api(self.api_client)
+        self.appsV1Beta1 = kubernetes.client.AppsV1beta1Api(self.api_client)
+        self.batchV1 = kubernetes.client.BatchV1Api(self.api_client)
+        self.autoscalingV2Beta1 = kubernetes.client.AutoscalingV2beta1Api(self.api_client)
+        self.policyV1Beta1 = kubernetes.client.PolicyV1beta1Api(self.api_client)
+        self.accessReviewV1 = kubernetes.client.AuthorizationV1Api(self.api_client)
+        self.version = kubernetes.client.VersionApi(self.api_client)
+
+    def api_method(self, verb, kind, subresource=None):
+
+        api_name, method = KIND_APIS[kind]
+
+        if RESOURCE_KINDS[kind].namespaced:
+            method = 'namespaced_' + method
+
+        if subresource:
+            method += '_' + subresource
+
+        return getattr(getattr(self, api_name), verb + '_' + method)
+
+    def _call(self, verb, kind, name=None, namespace=None, body=None, subresource=None):
+
+        args = [name] if name else []
+
+        if RESOURCE_KINDS[kind].namespaced:
+            args.append(namespace)
+
+        if body is not None:
+            args.append(body)
+
+        return self._request(verb + ('/' + subresource if subresource else ''), kind,
+                             self.api_method(verb, kind, subresource), *args)
+
+    def call(self, verb, kind, func, *args, **kwargs):
+        # Calls an API method outside of the object writes, with the same
+        # retries, rate limit and metrics
+        return self._request(verb, kind, func, *args, **kwargs)
+
+    def _request(self, verb, kind, func, *args, **kwargs):
+
+        attempt = 0
+
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+
+            try:
+                return self._timed(verb, kind, func, *args, **kwargs)
+            except API_ERRORS as error:
+                if attempt >= self.retry_policy.max_retries or \
+                        not self.retry_policy.is_retryable(error):
+                    raise
+
+                delay = self.retry_policy.delay(attempt, error)
+                attempt += 1
+
+                logger.warning("%s request for a %s failed (%s), retry %d of %d in %.1fs" %
+                               (verb.capitalize(), kind, _error_reason(error), attempt,
+                                self.retry_policy.max_retries, delay))
+                time.sleep(delay)
+
+    def _timed(self, verb, kind, func, *args, **kwargs):
+
+        start = time.perf_counter()
+        outcome = 'error'
+
         try:
-            res = self.v1.read_namespace(namespace)
-            if res.metadata.name == namespace:
-                logger.info("Namespace '%s' already exists!" % namespace)
+            res = func(*args, **kwargs)
+            outcome = 'ok'
+            return res
         except ApiException as error:
             if error.status == 404:
-                logger.info("Namespace '%s' not found, creating..." % namespace)
-                self.v1.create_namespace({'metadata': {'name': namespace}})
+                outcome = '404'
+            elif error.status == 429:
+                outcome = 'throttled'
+            raise
         finally:
-            logger.info("Namespace '%s' is ready" % namespace)
+            self.metrics.observe(kind, verb, outcome, time.perf_counter() - start)
 
-    def create_secret(self, name, secret_type, namespace, data):
+    def _snapshot_scope(self, kind, namespace):
+        return kind, namespace if RESOURCE_KINDS[kind].namespaced else None
 
-        body = {
-            'metadata': {
-                'name': name
-            },
-            'type': secret_type,
-            'data': data
-        }
+    def load_snapshot(self, namespace, kinds=None):
+        # Only the given kinds are listed, objects of other kinds are read
+        # one by one when written
 
-        try:
-            res = self.v1.read_namespaced_secret(name, namespace)
-            if res.metadata.name == name:
-                logger.info("Updating existing secret with name '%s'" % name)
-                self.v1.replace_namespaced_secret(name, namespace, body)
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating secret %s at namespace '%s'" % (name, namespace))
-                self.v1.create_namespaced_secret(namespace, body)
-            else:
-                logger.error(error)
-                exit(1)
+        logger.info("Listing existing objects")
 
-    def create_storage_class(self, name, data):
+        for kind in RESOURCE_KINDS:
+            if kinds is not None and kind not in kinds:
+                continue
 
-        body = {
-            'metadata': {
-                'name': name
-            }
-        }
-        body.update(data)
+            scope = self._snapshot_scope(kind, namespace)
 
-        try:
-            res = self.storageV1Beta1.read_storage_class(name)
-            if res.metadata.name == name:
-                logger.info("Storage class '%s' already exists, nothing done" % name)
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating storage class named '%s'" % name)
-                self.storageV1Beta1.create_storage_class(body)
-            else:
+            if scope in self._snapshot_scopes:
+                continue
+
+            try:
+                res = self._call('list', kind, namespace=scope[1])
+            except API_ERRORS as error:
                 logger.error(error)
                 exit(1)
 
-    def create_deployment(self, name, namespace, spec):
+            # Named as the model of the list, as in V1beta1StatefulSetList
+            self._models[kind] = type(res).__name__[:-len('List')]
 
-        body = {
-            'metadata': {
-                'name': name
-            },
-            'spec': spec
-        }
+            for item in self.api_client.sanitize_for_serialization(res).get('items') or []:
+                self._snapshot[scope + (item['metadata']['name'],)] = item
 
-        try:
-            res = self.extensionsV1Beta1.read_namespaced_deployment(name, namespace)
-            if res.metadata.name == name:
-                logger.info("Updating existing deployment with name '%s' on namespace '%s'" %
-                            (name, namespace))
-                self.extensionsV1Beta1.replace_namespaced_deployment(name, namespace, body)
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating deployment '%s' at namespace '%s'" % (name, namespace))
-                self.extensionsV1Beta1.create_namespaced_deployment(namespace, body)
-            else:
-                logger.error(error)
-                exit(1)
+            self._snapshot_scopes.add(scope)
 
-    def create_service_account(self, name, namespace):
+    def _remember(self, kind, name, namespace, res):
+        # Keeps the snapshot in sync with the objects written
+        scope = self._snapshot_scope(kind, namespace)
 
-        body = {
-            'metadata': {
-                'name': name
-            }
-        }
+        if scope in self._snapshot_scopes:
+            self._snapshot[scope + (name,)] = self.api_client.sanitize_for_serialization(res)
 
-        try:
-            res = self.v1.read_namespaced_service_account(name, namespace)
-            if res.metadata.name == name:
-                logger.info("Service Account '%s' already exists at namespace '%s', nothing done" %
-                            (name, namespace))
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating service account named '%s' at namespace '%s'" %
-                            (name, namespace))
-                self.v1.create_namespaced_service_account(namespace, body)
-            else:
-                logger.error(error)
-                exit(1)
+    def _forget(self, kind, name, namespace):
+        self._snapshot.pop(self._snapshot_scope(kind, namespace) + (name,), None)
 
-    def create_cluster_role(self, name, rules):
+    def _read(self, kind, name, namespace, fetch=True):
 
-        body = {
-            'metadata': {
-                'name': name
-            },
-            'rules': rules
-        }
+        scope = self._snapshot_scope(kind, namespace)
 
-        try:
-            res = self.authorizationV1Beta1.read_cluster_role(name)
-            if res.metadata.name == name:
-                logger.info("Updating existing cluster role with name '%s'" % name)
-                self.authorizationV1Beta1.replace_cluster_role(name, body)
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating cluster role '%s'" % name)
-                self.authorizationV1Beta1.create_cluster_role(body)
-            else:
-                logger.error(error)
-                exit(1)
+        if scope in self._snapshot_scopes:
+            return self._snapshot.get(scope + (name,))
+
+        if not fetch:
+            return None
 
-    def create_cluster_role_binding(self, name, subjects, cluster_role):
+        return self._fetch(kind, name, namespace)
 
-        body = {
-            'metadata': {
-                'name': name
-            },
-            'subjects': subjects,
-            'roleRef': {
-                "kind": "ClusterRole",
-                "name": cluster_role,
-                "apiGroup": "rbac.authorization.k8s.io"
-            }
-        }
+    def _fetch(self, kind, name, namespace):
 
         try:
-            res = self.authorizationV1Beta1.read_cluster_role_binding(name)
-            if res.metadata.name == name:
-                logger.info("Updating existing cluster role binding with name '%s'" % name)
-                self.authorizationV1Beta1.replace_cluster_role_binding(name, body)
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating cluster role binding '%s'" % name)
-                self.authorizationV1Beta1.create_cluster_role_binding(body)
-            else:
-                logger.error(error)
-                exit(1)
+            res = self._call('read', kind, name, namespace)
+        except API_ERRORS as error:
+            if getattr(error, 'status', None) == 404:
+                return None
 
-    def create_service(self, name, namespace, spec):
+            logger.error(error)
+            exit(1)
+
+        self._models.setdefault(kind, type(res).__name__)
 
-        body = {
-            'metadata': {
-                'name': name
-            },
-            'spec': spec
-        }
+        return self.api_client.sanitize_for_serialization(res)
+
+    def _apply(self, kind, name, namespace, body):
+
+        logger.info("Applying %s" % describe(kind, name, namespace))
+
+        # The body goes as a JSON string, which is valid YAML, since the
+        # client only sends non JSON content types when already serialized
+        return self._request(
+            'apply', kind, self.api_client.call_api,
+            resource_path(kind, name, namespace), 'PATCH',
+            query_params=[('fieldManager', FIELD_MANAGER), ('force', 'true')],
+            header_params={'Accept': 'application/json',
+                           'Content-Type': 'application/apply-patch+yaml'},
+            body=json.dumps(body),
+            response_type='object',
+            auth_settings=['BearerToken'],
+            _return_http_data_only=True)
 
-        try:
-            res = self.v1.read_namespaced_service(name, namespace)
+    def _count(self, result):
+        with self._stats_lock:
+            self.write_stats[result] += 1
 
-            body['metadata']['resourceVersion'] = res.metadata.resource_version
+    def _update(self, kind, name, namespace, body, current):
 
-            cluster_ip = getattr(res.spec, 'cluster_ip', None)
+        if kind in KEEP_EXISTING_KINDS:
+            logger.info("Found existing %s, nothing done" % describe(kind, name, namespace))
+            return 'unchanged'
 
-            if cluster_ip:
-                body['spec']['clusterIP'] = cluster_ip
+        elif kind == 'StatefulSet':
+            return self._update_stateful_set(name, namespace, body, current)
 
-            if res.metadata.name == name:
-                logger.info("Updating existing service with name '%s'" % name)
-                self.v1.replace_namespaced_service(name, namespace, body)
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating service '%s' on namespace '%s'" % (name, namespace))
-                self.v1.create_namespaced_service(namespace, body)
-            else:
-                logger.error(error)
-                exit(1)
+        elif kind == 'Job':
+            logger.info("Updating existing %s" % describe(kind, name, namespace))
+            self._remember(kind, name, namespace,
+                           self._call('patch', kind, name, namespace, body))
+            return 'updated'
 
-    def create_stateful_set(self, name, namespace, spec):
+        else:
+            if kind == 'Service':
+                # Services are replaced keeping the version and the cluster IP
+                # previously assigned to them
+                body = dict(body, metadata=dict(body['metadata']), spec=dict(body['spec']))
+                body['metadata']['resourceVersion'] = current['metadata']['resourceVersion']
 
-        body = {
-            'metadata': {
-                'name': name
-            },
-            'spec': spec
-        }
+                cluster_ip = current['spec'].get('clusterIP')
 
-        try:
-            self.appsV1Beta1.read_namespaced_stateful_set(name, namespace)
+                if cluster_ip:
+                    body['spec']['clusterIP'] = cluster_ip
 
-            # TODO: Check the correct way of scaling updating a statefulSet deployment
+            elif kind == 'Deployment' and 'replicas' not in body['spec']:
+                # Deployments without replicas have them managed by an
+                # autoscaler, the replace keeps the count it set
+                body = dict(body, spec=dict(body['spec'],
+                                            replicas=current['spec'].get('replicas', 1)))
 
-            logger.warn("It is not possible to update or scale the stateful"
-                        " set %s via this script at the moment" % name)
+            logger.info("Updating existing %s" % describe(kind, name, namespace))
+            self._remember(kind, name, namespace,
+                           self._call('replace', kind, name, namespace, body))
+            return 'updated'
 
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating stateful set '%s' on namespace '%s'" % (name, namespace))
-                self.appsV1Beta1.create_namespaced_stateful_set(namespace, body)
-            else:
-                logger.error(error)
-                exit(1)
+    def _check_stateful_set(self, name, namespace, body, current):
 
-    def create_role(self, name, namespace, rules):
+        # Fields the server drops, unknown to its model, do not count
+        spec = self._normalized('StatefulSet', body)['spec']
 
-        body = {
-            'metadata': {
-                'name': name
-            },
-            'rules': rules
-        }
+        for field in sorted(spec):
+            if field not in STATEFUL_SET_MUTABLE_FIELDS and \
+                    not _contains(current['spec'].get(field), spec[field]):
+                raise UnsafeUpdateError(
+                    "Refusing to update %s: its %s changed and cannot be updated, the "
+                    "stateful set must be deleted, keeping its pods with --cascade=false, "
+                    "before deploying it again" % (describe('StatefulSet', name, namespace),
+                                                   field))
 
-        try:
-            res = self.authorizationV1Beta1.read_namespaced_role(name, namespace)
-            if res.metadata.name == name:
-                logger.info("Updating existing role with "
-                            "name '%s' on namespace '%s'" % (name, namespace))
-                self.authorizationV1Beta1.replace_namespaced_role(name, namespace, body)
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating role '%s' on namespace '%s'" % (name, namespace))
-                self.authorizationV1Beta1.create_namespaced_role(namespace, body)
-            else:
-                logger.error(error)
-                exit(1)
+    def _update_stateful_set(self, name, namespace, body, current):
 
-    def create_role_binding(self, name, namespace, subjects, role):
+        self._check_stateful_set(name, namespace, body, current)
 
-        for subject in subjects:
-            subject['namespace'] = namespace
+        replicas = body['spec'].get('replicas', 1)
+        current_replicas = current['spec'].get('replicas', 1)
+        annotations = current['metadata'].get('annotations') or {}
 
-        body = {
-            'metadata': {
-                'name': name
-            },
-            'subjects': subjects,
-            'roleRef': {
-                "kind": "Role",
-                "name": role,
-                "apiGroup": "rbac.authorization.k8s.io"
-            }
-        }
+        # When the object only differs on the number of replicas it is
+        # scaled, leaving its pods as they are
+        scaled = dict(body, spec=dict(body['spec'], replicas=current_replicas))
 
-        try:
-            res = self.authorizationV1Beta1.read_namespaced_role_binding(name, namespace)
-            if res.metadata.name == name:
-                logger.info("Updating existing role binding with "
-                            "name '%s' on namespace '%s'" % (name, namespace))
-                self.authorizationV1Beta1.replace_namespaced_role_binding(name, namespace, body)
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating role binding '%s' on namespace '%s'" % (name, namespace))
-                self.authorizationV1Beta1.create_namespaced_role_binding(namespace, body)
-            else:
-                logger.error(error)
-                exit(1)
+        if annotations.get(HASH_ANNOTATION) == content_hash(scaled):
+            logger.info("Scaling %s from %d to %d replicas" %
+                        (describe('StatefulSet', name, namespace), current_replicas, replicas))
 
-    def start_job(self, name, namespace, spec):
+            self._call('patch', 'StatefulSet', name, namespace,
+                       {'spec': {'replicas': replicas}}, subresource='scale')
 
-        body = {
-            'metadata': {
-                'name': name
-            },
-            'spec': spec
-        }
+            patch = {'metadata': {'annotations': body['metadata']['annotations']}}
+            self._remember('StatefulSet', name, namespace,
+                           self._call('patch', 'StatefulSet', name, namespace, patch))
+            return 'scaled'
 
-        try:
-            res = self.batchV1.read_namespaced_job(name, namespace)
-            if res.metadata.name == name:
-                logger.info("Updating existing job with "
-                            "name '%s' on namespace '%s'" % (name, namespace))
-                self.batchV1.patch_namespaced_job(name, namespace, body)
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating job '%s' on namespace '%s'" % (name, namespace))
-                self.batchV1.create_namespaced_job(namespace, body)
-            else:
-                logger.error(error)
-                exit(1)
+        # Pods are replaced one at a time, from the highest ordinal down to
+        # the update strategy partition
+        if _contains(current['spec'].get('template'), body['spec'].get('template')):
+            logger.info("Updating existing %s" % describe('StatefulSet', name, namespace))
+        else:
+            logger.info("Rolling update of %s" % describe('StatefulSet', name, namespace))
+
+        self._remember('StatefulSet', name, namespace,
+                       self._call('replace', 'StatefulSet', name, namespace, body))
+        return 'updated'
+
+    def write(self, body):
+
+        start = time.perf_counter()
+        result = self._write(body)
+
+        self._count(result)
+        self.metrics.observe_write(body['kind'], result, time.perf_counter() - start)
 
-    def create_config_map(self, name, namespace, data):
+    def _write(self, body):
 
-        body = {
-            'metadata': {
-                'name': name
-            },
-            'data': data
-        }
+        kind = body['kind']
+        name = body['metadata']['name']
+        namespace = body['metadata'].get('namespace')
+
+        # Stamps the object with the hash of its content so that later
+        # deploys can tell whether the object in the cluster is outdated
+        body_hash = content_hash(body)
+        body['metadata']['annotations'] = dict(body['metadata'].get('annotations') or {})
+        body['metadata']['annotations'][HASH_ANNOTATION] = body_hash
 
         try:
-            res = self.v1.read_namespaced_config_map(name, namespace)
-            if res.metadata.name == name:
-                logger.info("Updating existing configmap with "
-                            "name '%s' on namespace '%s'" % (name, namespace))
-                self.v1.replace_namespaced_config_map(name, namespace, body)
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating configmap '%s' on namespace '%s'" % (name, namespace))
-                self.v1.create_namespaced_config_map(namespace, body)
-            else:
-                logger.error(error)
-                exit(1)
+            # Apply mode does not need to know the current object, it is only
+            # checked when already listed on the snapshot, except for the kinds
+            # whose existing objects are kept
+            current = self._read(kind, name, namespace,
+                                 fetch=not self.apply_mode or kind in KEEP_EXISTING_KINDS)
+
+            if current is not None:
+                annotations = current['metadata'].get('annotations') or {}
+
+                if annotations.get(HASH_ANNOTATION) == body_hash:
+                    logger.info("The %s is up to date" % describe(kind, name, namespace))
+                    return 'unchanged'
+
+            if self.apply_mode:
+                if kind in KEEP_EXISTING_KINDS and current is not None:
+                    logger.info("Found existing %s, nothing done" %
+                                describe(kind, name, namespace))
+                    return 'unchanged'
+
+                if kind == 'StatefulSet' and current is not None:
+                    self._check_stateful_set(name, namespace, body, current)
+
+                self._remember(kind, name, namespace, self._apply(kind, name, namespace, body))
+                return 'applied'
+
+            if current is None:
+                logger.info("Creating %s" % describe(kind, name, namespace))
+
+                try:
+                    self._remember(kind, name, namespace,
+                                   self._call('create', kind, namespace=namespace, body=body))
+                    return 'created'
+                except ApiException as error:
+                    if error.status != 409:
+                        raise
+                    conflict = error
+
+                # The object already exists, created by a retried request
+                # that did reach the server or by someone else meanwhile
+                current = self._fetch(kind, name, namespace)
+
+                if current is None:
+                    raise conflict
+
+                annotations = current['metadata'].get('annotations') or {}
+
+                if annotations.get(HASH_ANNOTATION) == body_hash:
+                    self._remember(kind, name, namespace, current)
+                    return 'created'
+
+            return self._update(kind, name, namespace, body, current)
+
+        except API_ERRORS as error:
+            logger.error(error)
+            exit(1)
+
+    def _normalized(self, kind, body):
+        # The object as the API server keeps it, leaving out the fields its
+        # model does not know about, which the server drops
+
+        if kind not in self._models:
+            return body
+
+        response = _JsonResponse(json.dumps(body))
+
+        return self.api_client.sanitize_for_serialization(
+            self.api_client.deserialize(response, self._models[kind]))
+
+    def delete(self, kind, name, namespace=None):
+        # Deletes an object a previous deploy left and the current one no
+        # longer writes, when it exists
 
-    # TODO: View how to deal with existing pvcs as they are not replaceable
-    def create_pvc(self, name, namespace, spec):
+        if self._read(kind, name, namespace) is None:
+            return
 
-        body = {
-            'metadata': {
-                'name': name
-            },
-            'spec': spec
-        }
+        logger.info("Deleting %s" % describe(kind, name, namespace))
 
         try:
-            res = self.v1.read_namespaced_persistent_volume_claim(name, namespace)
-            if res.metadata.name == name:
-                logger.info("Updating existing pvc with "
-                            "name '%s' on namespace '%s'" % (name, namespace))
-                # self.v1.replace_namespaced_persistent_volume_claim(name, namespace, body)
-        except ApiException as error:
-            if error.status == 404:
-                logger.info("Creating pvc '%s' on namespace '%s'" % (name, namespace))
-                self.v1.create_namespaced_persistent_volume_claim(namespace, body)
-            else:
+            self._call('delete', kind, name, namespace, body={})
+        except API_ERRORS as error:
+            if getattr(error, 'status', None) != 404:
                 logger.error(error)
                 exit(1)
+
+        self._forget(kind, name, namespace)
+        self._count('deleted')
+
+    def plan_delete(self, kind, name, namespace=None):
+        # What delete() would do to the object, None when it does not exist
+
+        if self._read(kind, name, namespace) is None:
+            return None
+
+        return PlannedChange(kind, name, namespace, 'delete', [])
+
+    def plan_write(self, body):
+        # What write() would do to the object, found without writing anything.
+        # Objects of kinds not listed on the snapshot are read
+
+        kind = body['kind']
+        name = body['metadata']['name']
+        namespace = body['metadata'].get('namespace')
+
+        def planned(action, changes=()):
+            return PlannedChange(kind, name, namespace, action, list(changes))
+
+        current = self._read(kind, name, namespace)
+
+        if current is None:
+            return planned('create')
+
+        annotations = current['metadata'].get('annotations') or {}
+
+        if annotations.get(HASH_ANNOTATION) == content_hash(body) or \
+                kind in KEEP_EXISTING_KINDS:
+            return planned('unchanged')
+
+        changes = _changes(current, self._normalized(kind, body))
+
+        if kind == 'StatefulSet':
+            try:
+                self._check_stateful_set(name, namespace, body, current)
+            except UnsafeUpdateError:
+                return planned('refused', changes)
+
+            replicas = current['spec'].get('replicas', 1)
+            scaled = dict(body, spec=dict(body['spec'], replicas=replicas))
+
+            if annotations.get(HASH_ANNOTATION) == content_hash(scaled):
+                return planned('scale', changes)
+
+        return planned('update', changes)
+
+    def log_write_summary(self):
+
+        results = ['created', 'updated', 'unchanged']
+
+        # Only reported when they happen
+        results += [result for result in ('applied', 'scaled', 'deleted')
+                    if self.write_stats[result]]
+
+        logger.info("Objects %s" % ", ".join("%s: %d" % (result, self.write_stats[result])
+                                             for result in results))
@@ -0,0 +1,131 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+logger = logging.getLogger("Manifests")
+
+# Directories, relative to the repository base, whose files are preloaded
+MANIFEST_DIRS = ['manifests', 'config_scripts', 'ma_config_files', 'redis_config_files']
+
+YAML_EXTENSIONS = ('.yaml', '.yml')
+
+DEFAULT_CACHE_FILE = '.manifest_cache'
+
+# Changing the cached entries layout requires a new cache version
+CACHE_VERSION = 2
+
+
+def load_yaml(stream):
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def load_yaml_all(stream):
+    return [doc for doc in yaml.load_all(stream, Loader=SafeLoader) if doc is not None]
+
+
+def dump_yaml_all(docs, stream=None):
+    return yaml.dump_all(docs, stream, Dumper=SafeDumper, default_flow_style=False,
+                         sort_keys=False)
+
+
+class ManifestRepository:
+
+    def __init__(self, base_dir='.', cache_file=DEFAULT_CACHE_FILE):
+        self.base_dir = base_dir
+        self.cache_path = os.path.join(base_dir, cache_file) if cache_file else None
+
+        # Entries by relative path, holding the file content hash and either
+        # the file text or its YAML documents, which are copied for every
+        # caller so that none of them changes the cached ones
+        self._files = {}
+
+        self._load()
+
+    def _load(self):
+
+        cached = self._read_cache()
+
+        for directory in MANIFEST_DIRS:
+            for root, _, files in os.walk(os.path.join(self.base_dir, directory)):
+                for file_name in sorted(files):
+                    path = os.path.relpath(os.path.join(root, file_name), self.base_dir)
+                    self._files[path] = self._load_file(path, cached.get(path))
+
+        if cached != self._files:
+            self._write_cache()
+
+    def _load_file(self, path, cached_entry=None):
+
+        with open(os.path.join(self.base_dir, path), 'rb') as manifest:
+            raw = manifest.read()
+
+        content_hash = hashlib.sha256(raw).hexdigest()
+
+        if cached_entry and cached_entry[0] == content_hash:
+            return cached_entry
+
+        logger.debug("Parsing %s" % path)
+
+        # Lists, as the entries read back from the JSON cache
+        if path.endswith(YAML_EXTENSIONS):
+            return [content_hash, load_yaml_all(raw)]
+
+        return [content_hash, raw.decode()]
+
+    def _read_cache(self):
+
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError) as error:
+            logger.warning("Ignoring unreadable manifest cache: %s" % error)
+            return {}
+
+        if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+            return {}
+
+        return cache['files']
+
+    def _write_cache(self):
+
+        if not self.cache_path:
+            return
+
+        tmp_path = self.cache_path + '.tmp'
+
+        try:
+            with open(tmp_path, 'w') as cache_file:
+                json.dump({'version': CACHE_VERSION, 'files': self._files}, cache_file)
+            os.replace(tmp_path, self.cache_path)
+        except (OSError, TypeError, ValueError) as error:
+            logger.warning("Could not write the manifest cache: %s" % error)
+
+    def _entry(self, path):
+
+        path = os.path.normpath(path)
+
+        if path not in self._files:
+            # Files outside of the preloaded directories are loaded on demand
+            self._files[path] = self._load_file(path)
+
+        return self._files[path][1]
+
+    def load_all(self, path):
+        return copy.deepcopy(self._entry(path))
+
+    def load(self, path):
+        return self.load_all(path)[0]
+
+    def read(self, path):
+        return self._entry(path)
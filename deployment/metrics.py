@@ -0,0 +1,172 @@
+import bisect
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger("Metrics")
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Histograms of the API requests, by kind, verb and outcome, and of the
+# object writes as a whole, each one made of one or more requests, by kind
+# and result
+REQUEST_METRIC = 'dojot_deployer_api_request_duration_seconds'
+WRITE_METRIC = 'dojot_deployer_object_write_duration_seconds'
+
+
+class _Series:
+
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # Observations per bucket, the last one being +Inf
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def cumulative_buckets(self):
+        cumulative = 0
+        for count in self.buckets:
+            cumulative += count
+            yield cumulative
+
+    def quantile_bound(self, quantile):
+        # Upper bound of the bucket holding the quantile
+        rank = quantile * self.count
+
+        for bound, cumulative in zip(LATENCY_BUCKETS, self.cumulative_buckets()):
+            if cumulative >= rank:
+                return bound
+
+        return self.max
+
+
+class CallMetrics:
+    # Counts and latency histograms of the API calls, by kind, verb and
+    # outcome, and of the object writes, by kind and result. Observing is a
+    # lock and a few additions, so it is always on
+
+    def __init__(self):
+        self._series = {}
+        self._writes = {}
+        self._lock = threading.Lock()
+
+    def _observe(self, series_by_key, key, seconds):
+
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+
+        with self._lock:
+            series = series_by_key.get(key)
+
+            if series is None:
+                series = series_by_key[key] = _Series()
+
+            series.count += 1
+            series.total += seconds
+            series.buckets[index] += 1
+
+            if seconds > series.max:
+                series.max = seconds
+
+    def observe(self, kind, verb, outcome, seconds):
+        self._observe(self._series, (kind, verb, outcome), seconds)
+
+    def observe_write(self, kind, result, seconds):
+        self._observe(self._writes, (kind, result), seconds)
+
+    def _sorted_series(self, series_by_key=None):
+        with self._lock:
+            return sorted((self._series if series_by_key is None else series_by_key).items())
+
+    def _table(self, header, rows):
+
+        lines = [header]
+
+        for key, series in rows:
+            lines.append("%s %6d %9.3f %9.1f %9.1f %9.1f" %
+                         (" ".join("%-*s" % (width, value) for width, value
+                                   in zip((22, 11, 10), key)),
+                          series.count, series.total, 1000 * series.total / series.count,
+                          1000 * series.quantile_bound(0.95), 1000 * series.max))
+
+        return "\n".join(lines)
+
+    def log_summary(self):
+
+        rows = self._sorted_series()
+
+        if rows:
+            logger.info("API calls:\n%s" % self._table(
+                "%-22s %-11s %-10s %6s %9s %9s %9s %9s" %
+                ('kind', 'verb', 'outcome', 'calls', 'total s', 'mean ms', 'p95<= ms', 'max ms'),
+                rows))
+
+        rows = self._sorted_series(self._writes)
+
+        if rows:
+            logger.info("Object writes:\n%s" % self._table(
+                "%-22s %-11s %6s %9s %9s %9s %9s" %
+                ('kind', 'result', 'writes', 'total s', 'mean ms', 'p95<= ms', 'max ms'),
+                rows))
+
+    def _histogram_lines(self, name, description, label_names, rows):
+
+        yield "# HELP %s %s" % (name, description)
+        yield "# TYPE %s histogram" % name
+
+        for key, series in rows:
+            labels = ",".join('%s="%s"' % label for label in zip(label_names, key))
+
+            for bound, cumulative in zip(LATENCY_BUCKETS + ('+Inf',),
+                                         series.cumulative_buckets()):
+                yield '%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative)
+
+            yield '%s_sum{%s} %.6f' % (name, labels, series.total)
+            yield '%s_count{%s} %d' % (name, labels, series.count)
+
+    def _prometheus_lines(self):
+
+        for line in self._histogram_lines(
+                REQUEST_METRIC, "Duration of the Kubernetes API requests made by the deployer",
+                ('kind', 'verb', 'outcome'), self._sorted_series()):
+            yield line
+
+        for line in self._histogram_lines(
+                WRITE_METRIC, "Duration of the object writes of the deployer, requests included",
+                ('kind', 'result'), self._sorted_series(self._writes)):
+            yield line
+
+    def _json_entries(self, label_names, rows):
+
+        return [dict(zip(label_names, key), **{
+            'count': series.count,
+            'sum': series.total,
+            'max': series.max,
+            'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'],
+                                series.cumulative_buckets()))
+        }) for key, series in rows]
+
+    def write_report(self, path):
+        # JSON when the file name ends with .json, otherwise the Prometheus
+        # text format, written atomically as expected by textfile collectors
+
+        if path.endswith('.json'):
+            content = json.dumps({
+                'calls': self._json_entries(('kind', 'verb', 'outcome'), self._sorted_series()),
+                'writes': self._json_entries(('kind', 'result'),
+                                             self._sorted_series(self._writes))
+            }, indent=2) + '\n'
+        else:
+            content = "\n".join(self._prometheus_lines()) + "\n"
+
+        tmp_path = path + '.tmp'
+
+        try:
+            with open(tmp_path, 'w') as report:
+                report.write(content)
+            os.replace(tmp_path, path)
+        except OSError as error:
+            logger.warning("Could not write the metrics report: %s" % error)
@@ -0,0 +1,76 @@
+import json
+import sys
+
+from collections import OrderedDict, namedtuple
+
+from .resources import describe
+
+# Change a deploy would make to an object: its action, one of PLAN_ACTIONS,
+# and the (path, current, desired) values of the fields it changes
+PlannedChange = namedtuple('PlannedChange', ['kind', 'name', 'namespace', 'action', 'changes'])
+
+PLAN_ACTIONS = ('create', 'update', 'scale', 'delete', 'unchanged', 'refused')
+
+# Marks of each action on the plan
+ACTION_SIGNS = {
+    'create': '+',
+    'update': '~',
+    'scale': '~',
+    'delete': '-',
+    'unchanged': '=',
+    'refused': '!'
+}
+
+
+def plan_summary(planned):
+    # Number of objects by action, every action included
+    summary = OrderedDict((action, 0) for action in PLAN_ACTIONS)
+
+    for change in planned:
+        summary[change.action] += 1
+
+    return summary
+
+
+def _value(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def _plan_document(planned):
+
+    return {
+        'objects': [{
+            'kind': change.kind,
+            'name': change.name,
+            'namespace': change.namespace,
+            'action': change.action,
+            'changes': [{'path': path, 'current': current, 'desired': desired}
+                        for path, current, desired in change.changes]
+        } for change in planned],
+        'summary': plan_summary(planned)
+    }
+
+
+def write_plan(planned, output_format='yaml', stream=None):
+    # Writes the changes of a plan to stdout, as text followed by a summary
+    # line, or with the json format as a single document
+
+    stream = stream or sys.stdout
+
+    if output_format == 'json':
+        json.dump(_plan_document(planned), stream, indent=2)
+        stream.write('\n')
+        return
+
+    for change in planned:
+        if change.action == 'unchanged':
+            continue
+
+        stream.write("%s %s %s\n" % (ACTION_SIGNS[change.action], change.action,
+                                     describe(change.kind, change.name, change.namespace)))
+
+        for path, current, desired in change.changes:
+            stream.write("    %s: %s -> %s\n" % (path, _value(current), _value(desired)))
+
+    stream.write("Plan: %s\n" % ", ".join("%d %s" % (count, action) for action, count
+                                          in plan_summary(planned).items()))
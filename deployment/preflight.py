@@ -0,0 +1,360 @@
+import logging
+import socket
+import time
+import kubernetes
+
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .kube import API_ERRORS
+from .profiles import WORKLOAD_KINDS, requested_resources, workload_replicas
+from .quantities import parse_quantity
+from .resources import RESOURCE_KINDS, describe
+
+logger = logging.getLogger("Preflight")
+
+# Problem found by a check, errors stop the deploy while warnings do not
+Finding = namedtuple('Finding', ['check', 'level', 'message'])
+
+# Errors of a kubeconfig that cannot be loaded
+KUBECONFIG_ERRORS = (kubernetes.config.ConfigException, OSError, TypeError)
+
+# Verbs the deployer uses on every kind it writes, and on the workloads it
+# waits for
+WRITE_VERBS = ('get', 'list', 'create', 'update', 'patch')
+WAIT_VERBS = ('watch',)
+
+# Checks run at once, each one waiting on its own API requests
+PREFLIGHT_WORKERS = 8
+
+# Seconds to wait for a TCP connection to a ceph monitor
+CONNECT_TIMEOUT = 3
+
+CEPH_MONITOR_PORT = 6789
+
+# Resource quota fields, by the total of the objects they limit
+QUOTA_TOTALS = {
+    'cpu': 'requests.cpu',
+    'requests.cpu': 'requests.cpu',
+    'memory': 'requests.memory',
+    'requests.memory': 'requests.memory',
+    'limits.cpu': 'limits.cpu',
+    'limits.memory': 'limits.memory',
+    'pods': 'pods',
+    'persistentvolumeclaims': 'persistentvolumeclaims',
+    'requests.storage': 'requests.storage'
+}
+
+# Node taints that keep the deployer pods away
+BLOCKING_TAINTS = ('NoSchedule', 'NoExecute')
+
+
+def required_anti_affinity(pod_spec):
+    # Whether the pods of a template cannot share a node with each other
+
+    anti_affinity = (pod_spec.get('affinity') or {}).get('podAntiAffinity') or {}
+
+    return any(term.get('topologyKey') == 'kubernetes.io/hostname' for term in
+               anti_affinity.get('requiredDuringSchedulingIgnoredDuringExecution') or [])
+
+
+def _reason(error):
+
+    if getattr(error, 'status', None):
+        return "%s %s" % (error.status, error.reason)
+
+    return str(error)
+
+
+def _monitor_address(monitor):
+    # Host and port of a ceph monitor, given as host, host:port, an IPv6
+    # address, or an IPv6 address in brackets followed by :port
+
+    if monitor.startswith('['):
+        host, _, rest = monitor[1:].partition(']')
+        port = rest[1:] if rest.startswith(':') else rest
+
+    elif monitor.count(':') == 1:
+        host, _, port = monitor.partition(':')
+
+    else:
+        host, port = monitor, ''
+
+    return host, int(port) if port else CEPH_MONITOR_PORT
+
+
+def _schedulable(node):
+
+    if node.spec.unschedulable:
+        return False
+
+    if any(taint.effect in BLOCKING_TAINTS for taint in node.spec.taints or []):
+        return False
+
+    return any(condition.type == 'Ready' and condition.status == 'True'
+               for condition in node.status.conditions or [])
+
+
+def _format(total, value):
+
+    if total.endswith('.cpu'):
+        return "%.2f cores" % value
+
+    if total.endswith('.memory') or total == 'requests.storage':
+        return "%.2fGi" % (value / 2 ** 30)
+
+    return "%d" % value
+
+
+class PreflightChecks:
+    # Checks that the cluster can take the objects of a deploy before any of
+    # them is written, running the checks concurrently and reporting every
+    # problem found at once
+
+    def __init__(self, conf, objects, kube_client=None, kube_error=None, wait=False):
+        self.config = conf
+        self.objects = objects
+        self.kube_client = kube_client
+        self.kube_error = kube_error
+        self.wait = wait
+
+        self.namespace = conf.get_config_data('namespace')
+
+    def checks(self, cluster=True):
+        # Name and function of every check, the cluster ones only when the
+        # API server can be reached
+
+        checks = []
+
+        storage = self.config.get_config_data('storage')
+
+        if storage['type'] == 'ceph':
+            for monitor in storage['cephMonitors']:
+                checks.append(('ceph monitor %s' % monitor,
+                               partial(self.check_ceph_monitor, monitor)))
+
+        if not cluster:
+            return checks
+
+        scopes = []
+
+        for body in self.objects:
+            scope = (body['kind'], body['metadata'].get('namespace')
+                     if RESOURCE_KINDS[body['kind']].namespaced else None)
+
+            if scope not in scopes:
+                scopes.append(scope)
+
+        for kind, namespace in scopes:
+            checks.append(('permissions', partial(self.check_access, kind, namespace)))
+
+        checks.append(('nodes', self.check_nodes))
+        checks.append(('storage class', self.check_storage_classes))
+        checks.append(('resource quota', self.check_quota))
+
+        return checks
+
+    def run(self):
+        # Returns whether the deploy can go on, after logging every finding
+
+        start = time.monotonic()
+        findings = []
+        cluster = False
+
+        if self.kube_error is not None:
+            findings.append(Finding('kubeconfig', 'error',
+                                    "Cannot load the kubeconfig: %s" % self.kube_error))
+        else:
+            try:
+                self.kube_client.call('get', 'Version', self.kube_client.version.get_code)
+                cluster = True
+            except API_ERRORS as error:
+                findings.append(Finding('API server', 'error',
+                                        "Cannot reach the API server: %s" % _reason(error)))
+
+        with ThreadPoolExecutor(max_workers=PREFLIGHT_WORKERS) as executor:
+            for check_findings in executor.map(self._run_check, self.checks(cluster)):
+                findings += check_findings
+
+        for finding in findings:
+            log = logger.error if finding.level == 'error' else logger.warning
+            log("%s: %s" % (finding.check, finding.message))
+
+        errors = len([finding for finding in findings if finding.level == 'error'])
+
+        logger.info("Preflight checks finished in %.1fs, %d errors and %d warnings" %
+                    (time.monotonic() - start, errors, len(findings) - errors))
+
+        return errors == 0
+
+    def _run_check(self, check):
+
+        name, function = check
+
+        try:
+            return [Finding(name, level, message) for level, message in function()]
+        except API_ERRORS as error:
+            return [Finding(name, 'error', "Check failed: %s" % _reason(error))]
+
+    def check_ceph_monitor(self, monitor):
+
+        try:
+            address = _monitor_address(monitor)
+        except ValueError:
+            return [('error', "Invalid monitor address, expected host:port or [address]:port")]
+
+        try:
+            socket.create_connection(address, timeout=CONNECT_TIMEOUT).close()
+        except (OSError, ValueError) as error:
+            return [('error', "Cannot connect to the monitor: %s" % error)]
+
+        return []
+
+    def check_access(self, kind, namespace):
+
+        resource = RESOURCE_KINDS[kind]
+        group = resource.api_version.split('/')[0] if '/' in resource.api_version else ''
+
+        verbs = WRITE_VERBS
+
+        if self.wait and kind in WORKLOAD_KINDS:
+            verbs += WAIT_VERBS
+
+        attributes = [{'verb': verb} for verb in verbs]
+
+        # Stateful sets only changing their number of replicas are scaled
+        if kind == 'StatefulSet':
+            attributes.append({'verb': 'patch', 'subresource': 'scale'})
+
+        denied = []
+
+        for attribute in attributes:
+            attribute.update(group=group, resource=resource.plural)
+
+            if namespace:
+                attribute['namespace'] = namespace
+
+            review = self.kube_client.call(
+                'create', 'SelfSubjectAccessReview',
+                self.kube_client.accessReviewV1.create_self_subject_access_review,
+                {'spec': {'resourceAttributes': attribute}})
+
+            if not review.status.allowed:
+                denied.append(attribute['verb'] + ('/' + attribute['subresource']
+                                                   if 'subresource' in attribute else ''))
+
+        if not denied:
+            return []
+
+        target = resource.plural + (" on namespace '%s'" % namespace if namespace else '')
+
+        return [('error', "Not allowed to %s %s" % (", ".join(denied), target))]
+
+    def check_nodes(self):
+
+        nodes = self.kube_client.call('list', 'Node', self.kube_client.v1.list_node).items
+        schedulable = len([node for node in nodes if _schedulable(node)])
+
+        findings = []
+
+        for body in self.objects:
+            if body['kind'] not in ('Deployment', 'StatefulSet'):
+                continue
+
+            replicas = workload_replicas(body)
+            target = describe(body['kind'], body['metadata']['name'],
+                              body['metadata'].get('namespace'))
+
+            if required_anti_affinity(body['spec']['template']['spec']):
+                if replicas > schedulable:
+                    findings.append(('error', "The %d pods of %s cannot share a node and only "
+                                     "%d nodes are schedulable" % (replicas, target,
+                                                                   schedulable)))
+
+            elif body['kind'] == 'StatefulSet' and replicas > schedulable:
+                findings.append(('warning', "The %d pods of %s share the %d schedulable nodes, "
+                                 "losing a node takes down more than one of them" %
+                                 (replicas, target, schedulable)))
+
+        # The in-tree GCE provisioner only provides disks to GCE nodes
+        for body in self.objects:
+            if body['kind'] == 'StorageClass' and \
+                    body['provisioner'] == 'kubernetes.io/gce-pd' and \
+                    not all((node.spec.provider_id or '').startswith('gce://') for node in nodes):
+                findings.append(('error', "The nodes are not all GCE instances, %s cannot "
+                                 "provide their volumes" % body['provisioner']))
+
+        return findings
+
+    def check_storage_classes(self):
+        # Existing storage classes are kept as they are
+
+        findings = []
+
+        for body in self.objects:
+            if body['kind'] != 'StorageClass':
+                continue
+
+            try:
+                current = self.kube_client.call(
+                    'read', 'StorageClass', self.kube_client.api_method('read', 'StorageClass'),
+                    body['metadata']['name'])
+            except kubernetes.client.rest.ApiException as error:
+                if error.status == 404:
+                    continue
+                raise
+
+            if current.provisioner != body['provisioner']:
+                findings.append(('error', "The existing %s uses the %s provisioner instead of "
+                                 "%s, delete it to have it created again" %
+                                 (describe('StorageClass', body['metadata']['name']),
+                                  current.provisioner, body['provisioner'])))
+
+        return findings
+
+    def check_quota(self):
+        # Only the objects to be created count against the headroom left
+
+        quotas = self.kube_client.call(
+            'list', 'ResourceQuota', self.kube_client.v1.list_namespaced_resource_quota,
+            self.namespace).items
+
+        if not quotas:
+            return []
+
+        existing = set()
+
+        for kind in WORKLOAD_KINDS + ('PersistentVolumeClaim',):
+            items = self.kube_client.call('list', kind, self.kube_client.api_method('list', kind),
+                                          self.namespace).items
+            existing.update((kind, item.metadata.name) for item in items)
+
+        needed = Counter()
+
+        for body in self.objects:
+            if body['metadata'].get('namespace') == self.namespace and \
+                    (body['kind'], body['metadata']['name']) not in existing:
+                needed.update(requested_resources(body))
+
+        findings = []
+
+        for quota in quotas:
+            hard = quota.status.hard or quota.spec.hard or {}
+            used = quota.status.used or {}
+
+            for field, limit in sorted(hard.items()):
+                total = QUOTA_TOTALS.get(field)
+
+                if not total or not needed[total]:
+                    continue
+
+                headroom = parse_quantity(limit) - parse_quantity(used.get(field, '0'))
+
+                if needed[total] > headroom:
+                    findings.append(('error', "The new objects need %s of %s and the resource "
+                                     "quota '%s' only has %s left" %
+                                     (_format(total, needed[total]), field,
+                                      quota.metadata.name, _format(total, max(headroom, 0)))))
+
+        return findings
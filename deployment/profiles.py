@@ -0,0 +1,247 @@
+import logging
+
+from collections import Counter
+
+from .quantities import parse_cpu, parse_memory
+from .resources import set_env
+
+logger = logging.getLogger("Profiles")
+
+# Sizing class of the containers, by image name without registry and tag.
+# Containers of any other image take the default sizing
+IMAGE_CLASSES = {
+    'kubernetes-zookeeper': 'zookeeper',
+    'kafka': 'kafka',
+    'spilo-9.6': 'postgres',
+    'mongo': 'mongodb',
+    'redis': 'redis',
+    'rabbitmq': 'rabbitmq',
+    'minio': 'minio'
+}
+
+
+def _sizing(cpu_request, cpu_limit, memory):
+    # Memory requests equal to the limits, so a node never has to reclaim
+    # memory the scheduler promised to a pod
+    return {
+        'requests': {'cpu': cpu_request, 'memory': memory},
+        'limits': {'cpu': cpu_limit, 'memory': memory}
+    }
+
+
+# Container resources of each profile, by sizing class. Data stores get
+# requests equal to their limits, that is the Guaranteed QoS class
+PROFILES = {
+    'small': {
+        'default': _sizing('50m', '500m', '256Mi'),
+        'zookeeper': _sizing('250m', '250m', '512Mi'),
+        'kafka': _sizing('500m', '500m', '1Gi'),
+        'postgres': _sizing('250m', '250m', '512Mi'),
+        'mongodb': _sizing('250m', '250m', '2Gi'),
+        'redis': _sizing('50m', '50m', '128Mi'),
+        'rabbitmq': _sizing('250m', '250m', '512Mi'),
+        'minio': _sizing('100m', '100m', '256Mi')
+    },
+    'medium': {
+        'default': _sizing('100m', '1', '512Mi'),
+        'zookeeper': _sizing('500m', '500m', '1Gi'),
+        'kafka': _sizing('1', '1', '4Gi'),
+        'postgres': _sizing('1', '1', '2Gi'),
+        'mongodb': _sizing('1', '1', '4Gi'),
+        'redis': _sizing('100m', '100m', '512Mi'),
+        'rabbitmq': _sizing('500m', '500m', '1Gi'),
+        'minio': _sizing('250m', '250m', '512Mi')
+    },
+    'large': {
+        'default': _sizing('250m', '2', '1Gi'),
+        'zookeeper': _sizing('1', '1', '2Gi'),
+        'kafka': _sizing('2', '2', '8Gi'),
+        'postgres': _sizing('2', '2', '8Gi'),
+        'mongodb': _sizing('2', '2', '8Gi'),
+        'redis': _sizing('250m', '250m', '2Gi'),
+        'rabbitmq': _sizing('1', '1', '2Gi'),
+        'minio': _sizing('500m', '500m', '1Gi')
+    }
+}
+
+# Kinds of the objects that run pods
+WORKLOAD_KINDS = ('Deployment', 'StatefulSet', 'Job')
+
+MEBIBYTE = 2 ** 20
+GIBIBYTE = 2 ** 30
+
+
+def container_class(container):
+
+    image = container.get('image', '').split('/')[-1].split(':')[0]
+    sizing_class = IMAGE_CLASSES.get(image, 'default')
+
+    # The mongo image also runs the mongos routers and the mongo shell
+    if sizing_class == 'mongodb' and \
+            (container.get('command') or container.get('args') or ['mongod'])[0] != 'mongod':
+        return 'default'
+
+    return sizing_class
+
+
+def container_resources(container, profile=None, overrides=None):
+    # Resources of the profile for the container, with the overrides given
+    # for its name on top of them, None when there are neither
+
+    resources = {}
+
+    if profile:
+        sizing = PROFILES[profile][container_class(container)]
+        resources = {field: dict(values) for field, values in sizing.items()}
+
+    override = (overrides or {}).get(container['name']) or {}
+
+    for field in ('requests', 'limits'):
+        if override.get(field):
+            resources.setdefault(field, {}).update(override[field])
+
+    # A request raised above the profile limit takes the limit along
+    requests = resources.get('requests', {})
+    limits = resources.get('limits', {})
+
+    for resource, parse in (('cpu', parse_cpu), ('memory', parse_memory)):
+        if resource in requests and resource in limits and \
+                parse(requests[resource]) > parse(limits[resource]):
+            limits[resource] = requests[resource]
+
+    return resources or None
+
+
+def _set_flag(arguments, flag, value):
+    # Sets '--flag value' on a list of arguments, replacing any previous value
+
+    if flag in arguments:
+        arguments[arguments.index(flag) + 1] = value
+    else:
+        arguments.extend([flag, value])
+
+
+def redis_maxmemory(memory_limit):
+    # The rest is left to the replication buffers and the forks of the snapshots
+    return memory_limit * 3 // 4
+
+
+def set_memory_settings(container, memory_limit):
+    # Sizes the memory the process itself manages after the container memory
+    # limit, leaving the rest to the page cache, threads and buffers
+
+    sizing_class = container_class(container)
+
+    if sizing_class == 'zookeeper':
+        heap = '--heap=%dM' % (memory_limit * 3 // 4 // MEBIBYTE)
+        container['command'] = [heap if argument.startswith('--heap=') else argument
+                                for argument in container['command']]
+
+    elif sizing_class == 'kafka':
+        # Kafka relies on the page cache, half of the memory is enough for the heap
+        heap = memory_limit // 2 // MEBIBYTE
+        set_env(container, 'KAFKA_HEAP_OPTS', '-Xms%dm -Xmx%dm' % (heap, heap))
+
+    elif sizing_class == 'mongodb':
+        # Same rule as mongod on a host of that size: half of the memory
+        # minus 1GB, in whole gigabytes as MongoDB 3.2 takes them
+        cache = str(max(1, (memory_limit - GIBIBYTE) // 2 // GIBIBYTE))
+
+        if container.get('command'):
+            _set_flag(container['command'], '--wiredTigerCacheSizeGB', cache)
+        else:
+            container['args'] = container.get('args') or ['mongod']
+            _set_flag(container['args'], '--wiredTigerCacheSizeGB', cache)
+
+    elif sizing_class == 'redis':
+        if container.get('command'):
+            logger.debug("Container %s runs its own Redis command, its maxmemory is not set" %
+                         container['name'])
+            return
+
+        container['args'] = container.get('args') or ['redis-server']
+        _set_flag(container['args'], '--maxmemory', str(redis_maxmemory(memory_limit)))
+
+
+def size_pod(pod_spec, profile=None, overrides=None):
+    # Sets the resources of every container of a pod template, and the memory
+    # settings of the data stores that would not follow their memory limit
+
+    if not profile and not overrides:
+        return
+
+    for container in pod_spec.get('initContainers', []) + pod_spec['containers']:
+        resources = container_resources(container, profile, overrides)
+
+        if not resources:
+            continue
+
+        container['resources'] = resources
+
+        memory_limit = resources.get('limits', {}).get('memory')
+
+        if memory_limit is not None:
+            set_memory_settings(container, parse_memory(memory_limit))
+
+
+def workload_replicas(body):
+    # Pods a workload runs at once, autoscaled deployments counted by the
+    # replicas they start with
+    spec = body['spec']
+
+    if body['kind'] == 'Job':
+        return spec.get('parallelism', 1)
+
+    return spec.get('replicas', 1)
+
+
+def pod_resources(pod_spec):
+    # Requests and limits of the containers of a pod, added up and named as
+    # on resource quotas: CPU in cores and memory in bytes
+
+    totals = Counter()
+
+    for container in pod_spec['containers']:
+        resources = container.get('resources') or {}
+        limits = resources.get('limits') or {}
+
+        # Requests not set default to the limits
+        requests = dict(limits, **(resources.get('requests') or {}))
+
+        for field, values in (('requests', requests), ('limits', limits)):
+            if 'cpu' in values:
+                totals[field + '.cpu'] += parse_cpu(values['cpu'])
+
+            if 'memory' in values:
+                totals[field + '.memory'] += parse_memory(values['memory'])
+
+    return totals
+
+
+def requested_resources(body):
+    # Resources an object takes from the cluster once all its pods run, named
+    # as on resource quotas: CPU in cores, memory and storage in bytes
+
+    totals = Counter()
+
+    if body['kind'] == 'PersistentVolumeClaim':
+        totals['persistentvolumeclaims'] += 1
+        totals['requests.storage'] += parse_memory(
+            body['spec']['resources']['requests']['storage'])
+        return totals
+
+    if body['kind'] not in WORKLOAD_KINDS:
+        return totals
+
+    replicas = workload_replicas(body)
+    totals['pods'] += replicas
+
+    for field, value in pod_resources(body['spec']['template']['spec']).items():
+        totals[field] += replicas * value
+
+    for claim in body['spec'].get('volumeClaimTemplates') or []:
+        totals['persistentvolumeclaims'] += replicas
+        totals['requests.storage'] += replicas * parse_memory(
+            claim['spec']['resources']['requests']['storage'])
+
+    return totals
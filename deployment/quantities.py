@@ -0,0 +1,37 @@
+import re
+
+# Multipliers of the Kubernetes quantity suffixes
+BINARY_SUFFIXES = {'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50}
+DECIMAL_SUFFIXES = {'m': 1e-3, '': 1, 'k': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'P': 1e15}
+
+QUANTITY_PATTERN = re.compile(r'^([0-9]+(?:\.[0-9]*)?|\.[0-9]+)([a-zA-Z]*)$')
+
+
+def parse_quantity(quantity):
+    # Value of a quantity such as '500m', '1.5' or '2Gi', raising ValueError
+    # when it is not a valid one
+
+    match = QUANTITY_PATTERN.match(str(quantity).strip())
+
+    if not match:
+        raise ValueError("Invalid quantity '%s'" % quantity)
+
+    number, suffix = match.groups()
+
+    if suffix in BINARY_SUFFIXES:
+        return float(number) * BINARY_SUFFIXES[suffix]
+
+    if suffix in DECIMAL_SUFFIXES:
+        return float(number) * DECIMAL_SUFFIXES[suffix]
+
+    raise ValueError("Invalid quantity suffix '%s' in '%s'" % (suffix, quantity))
+
+
+def parse_cpu(quantity):
+    # Number of cores
+    return parse_quantity(quantity)
+
+
+def parse_memory(quantity):
+    # Number of bytes
+    return int(parse_quantity(quantity))
@@ -0,0 +1,150 @@
+import json
+import logging
+import time
+
+from kubernetes.watch.watch import iter_resp_lines
+
+from .resources import describe
+from .retry import RETRYABLE_ERRORS
+from .scheduler import TaskFailure
+
+logger = logging.getLogger("Readiness")
+
+# Kinds whose readiness is awaited, the other kinds are ready once written
+WORKLOAD_KINDS = ('StatefulSet', 'Deployment', 'Job')
+
+
+class ReadinessError(TaskFailure):
+    pass
+
+
+def _workload_state(kind, obj):
+    # Returns whether the object is ready and a description of its state
+
+    spec = obj.get('spec') or {}
+    status = obj.get('status') or {}
+
+    if kind == 'Job':
+        completions = spec.get('completions') or 1
+        succeeded = status.get('succeeded') or 0
+
+        for condition in status.get('conditions') or []:
+            if condition.get('type') == 'Failed' and condition.get('status') == 'True':
+                raise ReadinessError("failed: %s" % (condition.get('message') or
+                                                     condition.get('reason')))
+
+        return succeeded >= completions, "%d/%d completions" % (succeeded, completions)
+
+    replicas = spec.get('replicas', 1)
+
+    # Status fields are only meaningful once the controller saw the last change
+    observed = status.get('observedGeneration', 0) >= obj['metadata'].get('generation', 0)
+
+    updated = status.get('updatedReplicas') or 0
+
+    if kind == 'StatefulSet':
+        ready = status.get('readyReplicas') or 0
+        strategy = spec.get('updateStrategy') or {}
+
+        # Only rolling updates replace the pods, the ones below the partition
+        # keep the previous revision until it is lowered
+        if strategy.get('type') == 'RollingUpdate':
+            partition = (strategy.get('rollingUpdate') or {}).get('partition') or 0
+            rolled = updated >= replicas - partition and \
+                (partition > 0 or status.get('currentRevision') == status.get('updateRevision'))
+        else:
+            rolled = True
+
+        return (observed and rolled and ready >= replicas,
+                "%d/%d replicas ready, %d updated" % (ready, replicas, updated))
+
+    available = status.get('availableReplicas') or 0
+
+    # Pods of the previous replica set are still running until it is scaled down
+    old = (status.get('replicas') or 0) - updated
+
+    return (observed and updated >= replicas and available >= replicas and old <= 0,
+            "%d/%d replicas available, %d old" % (available, replicas, max(old, 0)))
+
+
+class ReadinessWaiter:
+
+    def __init__(self, kube_client):
+        self.kube_client = kube_client
+
+    def _events(self, kind, list_method, name, namespace, resource_version, deadline):
+        # Watch events of the object from the given version on. The watch is
+        # opened through the client, with its retries and rate limit
+
+        response = self.kube_client.call(
+            'watch', kind, list_method, namespace, watch=True, _preload_content=False,
+            field_selector='metadata.name=%s' % name, resource_version=resource_version,
+            timeout_seconds=max(1, int(deadline - time.monotonic())))
+
+        try:
+            for line in iter_resp_lines(response):
+                yield json.loads(line)
+        finally:
+            response.close()
+            response.release_conn()
+
+    def _check(self, kind, name, namespace, obj):
+
+        try:
+            return _workload_state(kind, obj)
+        except ReadinessError as error:
+            raise ReadinessError("%s %s" % (describe(kind, name, namespace), error))
+
+    def wait(self, kind, name, namespace, deadline):
+
+        list_method = self.kube_client.api_method('list', kind)
+        state = "no status received"
+
+        # The object is listed and then watched from its version on, both
+        # again whenever the server closes the watch or the connection breaks,
+        # until the deadline
+        while time.monotonic() < deadline:
+            res = self.kube_client.call('list', kind, list_method, namespace,
+                                        field_selector='metadata.name=%s' % name)
+
+            for obj in self.kube_client.api_client.sanitize_for_serialization(res)['items']:
+                ready, state = self._check(kind, name, namespace, obj)
+
+                if ready:
+                    logger.info("The %s is ready (%s)" % (describe(kind, name, namespace), state))
+                    return
+
+            try:
+                for event in self._events(kind, list_method, name, namespace,
+                                          res.metadata.resource_version, deadline):
+
+                    # Expired versions come as an error event, listed again
+                    if event['type'] == 'ERROR':
+                        break
+
+                    if event['type'] not in ('ADDED', 'MODIFIED'):
+                        continue
+
+                    ready, state = self._check(kind, name, namespace, event['object'])
+
+                    if ready:
+                        logger.info("The %s is ready (%s)" %
+                                    (describe(kind, name, namespace), state))
+                        return
+            except RETRYABLE_ERRORS as error:
+                logger.warning("Watch of %s broken (%s), watching again" %
+                               (describe(kind, name, namespace), error.__class__.__name__))
+
+        raise ReadinessError("%s is not ready after the timeout (%s)" %
+                             (describe(kind, name, namespace), state))
+
+    def wait_for_objects(self, objects, timeout):
+
+        deadline = time.monotonic() + timeout
+
+        for body in objects:
+            if body['kind'] in WORKLOAD_KINDS:
+                logger.info("Waiting for %s" % describe(body['kind'], body['metadata']['name'],
+                                                        body['metadata'].get('namespace')))
+                self.wait(body['kind'], body['metadata']['name'],
+                          body['metadata'].get('namespace'), deadline)
@@ -0,0 +1,45 @@
+import json
+import logging
+import os
+import sys
+
+from .manifests import dump_yaml_all
+
+logger = logging.getLogger("Render")
+
+OUTPUT_FORMATS = ('yaml', 'json')
+
+
+def _dump(objects, output_format, stream):
+
+    if output_format == 'json':
+        # A single List object, as accepted by kubectl
+        json.dump({'apiVersion': 'v1', 'kind': 'List', 'items': objects}, stream, indent=2)
+        stream.write('\n')
+    else:
+        dump_yaml_all(objects, stream)
+
+
+def write_render(steps, target, output_format='yaml'):
+    # Writes every object to stdout when the target is '-', otherwise writes
+    # one file per deploy step on the target directory, numbered in deploy order
+
+    if target == '-':
+        _dump([body for objects in steps.values() for body in objects],
+              output_format, sys.stdout)
+        return
+
+    os.makedirs(target, exist_ok=True)
+
+    for index, (step, objects) in enumerate(steps.items()):
+
+        if not objects:
+            continue
+
+        path = os.path.join(target, "%02d-%s.%s" % (index, step.replace('_', '-'),
+                                                    output_format))
+
+        with open(path, 'w') as output:
+            _dump(objects, output_format, output)
+
+        logger.info("Wrote %d objects to %s" % (len(objects), path))
@@ -0,0 +1,176 @@
+import abc
+import re
+
+from collections import namedtuple
+
+# API version, URL resource name and scope of each object kind the deployer writes
+ResourceKind = namedtuple('ResourceKind', ['api_version', 'plural', 'namespaced'])
+
+RESOURCE_KINDS = {
+    'Namespace': ResourceKind('v1', 'namespaces', False),
+    'Secret': ResourceKind('v1', 'secrets', True),
+    'ServiceAccount': ResourceKind('v1', 'serviceaccounts', True),
+    'Service': ResourceKind('v1', 'services', True),
+    'ConfigMap': ResourceKind('v1', 'configmaps', True),
+    'PersistentVolumeClaim': ResourceKind('v1', 'persistentvolumeclaims', True),
+    'StorageClass': ResourceKind('storage.k8s.io/v1beta1', 'storageclasses', False),
+    'Deployment': ResourceKind('extensions/v1beta1', 'deployments', True),
+    'StatefulSet': ResourceKind('apps/v1beta1', 'statefulsets', True),
+    'Job': ResourceKind('batch/v1', 'jobs', True),
+    'ClusterRole': ResourceKind('rbac.authorization.k8s.io/v1beta1', 'clusterroles', False),
+    'ClusterRoleBinding': ResourceKind('rbac.authorization.k8s.io/v1beta1',
+                                       'clusterrolebindings', False),
+    'Role': ResourceKind('rbac.authorization.k8s.io/v1beta1', 'roles', True),
+    'RoleBinding': ResourceKind('rbac.authorization.k8s.io/v1beta1', 'rolebindings', True),
+    'HorizontalPodAutoscaler': ResourceKind('autoscaling/v2beta1', 'horizontalpodautoscalers',
+                                            True),
+    'PodDisruptionBudget': ResourceKind('policy/v1beta1', 'poddisruptionbudgets', True),
+}
+
+
+def resource_path(kind, name=None, namespace=None):
+
+    resource = RESOURCE_KINDS[kind]
+
+    if resource.api_version == 'v1':
+        path = '/api/v1'
+    else:
+        path = '/apis/' + resource.api_version
+
+    if resource.namespaced:
+        path += '/namespaces/' + namespace
+
+    path += '/' + resource.plural
+
+    if name:
+        path += '/' + name
+
+    return path
+
+
+def describe(kind, name, namespace=None):
+    # Human readable reference to an object, as in "stateful set 'zk' on namespace 'dojot'"
+    label = re.sub(r'(?<!^)([A-Z])', r' \1', kind).lower()
+
+    if namespace and RESOURCE_KINDS[kind].namespaced:
+        return "%s '%s' on namespace '%s'" % (label, name, namespace)
+
+    return "%s '%s'" % (label, name)
+
+
+def set_env(container, name, value):
+    # Sets an environment variable of a container, replacing any previous value
+
+    env = container.setdefault('env', [])
+
+    for env_var in env:
+        if env_var['name'] == name:
+            env_var['value'] = value
+            return
+
+    env.append({'name': name, 'value': value})
+
+
+def build_object(kind, name, namespace=None, **fields):
+
+    metadata = {
+        'name': name
+    }
+
+    if RESOURCE_KINDS[kind].namespaced:
+        metadata['namespace'] = namespace
+
+    body = {
+        'apiVersion': RESOURCE_KINDS[kind].api_version,
+        'kind': kind,
+        'metadata': metadata
+    }
+    body.update(fields)
+
+    return body
+
+
+class ResourceWriter(abc.ABC):
+    # Builds the complete objects requested by the deployer and hands them to
+    # write(), which decides how they reach the cluster
+
+    @abc.abstractmethod
+    def write(self, body):
+        pass
+
+    def create_namespace(self, namespace):
+        self.write(build_object('Namespace', namespace))
+
+    def create_secret(self, name, secret_type, namespace, data):
+        self.write(build_object('Secret', name, namespace, type=secret_type, data=data))
+
+    def create_storage_class(self, name, data):
+        self.write(build_object('StorageClass', name, **data))
+
+    def create_deployment(self, name, namespace, spec):
+        self.write(build_object('Deployment', name, namespace, spec=spec))
+
+    def create_service_account(self, name, namespace):
+        self.write(build_object('ServiceAccount', name, namespace))
+
+    def create_cluster_role(self, name, rules):
+        self.write(build_object('ClusterRole', name, rules=rules))
+
+    def create_cluster_role_binding(self, name, subjects, cluster_role):
+
+        role_ref = {
+            "kind": "ClusterRole",
+            "name": cluster_role,
+            "apiGroup": "rbac.authorization.k8s.io"
+        }
+
+        self.write(build_object('ClusterRoleBinding', name, subjects=subjects,
+                                roleRef=role_ref))
+
+    def create_service(self, name, namespace, spec):
+        self.write(build_object('Service', name, namespace, spec=spec))
+
+    def create_stateful_set(self, name, namespace, spec):
+        self.write(build_object('StatefulSet', name, namespace, spec=spec))
+
+    def create_role(self, name, namespace, rules):
+        self.write(build_object('Role', name, namespace, rules=rules))
+
+    def create_role_binding(self, name, namespace, subjects, role):
+
+        for subject in subjects:
+            subject['namespace'] = namespace
+
+        role_ref = {
+            "kind": "Role",
+            "name": role,
+            "apiGroup": "rbac.authorization.k8s.io"
+        }
+
+        self.write(build_object('RoleBinding', name, namespace, subjects=subjects,
+                                roleRef=role_ref))
+
+    def start_job(self, name, namespace, spec):
+        self.write(build_object('Job', name, namespace, spec=spec))
+
+    def create_config_map(self, name, namespace, data):
+        self.write(build_object('ConfigMap', name, namespace, data=data))
+
+    def create_pvc(self, name, namespace, spec):
+        self.write(build_object('PersistentVolumeClaim', name, namespace, spec=spec))
+
+    def create_horizontal_pod_autoscaler(self, name, namespace, spec):
+        self.write(build_object('HorizontalPodAutoscaler', name, namespace, spec=spec))
+
+    def create_pod_disruption_budget(self, name, namespace, spec):
+        self.write(build_object('PodDisruptionBudget', name, namespace, spec=spec))
+
+
+class ObjectCollector(ResourceWriter):
+    # Keeps the objects instead of writing them anywhere
+
+    def __init__(self):
+        self.objects = []
+
+    def write(self, body):
+        self.objects.append(body)
@@ -0,0 +1,83 @@
+import random
+import threading
+import time
+import urllib3
+
+# Responses worth retrying: throttling and server errors that are usually
+# transient, such as an API server being restarted
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+# Connection level errors that reach the caller: resets, timeouts and
+# connections refused after the urllib3 retries
+RETRYABLE_ERRORS = (urllib3.exceptions.ProtocolError, urllib3.exceptions.MaxRetryError,
+                    urllib3.exceptions.TimeoutError, ConnectionError)
+
+DEFAULT_MAX_RETRIES = 5
+
+
+def retry_after(error):
+    # Seconds asked by the server through the Retry-After header, if any
+
+    headers = getattr(error, 'headers', None) or {}
+    value = headers.get('Retry-After')
+
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES, base_delay=0.5, max_delay=30.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, error):
+
+        status = getattr(error, 'status', None)
+
+        if status is not None:
+            return status in RETRYABLE_STATUSES
+
+        return isinstance(error, RETRYABLE_ERRORS)
+
+    def delay(self, attempt, error=None):
+        # Capped exponential backoff with full jitter, unless the server said
+        # how long to wait
+
+        requested = retry_after(error)
+
+        if requested is not None:
+            return min(requested, self.max_delay)
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class RateLimiter:
+    # Token bucket allowing 'qps' requests per second on average and bursts
+    # of up to 'burst' requests, shared by every thread of the client
+
+    def __init__(self, qps, burst=None):
+        self.qps = float(qps)
+        self.burst = burst or max(1, int(qps))
+
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.qps)
+            self._updated = now
+
+            # The token is taken right away, callers going below zero wait
+            # for their turn outside of the lock
+            self._tokens -= 1
+            wait = -self._tokens / self.qps if self._tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger("Scheduler")
+
+
+class TaskFailure(Exception):
+    # Expected failure of a task, which does not stop the independent tasks
+    pass
+
+
+class SchedulerError(Exception):
+
+    def __init__(self, failures, skipped):
+        super().__init__("Failed tasks: %s" % ", ".join(failures))
+        self.failures = failures
+        self.skipped = skipped
+
+
+def _run_task(task):
+
+    try:
+        task()
+    except TaskFailure as error:
+        return error
+
+    return None
+
+
+async def _run_task_async(task):
+
+    try:
+        await task()
+    except TaskFailure as error:
+        return error
+
+    return None
+
+
+class DependencyScheduler:
+
+    def __init__(self, dependencies):
+        # Maps each task name to the names it must run after. The mapping
+        # order is the serial order, used to break ties between ready tasks
+        self.dependencies = OrderedDict(dependencies)
+        self._check_graph()
+
+    def _check_graph(self):
+
+        for name, deps in self.dependencies.items():
+            for dep in deps:
+                if dep not in self.dependencies:
+                    raise ValueError("Task '%s' depends on unknown task '%s'" % (name, dep))
+
+        # Raises if the graph has a cycle
+        self.order()
+
+    def order(self, names=None):
+
+        if names is None:
+            names = self.dependencies.keys()
+
+        pending = OrderedDict((name, self._dependencies_of(name, names)) for name in names)
+        ordered = []
+
+        while pending:
+            ready = [name for name, deps in pending.items() if not deps]
+
+            if not ready:
+                raise ValueError("Dependency cycle between tasks: %s" % ", ".join(pending))
+
+            # Only the first ready task is taken so the declared order is kept
+            # whenever it is already a valid one
+            ordered.append(ready[0])
+            del pending[ready[0]]
+
+            for deps in pending.values():
+                deps.discard(ready[0])
+
+        return ordered
+
+    def _dependencies_of(self, name, names):
+        # Dependencies outside of the scheduled set are considered satisfied
+        return set(dep for dep in self.dependencies[name] if dep in names)
+
+    def _finish(self, name, error, pending, failures, skipped):
+
+        if error is None:
+            for deps in pending.values():
+                deps.discard(name)
+            return
+
+        logger.error("Task '%s' failed: %s" % (name, error))
+        failures[name] = error
+
+        # Everything that depends on the failed task, directly or not, is skipped
+        blocked = [name]
+
+        while blocked:
+            blocker = blocked.pop()
+
+            for dependent in [dependent for dependent, deps in pending.items() if blocker in deps]:
+                logger.warning("Skipping task '%s', it depends on '%s'" % (dependent, blocker))
+                del pending[dependent]
+                skipped.append(dependent)
+                blocked.append(dependent)
+
+    def run(self, tasks, parallelism=1):
+        # Tasks failing with TaskFailure have their dependents skipped while
+        # the independent ones carry on, any other error stops the run
+
+        pending = OrderedDict((name, self._dependencies_of(name, tasks))
+                              for name in self.order(tasks.keys()))
+        running = {}
+        failures = OrderedDict()
+        skipped = []
+
+        if parallelism <= 1:
+            while pending:
+                name = next(iter(pending))
+                del pending[name]
+
+                logger.info("Running task '%s'" % name)
+                self._finish(name, _run_task(tasks[name]), pending, failures, skipped)
+
+        else:
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+
+                while pending or running:
+
+                    for name in [name for name, deps in pending.items() if not deps]:
+                        logger.info("Running task '%s'" % name)
+                        running[executor.submit(_run_task, tasks[name])] = name
+                        del pending[name]
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        name = running.pop(future)
+
+                        # Re-raises unexpected errors, leaving the executor
+                        # to wait for the tasks that are still running
+                        self._finish(name, future.result(), pending, failures, skipped)
+
+        if failures:
+            raise SchedulerError(failures, skipped)
+
+    async def run_async(self, tasks):
+        # Same as run, for coroutine functions, every task being started on
+        # the running event loop as soon as its dependencies are done
+
+        pending = OrderedDict((name, self._dependencies_of(name, tasks))
+                              for name in self.order(tasks.keys()))
+        running = {}
+        failures = OrderedDict()
+        skipped = []
+
+        try:
+            while pending or running:
+
+                for name in [name for name, deps in pending.items() if not deps]:
+                    logger.info("Running task '%s'" % name)
+                    running[asyncio.ensure_future(_run_task_async(tasks[name]))] = name
+                    del pending[name]
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+
+                for future in done:
+                    name = running.pop(future)
+                    self._finish(name, future.result(), pending, failures, skipped)
+        except Exception:
+            # Unexpected errors stop the run once the running tasks are done
+            if running:
+                await asyncio.wait(running)
+            raise
+
+        if failures:
+            raise SchedulerError(failures, skipped)
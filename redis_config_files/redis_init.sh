@@ -0,0 +1,22 @@
+#!/bin/sh
+
+# Starts as a replica of the master known by the sentinels or, when there is
+# none yet, of the first node, which starts as the master
+
+HOST="$(hostname).${CLUSTER_SERVICE}"
+
+cp /usr/local/etc/redis/redis.conf /data/redis.conf
+echo "replica-announce-ip ${HOST}" >> /data/redis.conf
+
+MASTER=$(redis-cli -h "${SENTINEL_SERVICE}" -p 26379 \
+         sentinel get-master-addr-by-name "${MASTER_NAME}" 2>/dev/null | head -n 1)
+
+if [ -z "${MASTER}" ] && [ "$(hostname)" != "${FIRST_NODE}" ]; then
+    MASTER="${FIRST_NODE}.${CLUSTER_SERVICE}"
+fi
+
+if [ -n "${MASTER}" ] && [ "${MASTER}" != "${HOST}" ]; then
+    echo "replicaof ${MASTER} 6379" >> /data/redis.conf
+fi
+
+exec redis-server /data/redis.conf
@@ -0,0 +1,31 @@
+#!/bin/sh
+
+# Monitors the master known by the other sentinels or, when there is none
+# yet, the first node
+
+HOST="$(hostname).${CLUSTER_SERVICE}"
+
+MASTER=$(redis-cli -h "${SENTINEL_SERVICE}" -p 26379 \
+         sentinel get-master-addr-by-name "${MASTER_NAME}" 2>/dev/null | head -n 1)
+
+if [ -z "${MASTER}" ]; then
+    MASTER="${FIRST_NODE}.${CLUSTER_SERVICE}"
+fi
+
+# Sentinel needs the master name to resolve before it starts
+until getent hosts "${MASTER}" > /dev/null; do
+    sleep 1
+done
+
+cat > /data/sentinel.conf <<-EOCONF
+port 26379
+sentinel resolve-hostnames yes
+sentinel announce-hostnames yes
+sentinel announce-ip ${HOST}
+sentinel monitor ${MASTER_NAME} ${MASTER} 6379 ${QUORUM}
+sentinel down-after-milliseconds ${MASTER_NAME} 5000
+sentinel failover-timeout ${MASTER_NAME} 60000
+sentinel parallel-syncs ${MASTER_NAME} 1
+EOCONF
+
+exec redis-sentinel /data/sentinel.conf